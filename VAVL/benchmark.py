@@ -0,0 +1,340 @@
+# -*- coding: UTF-8 -*-
+# Local modules
+import io
+import os
+import re
+import sys
+import json
+import time
+import platform
+import argparse
+import contextlib
+# 3rd-Party Modules
+import numpy as np
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+# Self-Written Modules
+sys.path.append(os.getcwd())
+import utils
+import net
+from net import avmodel
+from conformer.attention import RelativeMultiHeadAttention
+from conformer.embedding import PositionalEncoding
+from conformer.encoder import ConformerBlock
+
+
+"""
+CPU micro-benchmarks of the model and data pipeline on synthetic inputs.
+
+Every case is timed after a few warm-up calls and reported as median/mean/min
+milliseconds per call. Results are written as JSON (--output) and, given a
+--baseline produced by an earlier run (e.g. on the main branch), every case
+whose median is more than --tolerance slower is reported and the script exits
+with status 1. Baselines are only comparable on the same machine, torch
+version and thread count; mismatches are printed as warnings.
+
+Example:
+    python benchmark.py --threads 4 --output bench_main.json
+    python benchmark.py --threads 4 --baseline bench_main.json --filter "conformer|train_step"
+
+Sequence lengths are in encoder frames (wav2vec2 runs at 50 frames/s), so the
+default 50,150,300 covers 1s, 3s and 6s utterances.
+"""
+
+
+class StubAudioEncoder(nn.Module):
+    """
+    Frozen stand-in for wav2vec2 with the same output rate (one 1024-dim frame
+    per 320 samples), so the train step can be timed without pretrained
+    weights. Its cost is not representative of wav2vec2.
+    """
+    def __init__(self, dim=1024):
+        super(StubAudioEncoder, self).__init__()
+        self.conv = nn.Conv1d(1, dim, kernel_size=400, stride=320)
+        for p in self.parameters():
+            p.requires_grad = False
+
+    def forward(self, x, attention_mask=None):
+        h = self.conv(x.unsqueeze(1)).transpose(1, 2)
+        return argparse.Namespace(last_hidden_state=h)
+
+
+def measure(fn, warmup=2, repeat=10):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(1000 * (time.perf_counter() - start))
+    times = np.array(times)
+    return {
+        "median_ms": round(float(np.median(times)), 4),
+        "mean_ms": round(float(np.mean(times)), 4),
+        "min_ms": round(float(np.min(times)), 4),
+        "std_ms": round(float(np.std(times)), 4),
+        "repeat": repeat,
+    }
+
+
+def fwd_bwd_cases(name, module, make_input):
+    """
+    Eval-mode forward under no_grad and train-mode forward+backward of module
+    """
+    def fwd():
+        module.eval()
+        with torch.no_grad():
+            module(*make_input())
+
+    def fwd_bwd():
+        module.train()
+        module.zero_grad(set_to_none=True)
+        out = module(*make_input())
+        out.float().pow(2).mean().backward()
+
+    return [(name + "/fwd", fwd), (name + "/fwd_bwd", fwd_bwd)]
+
+
+def model_cases(args):
+    model_args = argparse.Namespace(output_num=args.output_num, out_dropout=0.2)
+    attention = RelativeMultiHeadAttention(d_model=512, num_heads=8)
+    pos_encoding = PositionalEncoding(512)
+    block = ConformerBlock(encoder_dim=512)
+    acoustic = avmodel.Acoustic(model_args)
+    visual = avmodel.Visual(model_args)
+    shared = avmodel.Shared(model_args)
+
+    cases = []
+    for B in args.batch_sizes:
+        for T in args.seq_lens:
+            size = "B%d_T%d" % (B, T)
+            x = torch.randn(B, T, 512)
+            pos = pos_encoding(T).repeat(B, 1, 1)
+            cases += fwd_bwd_cases("attention/" + size, attention, lambda x=x, pos=pos: (x, x, x, pos))
+            cases += fwd_bwd_cases("conformer_block/" + size, block, lambda x=x: (x,))
+            # Acoustic/Visual take (B, T, D); Shared takes the (T, B, D) Conformer output
+            x_a = torch.randn(B, T, acoustic.a_dim)
+            x_v = torch.randn(B, T, visual.v_dim)
+            x_s = torch.randn(T, B, 512)
+            cases += fwd_bwd_cases("acoustic/" + size, acoustic, lambda x=x_a: (x,))
+            cases += fwd_bwd_cases("visual/" + size, visual, lambda x=x_v: (x,))
+            cases += fwd_bwd_cases("shared/" + size, shared, lambda x=x_s: (x,))
+    return cases
+
+
+def synthetic_corpus(num_utts, max_sec, vid_fps=30, vid_dim=1408, seed=0):
+    rng = np.random.RandomState(seed)
+    durs = rng.uniform(1.0, max_sec, size=num_utts)
+    wav_list = [rng.randn(int(dur * 16000)).astype(np.float32) * 0.1 for dur in durs]
+    vid_list = [rng.randn(int(dur * vid_fps), vid_dim).astype(np.float32) for dur in durs]
+    lab_list = [np.eye(6)[rng.randint(6)] for _ in durs]
+    utt_list = ["utt_%04d.wav" % i for i in range(num_utts)]
+    return wav_list, vid_list, lab_list, utt_list
+
+
+def data_cases(args):
+    vid_fps = 30
+    wav_list, vid_list, lab_list, utt_list = synthetic_corpus(args.num_utts, args.max_sec, vid_fps=vid_fps)
+    with contextlib.redirect_stderr(io.StringIO()):
+        wav_mean, wav_std = utils.get_norm_stat_for_wav(wav_list)
+        vid_mean, vid_std = utils.get_norm_stat_for_vid(vid_list)
+    dataset = utils.AudVidSet(wav_list, vid_list, lab_list, utt_list,
+        wav_mean=wav_mean, wav_std=wav_std, vid_mean=vid_mean, vid_std=vid_std,
+        print_dur=True, lab_type="categorical", label_config={"emo_type": list(range(6))}, vid_fps=vid_fps)
+    items = [dataset[idx] for idx in range(len(dataset))]
+
+    def getitem():
+        for idx in range(len(dataset)):
+            dataset[idx]
+
+    def norm_stat_wav():
+        # the normalisers draw a tqdm bar
+        with contextlib.redirect_stderr(io.StringIO()):
+            utils.get_norm_stat_for_wav(wav_list)
+
+    def norm_stat_vid():
+        with contextlib.redirect_stderr(io.StringIO()):
+            utils.get_norm_stat_for_vid(vid_list)
+
+    n = "x%d" % len(dataset)
+    cases = [
+        ("dataset/getitem_" + n, getitem),
+        ("normalizer/wav_" + n, norm_stat_wav),
+        ("normalizer/vid_" + n, norm_stat_vid),
+    ]
+    for B in args.batch_sizes:
+        batch = items[:B]
+        cases.append(("collate_fn_padd/B%d" % B, lambda batch=batch: utils.collate_fn_padd(batch)))
+    return cases
+
+
+def loss_cases(args):
+    cases = []
+    for B in [64, 4096]:
+        pred = torch.rand(B, 3, requires_grad=True)
+        lab = torch.rand(B, 3)
+
+        def ccc(pred=pred, lab=lab):
+            utils.CCC_loss(pred, lab).sum().backward()
+        cases.append(("ccc_loss/B%d" % B, ccc))
+    return cases
+
+
+def train_step(modelWrapper, xa, xv, y, mask):
+    """
+    The three phases of one (categorical) train.py step, without autocast
+    """
+    preds_v, x_in, rec_pred = modelWrapper.feed_forward(None, xv, mode='visual', attention_mask=mask)
+    total_loss_v = utils.CE_category(preds_v, y) + 2*utils.MSE_loss(rec_pred, x_in)
+    modelWrapper.backprop(total_loss_v, 'visual')
+
+    preds_a, x_in, rec_pred = modelWrapper.feed_forward(xa, None, mode='acoustic', attention_mask=mask)
+    total_loss_a = utils.CE_category(preds_a, y) + 2*utils.MSE_loss(rec_pred, x_in)
+    modelWrapper.backprop(total_loss_a, 'acoustic')
+
+    preds_a, preds_v, preds = modelWrapper.feed_forward(xa, xv, mode='weights', attention_mask=mask)
+    total_loss = utils.CE_category(preds, y)
+    modelWrapper.backprop(total_loss, 'weights')
+
+
+def train_step_cases(args):
+    model_args = argparse.Namespace(device='cpu', model_type="stub", hidden_dim=1024, num_layers=2,
+        output_num=args.output_num, label_type="categorical", label_learning="hard-label",
+        lr=1e-4, model_path=None, out_dropout=0.2)
+    modelWrapper = net.ModelWrapper(model_args)
+    modelWrapper.wav2vec_model = StubAudioEncoder()
+    modelWrapper.init_heads()
+    modelWrapper.init_optimizer()
+
+    cases = []
+    for B in args.batch_sizes:
+        for T in args.seq_lens:
+            num_samples = T * 320
+            xa = torch.randn(B, num_samples) * 0.1
+            xv = torch.randn(B, T, modelWrapper.visual_model.v_dim)
+            y = F.one_hot(torch.randint(0, args.output_num, (B,)), args.output_num).float()
+            mask = torch.ones(B, num_samples)
+
+            def step(xa=xa, xv=xv, y=y, mask=mask):
+                modelWrapper.set_train()
+                train_step(modelWrapper, xa, xv, y, mask)
+            cases.append(("train_step/B%d_T%d" % (B, T), step))
+    return cases
+
+
+def environment(args):
+    return {
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "threads": torch.get_num_threads(),
+        "batch_sizes": args.batch_sizes,
+        "seq_lens": args.seq_lens,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print current vs. baseline medians, return the names of the cases slower than 1 + tolerance
+    """
+    for key in ["torch", "machine", "processor", "threads"]:
+        if baseline["env"].get(key) != results["env"].get(key):
+            print("Warning: %s differs from the baseline (%s vs. %s)" % (key, results["env"].get(key), baseline["env"].get(key)))
+
+    regressions = []
+    print("%-40s %12s %12s %8s" % ("case", "baseline ms", "current ms", "ratio"))
+    for name, result in results["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is None:
+            print("%-40s %12s %12.3f %8s" % (name, "-", result["median_ms"], "new"))
+            continue
+        ratio = result["median_ms"] / max(base["median_ms"], 1e-9)
+        status = ""
+        if ratio > 1 + tolerance:
+            status = "SLOWER"
+            regressions.append(name)
+        elif ratio < 1 / (1 + tolerance):
+            status = "faster"
+        print("%-40s %12.3f %12.3f %8.3f %s" % (name, base["median_ms"], result["median_ms"], ratio, status))
+    return regressions
+
+
+def main(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    utils.set_deterministic(args.seed, deterministic=False)
+
+    case_fns = model_cases(args) + data_cases(args) + loss_cases(args) + train_step_cases(args)
+    if args.filter is not None:
+        case_fns = [(name, fn) for name, fn in case_fns if re.search(args.filter, name)]
+
+    results = {"env": environment(args), "cases": {}}
+    for name, fn in case_fns:
+        results["cases"][name] = measure(fn, warmup=args.warmup, repeat=args.repeat)
+        print("%-40s %10.3f ms" % (name, results["cases"][name]["median_ms"]))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print("Results saved to", args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) != 0:
+            print("Regressions (> %d%% slower):" % round(100 * args.tolerance), ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    # Inputs for the main function
+    parser = argparse.ArgumentParser()
+
+    # Benchmark Arguments
+    parser.add_argument(
+        '--batch_sizes', type=lambda s: [int(v) for v in s.split(",")], default="2,8",
+        help='comma separated batch sizes')
+    parser.add_argument(
+        '--seq_lens', type=lambda s: [int(v) for v in s.split(",")], default="50,150,300",
+        help='comma separated sequence lengths, in encoder frames')
+    parser.add_argument(
+        '--num_utts', type=int, default=64,
+        help='synthetic utterances for the data pipeline cases')
+    parser.add_argument(
+        '--max_sec', type=float, default=8.0,
+        help='maximum duration of the synthetic utterances')
+    parser.add_argument(
+        '--output_num', type=int, default=6)
+    parser.add_argument(
+        '--filter', type=str, default=None,
+        help='only run the cases whose name matches this regular expression')
+    parser.add_argument(
+        '--warmup', type=int, default=2)
+    parser.add_argument(
+        '--repeat', type=int, default=10)
+    parser.add_argument(
+        '--threads', type=int, default=None,
+        help='torch intra-op threads (default: torch default)')
+    parser.add_argument(
+        '--seed', type=int, default=0)
+
+    # Output Arguments
+    parser.add_argument(
+        '--output', type=str, default=None,
+        help='JSON file for the results')
+    parser.add_argument(
+        '--baseline', type=str, default=None,
+        help='results JSON of an earlier run to compare against')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1,
+        help='relative slowdown of the median reported as a regression')
+
+    args = parser.parse_args()
+
+    # Call main function
+    main(args)
@@ -0,0 +1,411 @@
+# -*- coding: UTF-8 -*-
+# Local modules
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+# 3rd-Party Modules
+from tqdm import tqdm
+import numpy as np
+
+# PyTorch Modules
+import torch
+from torch.utils.data import DataLoader
+from torch.cuda.amp import autocast
+# Self-Written Modules
+sys.path.append(os.getcwd())
+import utils
+import net
+from train import evaluate_test, report_test
+
+
+"""
+Distils a trained VAVL model (teacher) into a smaller student: fewer and
+narrower Conformer layers (--encoder_dim, --num_heads, --*_layers) and
+optionally a lighter audio encoder (--model_type, see net/audio_encoder.py).
+
+The student is trained with the three phases of train.py, each head against
+the labels and against the cached outputs of the matching teacher head
+(MLP_v, MLP_a and MultitaskFusion), exported beforehand with
+
+    python export_embeddings.py --model_path <teacher> --splits train ...
+
+Afterwards teacher and student are evaluated on the test set and their
+accuracy, parameter count, inference latency and peak memory are written to
+<model_path>/distill_report.json. The student directory holds the usual head
+files plus model_config.json, so test.py and stream.py can load it directly.
+"""
+
+
+def load_teacher_outputs(store_root, utts):
+    """
+    utt id -> row of the teacher's pred_a/pred_v/pred, loaded in memory
+    """
+    store = utils.EmbeddingStore(store_root)
+    missing = set(utts) - set(store.utts)
+    assert len(missing) == 0, "%d utterances have no teacher outputs in %s" % (len(missing), store_root)
+    index = {utt: idx for idx, utt in enumerate(store.utts)}
+    outputs = {name: torch.from_numpy(np.array(store[name])) for name in ["pred_a", "pred_v", "pred"]}
+    return outputs, index
+
+
+def student_loss(pred, y, teacher_pred, args):
+    if args.label_type == "categorical":
+        hard_loss = utils.CE_category(pred, y)
+    elif args.label_type == "dimensional":
+        hard_loss = 3.0 - utils.CCC_loss(pred, y).sum()
+    soft_loss = utils.KD_loss(pred, teacher_pred, args.kd_temperature, args.label_type)
+    return (1.0 - args.kd_alpha) * hard_loss + args.kd_alpha * soft_loss
+
+
+def count_parameters(modelWrapper):
+    heads = sum(p.numel() for model in modelWrapper.head_models() for p in model.parameters())
+    encoder = sum(p.numel() for p in modelWrapper.wav2vec_model.parameters())
+    return {
+        "head_params": heads,
+        "encoder_params": encoder,
+        "param_mb": round(4 * (heads + encoder) / 2**20, 2),
+    }
+
+
+def measure_inference(modelWrapper, loader, args, num_batches):
+    """
+    Mean latency of the full audiovisual forward pass over the first
+    num_batches batches (after one warm-up batch), and its peak device memory
+    """
+    use_cuda = str(args.device).startswith('cuda')
+    modelWrapper.set_eval()
+    times, num_utts = [], 0
+    if use_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    with torch.no_grad():
+        for bidx, xy_pair in enumerate(loader):
+            if bidx > num_batches:
+                break
+            xa = xy_pair[0].to(args.device).float()
+            xv = xy_pair[1].to(args.device).float()
+            mask = xy_pair[3].to(args.device).float()
+            start = time.perf_counter()
+            modelWrapper.feed_forward(xa, xv, mode='weights', attention_mask=mask)
+            if use_cuda:
+                torch.cuda.synchronize()
+            if bidx > 0:
+                times.append(time.perf_counter() - start)
+                num_utts += xa.size(0)
+    result = {
+        "ms_per_batch": round(1000 * float(np.mean(times)), 3) if len(times) > 0 else None,
+        "utt_per_sec": round(num_utts / sum(times), 3) if len(times) > 0 else None,
+        # host memory is not attributable to one of the two models in the same process
+        "peak_mem_mb": round(torch.cuda.max_memory_allocated() / 2**20, 1) if use_cuda else None,
+    }
+    return result
+
+
+def evaluate_model(modelWrapper, loader, args):
+    lm = utils.LogManager()
+    lm.alloc_stat_type_list(["test_loss", "test_acc", "test_aro", "test_dom", "test_val",
+        "test_aro_a", "test_dom_a", "test_val_a", "test_aro_v", "test_dom_v", "test_val_v"])
+    modelWrapper.set_eval()
+    test_out = evaluate_test(modelWrapper, loader, args, lm)
+    return test_out, lm
+
+
+def dev_loss_of(lm, args):
+    if args.label_type == "dimensional":
+        return 3.0 - lm.get_stat("test_aro") - lm.get_stat("test_dom") - lm.get_stat("test_val")
+    return float(lm.get_stat("test_loss"))
+
+
+def main(args):
+    utils.print_config_description(args.conf_path)
+    config_dict = utils.load_env(args.conf_path)
+    assert config_dict.get("config_root", None) != None, "No config_root in config/conf.json"
+    config_path = os.path.join(config_dict["config_root"], config_dict[args.corpus_type])
+    utils.print_config_description(config_path)
+
+    utils.set_deterministic(args.seed)
+
+    model_path = args.model_path
+    os.makedirs(model_path, exist_ok=True)
+    teacher_path = args.teacher_path
+
+    # Initialize dataset, normalised with the teacher's statistics the cached outputs were computed with
+    DataManager=utils.DataManager(config_path)
+    lab_type = args.label_type
+
+    audio_path, video_path, label_path = utils.load_audio_and_label_file_paths(args)
+    fnames_aud, fnames_vid = utils.get_matched_fnames(audio_path, video_path)
+
+    norm_stat_file = os.path.join(teacher_path, "train_norm_stat.pkl")
+    wav_mean, wav_std, vid_mean, vid_std = utils.load_norm_stat(norm_stat_file)
+    shutil.copyfile(norm_stat_file, os.path.join(model_path, "train_norm_stat.pkl"))
+
+    total_dataloader = {}
+    total_utts = {}
+    for split_type in ["train", "dev", "test"]:
+        wavs, vids, labs, utts = DataManager.get_split_data(split_type,
+            audio_path, video_path, label_path, fnames_aud, fnames_vid, lab_type)
+        cur_set = utils.AudVidSet(wavs, vids, labs, utts,
+            print_dur=True, lab_type=lab_type, print_utt=True,
+            wav_mean = wav_mean, wav_std = wav_std,
+            vid_mean = vid_mean, vid_std = vid_std,
+            label_config = DataManager.get_label_config(lab_type),
+            vid_fps = DataManager.get_vid_fps(utts),
+            vid_frame_index = DataManager.get_vid_frame_index(utts)
+        )
+        total_dataloader[split_type] = DataLoader(cur_set, batch_size=args.batch_size, collate_fn=utils.collate_fn_padd, shuffle=False)
+        total_utts[split_type] = utts
+
+    teacher_embeddings = args.teacher_embeddings or os.path.join(teacher_path, "embeddings", "train")
+    teacher_out, teacher_index = load_teacher_outputs(teacher_embeddings, total_utts["train"])
+
+    # Student
+    modelWrapper = net.ModelWrapper(args)
+    modelWrapper.init_model()
+    modelWrapper.init_optimizer()
+    if args.wav2vec_path is not None:
+        modelWrapper.load_model(args.wav2vec_path, 'train')
+    utils.save_model_config(model_path, args)
+    if len(list(modelWrapper.wav2vec_model.parameters())) != 0:
+        # the (frozen) student encoder, so that --wav2vec_path <model_path> works in test.py
+        torch.save(modelWrapper.wav2vec_model.state_dict(), os.path.join(model_path, "final_wav2vec.pt"))
+
+    rec_weight = 2.0 if args.label_type == "categorical" else 1.0
+    best_dev_loss = float("inf")
+    best_epoch = -1
+    losses_train, losses_dev = [], []
+    for epoch in range(args.epochs):
+        print("Epoch:", epoch)
+        train_loss = utils.LogManager()
+        train_loss.alloc_stat_type("train_loss")
+        for xy_pair in tqdm(total_dataloader["train"]):
+            modelWrapper.set_train()
+            xa = xy_pair[0].to(args.device, non_blocking=True).float()
+            xv = xy_pair[1].to(args.device, non_blocking=True).float()
+            y = xy_pair[2].to(args.device, non_blocking=True).float()
+            mask = xy_pair[3].to(args.device, non_blocking=True).float()
+            rows = torch.tensor([teacher_index[utt] for utt in xy_pair[4]])
+            teacher = {name: value[rows].to(args.device) for name, value in teacher_out.items()}
+
+            with autocast():
+                preds_v, x_in, rec_pred = modelWrapper.feed_forward(None, xv, mode = 'visual', attention_mask=mask)
+                total_loss_v = student_loss(preds_v, y, teacher["pred_v"], args) + rec_weight*utils.MSE_loss(rec_pred, x_in)
+            modelWrapper.backprop(total_loss_v, 'visual')
+
+            with autocast():
+                preds_a, x_in, rec_pred = modelWrapper.feed_forward(xa, None, mode = 'acoustic', attention_mask=mask)
+                total_loss_a = student_loss(preds_a, y, teacher["pred_a"], args) + rec_weight*utils.MSE_loss(rec_pred, x_in)
+            modelWrapper.backprop(total_loss_a, 'acoustic')
+
+            with autocast():
+                preds_a, preds_v, preds = modelWrapper.feed_forward(xa, xv, mode = 'weights', attention_mask=mask)
+                total_loss = student_loss(preds, y, teacher["pred"], args)
+            modelWrapper.backprop(total_loss, 'weights')
+            train_loss.add_torch_stat("train_loss", total_loss, weight=y.size(0))
+
+        _, dev_lm = evaluate_model(modelWrapper, total_dataloader["dev"], args)
+        dev_loss = dev_loss_of(dev_lm, args)
+        losses_train.append(float(train_loss.get_stat("train_loss")))
+        losses_dev.append(dev_loss)
+        print("train_loss", losses_train[-1], "dev_loss", dev_loss)
+        if dev_loss < best_dev_loss:
+            best_dev_loss = dev_loss
+            best_epoch = epoch
+            print('better dev loss found:' + str(dev_loss) + ' saving model')
+            modelWrapper.save_model(epoch)
+
+    # Student: selected epoch
+    modelWrapper.load_model(model_path, 'test')
+    student_out, student_lm = evaluate_model(modelWrapper, total_dataloader["test"], args)
+    student_result = report_test(student_out, args, student_lm, model_path)
+    student_result.update(count_parameters(modelWrapper))
+    student_result.update(measure_inference(modelWrapper, total_dataloader["test"], args, args.latency_batches))
+    student_result.update({"epoch": best_epoch, "dev_loss": best_dev_loss})
+    del modelWrapper
+    if str(args.device).startswith('cuda'):
+        torch.cuda.empty_cache()
+
+    # Teacher
+    teacher_args = argparse.Namespace(**vars(args))
+    for key in utils.MODEL_SIZE_ARGS:
+        if hasattr(teacher_args, key):
+            delattr(teacher_args, key)
+    teacher_args.model_type = args.teacher_model_type
+    utils.load_model_config(teacher_path, teacher_args)
+    teacherWrapper = net.ModelWrapper(teacher_args)
+    teacherWrapper.init_model()
+    teacherWrapper.load_model(args.teacher_wav2vec_path, 'train')
+    teacherWrapper.load_model(teacher_path, 'test')
+    teacher_test_out, teacher_lm = evaluate_model(teacherWrapper, total_dataloader["test"], teacher_args)
+    teacher_result = report_test(teacher_test_out, teacher_args, teacher_lm, teacher_path)
+    teacher_result.update(count_parameters(teacherWrapper))
+    teacher_result.update(measure_inference(teacherWrapper, total_dataloader["test"], teacher_args, args.latency_batches))
+
+    report = {
+        "teacher_path": teacher_path,
+        "student_config": {key: getattr(args, key) for key in utils.MODEL_SIZE_ARGS},
+        "kd_alpha": args.kd_alpha,
+        "kd_temperature": args.kd_temperature,
+        "batch_size": args.batch_size,
+        "device": args.device,
+        "teacher": teacher_result,
+        "student": student_result,
+    }
+    with open(os.path.join(model_path, "distill_report.json"), 'w') as f:
+        json.dump(report, f, indent=4)
+    with open(os.path.join(model_path, "train_loss.txt"), 'w') as f:
+        for item in losses_train:
+            f.write("%s\n" % item)
+    with open(os.path.join(model_path, "dev_loss.txt"), 'w') as f:
+        for item in losses_dev:
+            f.write("%s\n" % item)
+
+    print("%-24s %14s %14s" % ("", "teacher", "student"))
+    for key in student_result:
+        if isinstance(student_result[key], (int, float)) and isinstance(teacher_result.get(key), (int, float)):
+            print("%-24s %14.4f %14.4f" % (key, teacher_result[key], student_result[key]))
+    print("Report saved to", os.path.join(model_path, "distill_report.json"))
+
+
+if __name__ == "__main__":
+    # Inputs for the main function
+    parser = argparse.ArgumentParser()
+
+    # Experiment Arguments
+    parser.add_argument(
+        '--device',
+        choices=['cuda', 'cpu'],
+        default='cuda',
+        type=str)
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int)
+    parser.add_argument(
+        '--conf_path',
+        default="config/conf.json",
+        type=str)
+
+    # Data Arguments
+    parser.add_argument(
+        '--corpus_type',
+        default="podcast_v1.7",
+        type=str)
+    parser.add_argument(
+        '--label_type',
+        choices=['dimensional', 'categorical'],
+        default='categorical',
+        type=str)
+
+    # Teacher Arguments
+    parser.add_argument(
+        '--teacher_path', type=str, required=True,
+        help='model directory of the trained teacher')
+    parser.add_argument(
+        '--teacher_embeddings', type=str, default=None,
+        help='export_embeddings.py output of the teacher on the train split (default: <teacher_path>/embeddings/train)')
+    parser.add_argument(
+        '--teacher_model_type', type=str, default="wav2vec2",
+        help='audio encoder of the teacher')
+    parser.add_argument(
+        '--teacher_wav2vec_path', type=str, default=None,
+        help='directory of the teacher final_wav2vec.pt (default: pretrained weights)')
+
+    # Student Arguments
+    parser.add_argument(
+        '--model_path',
+        default=None,
+        type=str)
+    parser.add_argument(
+        '--model_type', type=str, default="wav2vec2",
+        help='audio encoder of the student, see net/audio_encoder.py')
+    parser.add_argument(
+        '--wav2vec_path', type=str, default=None,
+        help='directory of a fine-tuned final_wav2vec.pt for the student encoder (default: pretrained weights)')
+    parser.add_argument(
+        '--encoder_dim', type=int, default=256,
+        help='Conformer dimension of the student (teacher: 512)')
+    parser.add_argument(
+        '--num_heads', type=int, default=4,
+        help='attention heads of the student Conformers (teacher: 8)')
+    parser.add_argument(
+        '--acoustic_layers', type=int, default=2,
+        help='acoustic Conformer layers of the student (teacher: 3)')
+    parser.add_argument(
+        '--visual_layers', type=int, default=2,
+        help='visual Conformer layers of the student (teacher: 3)')
+    parser.add_argument(
+        '--shared_layers', type=int, default=1,
+        help='shared Conformer layers of the student (teacher: 2)')
+    parser.add_argument(
+        '--output_num',
+        default=4,
+        type=int)
+    parser.add_argument(
+        '--batch_size',
+        default=128,
+        type=int)
+    parser.add_argument(
+        '--hidden_dim',
+        default=256,
+        type=int)
+    parser.add_argument(
+        '--num_layers',
+        default=3,
+        type=int)
+    parser.add_argument(
+        '--epochs',
+        default=100,
+        type=int)
+    parser.add_argument(
+        '--lr',
+        default=1e-5,
+        type=float)
+    parser.add_argument(
+        '--out_dropout', type=float, default=0.2,
+        help='output layer dropout (default: 0.2')
+
+    # Distillation Arguments
+    parser.add_argument(
+        '--kd_alpha', type=float, default=0.5,
+        help='weight of the teacher loss, 1 - kd_alpha goes to the label loss (default: 0.5)')
+    parser.add_argument(
+        '--kd_temperature', type=float, default=2.0,
+        help='softmax temperature of the categorical teacher loss (default: 2.0)')
+    parser.add_argument(
+        '--latency_batches', type=int, default=20,
+        help='test batches timed for the latency report (default: 20)')
+
+     # Label Learning Arguments
+    parser.add_argument(
+        '--label_learning',
+        default="hard-label",
+        type=str)
+    parser.add_argument(
+        '--corpus',
+        default="USC-IEMOCAP",
+        type=str)
+    parser.add_argument(
+        '--num_classes',
+        default="four",
+        type=str)
+    parser.add_argument(
+        '--label_rule',
+        default="M",
+        type=str)
+    parser.add_argument(
+        '--partition_number',
+        default="1",
+        type=str)
+    parser.add_argument(
+        '--data_mode',
+        default="primary",
+        type=str)
+
+    args = parser.parse_args()
+
+    # Call main function
+    main(args)
@@ -0,0 +1,186 @@
+# -*- coding: UTF-8 -*-
+# Local modules
+import os
+import sys
+import argparse
+# 3rd-Party Modules
+from tqdm import tqdm
+
+# PyTorch Modules
+import torch
+from torch.utils.data import DataLoader
+# Self-Written Modules
+sys.path.append(os.getcwd())
+import utils
+import net
+
+
+def main(args):
+    utils.print_config_description(args.conf_path)
+    config_dict = utils.load_env(args.conf_path)
+    assert config_dict.get("config_root", None) != None, "No config_root in config/conf.json"
+    config_path = os.path.join(config_dict["config_root"], config_dict[args.corpus_type])
+    utils.print_config_description(config_path)
+
+    model_path = args.model_path
+    export_path = args.export_path or os.path.join(model_path, "embeddings")
+
+    DataManager=utils.DataManager(config_path)
+    lab_type = args.label_type
+
+    audio_path, video_path, label_path = utils.load_audio_and_label_file_paths(args)
+    fnames_aud, fnames_vid = utils.get_matched_fnames(audio_path, video_path)
+
+    wav_mean, wav_std, vid_mean, vid_std = utils.load_norm_stat(os.path.join(model_path, "train_norm_stat.pkl"))
+
+    # Heads of a non-default size (e.g. distill.py students) are described by model_config.json
+    utils.load_model_config(model_path, args)
+    modelWrapper = net.ModelWrapper(args)
+    modelWrapper.init_model()
+    modelWrapper.load_model(args.wav2vec_path, 'train')
+    modelWrapper.load_model(model_path, 'test')
+    modelWrapper.set_eval()
+
+    for split_type in args.splits.split(","):
+        wavs, vids, labs, utts = DataManager.get_split_data(split_type,
+            audio_path, video_path, label_path, fnames_aud, fnames_vid, lab_type)
+        # Same batching as the 'weights' phase of train.py (shuffle=False),
+        # so the exported vectors are the ones MultitaskFusion is trained on.
+        cur_set = utils.AudVidSet(wavs, vids, labs, utts,
+            print_dur=True, lab_type=lab_type, print_utt=True,
+            wav_mean = wav_mean, wav_std = wav_std,
+            vid_mean = vid_mean, vid_std = vid_std,
+            label_config = DataManager.get_label_config(lab_type),
+            vid_fps = DataManager.get_vid_fps(utts),
+            vid_frame_index = DataManager.get_vid_frame_index(utts)
+        )
+        loader = DataLoader(cur_set, batch_size=args.batch_size, collate_fn=utils.collate_fn_padd, shuffle=False)
+
+        store = utils.EmbeddingStore.create(os.path.join(export_path, split_type), utts, {
+                "rep_a": modelWrapper.shared_model.hidden_2,
+                "rep_v": modelWrapper.shared_model.hidden_2,
+                "pred_a": args.output_num,
+                "pred_v": args.output_num,
+                "pred": args.output_num,
+                "label": len(labs[0]),
+            },
+            label_type=lab_type, batch_size=args.batch_size, model_path=model_path)
+
+        print("Exporting", split_type, "embeddings to", store.root)
+        sidx = 0
+        with torch.no_grad():
+            for xy_pair in tqdm(loader):
+                xa = xy_pair[0].to(args.device, non_blocking=True).float()
+                xv = xy_pair[1].to(args.device, non_blocking=True).float()
+                y = xy_pair[2]
+                mask = xy_pair[3].to(args.device, non_blocking=True).float()
+
+                rep_a, rep_v, pred_a, pred_v, pred = modelWrapper.feed_forward(xa, xv, mode = 'embeddings', attention_mask=mask)
+                store.write(sidx,
+                    rep_a=rep_a.float().cpu().numpy(), rep_v=rep_v.float().cpu().numpy(),
+                    pred_a=pred_a.float().cpu().numpy(), pred_v=pred_v.float().cpu().numpy(),
+                    pred=pred.float().cpu().numpy(), label=y.numpy())
+                sidx += y.size(0)
+        store.flush()
+
+
+if __name__ == "__main__":
+    # Inputs for the main function
+    parser = argparse.ArgumentParser()
+
+    # Experiment Arguments
+    parser.add_argument(
+        '--device',
+        choices=['cuda', 'cpu'],
+        default='cuda',
+        type=str)
+    parser.add_argument(
+        '--conf_path',
+        default="config/conf.json",
+        type=str)
+
+    # Data Arguments
+    parser.add_argument(
+        '--corpus_type',
+        default="podcast_v1.7",
+        type=str)
+    parser.add_argument(
+        '--model_type',
+        default="wav2vec2",
+        type=str)
+    parser.add_argument(
+        '--label_type',
+        choices=['dimensional', 'categorical'],
+        default='categorical',
+        type=str)
+
+    # Model Arguments
+    parser.add_argument(
+        '--model_path',
+        default=None,
+        type=str)
+    parser.add_argument(
+        '--wav2vec_path', type=str, default=None,
+        help='directory of a fine-tuned final_wav2vec.pt for the audio encoder (default: pretrained weights)')
+    parser.add_argument(
+        '--output_num',
+        default=4,
+        type=int)
+    parser.add_argument(
+        '--batch_size',
+        default=128,
+        type=int)
+    parser.add_argument(
+        '--hidden_dim',
+        default=256,
+        type=int)
+    parser.add_argument(
+        '--num_layers',
+        default=3,
+        type=int)
+    parser.add_argument(
+        '--lr',
+        default=1e-5,
+        type=float)
+
+     # Label Learning Arguments
+    parser.add_argument(
+        '--label_learning',
+        default="multi-label",
+        type=str)
+    parser.add_argument(
+        '--corpus',
+        default="USC-IEMOCAP",
+        type=str)
+    parser.add_argument(
+        '--num_classes',
+        default="four",
+        type=str)
+    parser.add_argument(
+        '--label_rule',
+        default="M",
+        type=str)
+    parser.add_argument(
+        '--partition_number',
+        default="1",
+        type=str)
+    parser.add_argument(
+        '--data_mode',
+        default="primary",
+        type=str)
+    parser.add_argument(
+        '--out_dropout', type=float, default=0.2,
+        help='output layer dropout (default: 0.2')
+
+    # Export Arguments
+    parser.add_argument(
+        '--export_path', type=str, default=None,
+        help='output directory (default: <model_path>/embeddings)')
+    parser.add_argument(
+        '--splits', type=str, default="train,dev,test",
+        help='comma separated data splits to export')
+
+    args = parser.parse_args()
+
+    # Call main function
+    main(args)
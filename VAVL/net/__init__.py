@@ -1 +1,3 @@
-from .modelWrapper import *
\ No newline at end of file
+from .modelWrapper import *
+from .streaming import *
+from .audio_encoder import *
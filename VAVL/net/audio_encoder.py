@@ -0,0 +1,111 @@
+from collections import namedtuple
+
+import torch
+from torch import nn
+import librosa
+
+
+"""
+Audio front-ends selectable with --model_type.
+
+Every encoder maps a (B, samples) 16kHz waveform to (B, frames, dim) features
+at one frame per 320 samples (400 sample receptive field), so the streaming
+frame arithmetic and the face/audio alignment hold for all of them. dim is
+passed to the heads as model_args.a_dim.
+
+    wav2vec2-large-robust (default, "wav2vec2")  1024  top 12 layers pruned
+    wav2vec2-large                                1024
+    wav2vec2-base                                 768
+    distilhubert                                  768   2 transformer layers
+    log-mel                                       80    no network, cheapest
+
+New front-ends are added with @register_audio_encoder(name, dim).
+"""
+
+
+AudioEncoderOutput = namedtuple("AudioEncoderOutput", ["last_hidden_state"])
+AudioEncoderSpec = namedtuple("AudioEncoderSpec", ["name", "dim", "use_mask", "build"])
+
+AUDIO_ENCODERS = {}
+AUDIO_ENCODER_ALIASES = {
+    "wav2vec2": "wav2vec2-large-robust",
+}
+
+
+def register_audio_encoder(name, dim, use_mask=True):
+    """
+    use_mask: whether the padding mask is passed to the encoder. The wav2vec2
+    models with group-normalised feature extractors (base, distilhubert) were
+    pre-trained without one and expect zero-padded inputs instead.
+    """
+    def decorator(build):
+        AUDIO_ENCODERS[name] = AudioEncoderSpec(name, dim, use_mask, build)
+        return build
+    return decorator
+
+
+def get_audio_encoder(model_type):
+    name = AUDIO_ENCODER_ALIASES.get(model_type, model_type)
+    assert name in AUDIO_ENCODERS, \
+        "Wrong model type %s, choose from %s" % (model_type, sorted(list(AUDIO_ENCODERS) + list(AUDIO_ENCODER_ALIASES)))
+    return AUDIO_ENCODERS[name]
+
+
+@register_audio_encoder("wav2vec2-large", 1024)
+def build_wav2vec2_large():
+    from transformers import Wav2Vec2Model
+    model = Wav2Vec2Model.from_pretrained("facebook/wav2vec2-large")
+    model.freeze_feature_encoder()
+    return model
+
+
+@register_audio_encoder("wav2vec2-large-robust", 1024)
+def build_wav2vec2_large_robust():
+    from transformers import Wav2Vec2Model
+    model = Wav2Vec2Model.from_pretrained("facebook/wav2vec2-large-robust")
+    model.freeze_feature_encoder()
+    del model.encoder.layers[12:]
+    return model
+
+
+@register_audio_encoder("wav2vec2-base", 768, use_mask=False)
+def build_wav2vec2_base():
+    from transformers import Wav2Vec2Model
+    model = Wav2Vec2Model.from_pretrained("facebook/wav2vec2-base")
+    model.freeze_feature_encoder()
+    return model
+
+
+@register_audio_encoder("distilhubert", 768, use_mask=False)
+def build_distilhubert():
+    from transformers import HubertModel
+    model = HubertModel.from_pretrained("ntu-spml/distilhubert")
+    model.freeze_feature_encoder()
+    return model
+
+
+class LogMelEncoder(nn.Module):
+    """
+    Log-mel filterbank energies (25ms window, 20ms hop, no padding), leaving all
+    modelling to the Acoustic Conformer
+    """
+    def __init__(self, n_mels=80, sr=16000, n_fft=400, hop_length=320):
+        super(LogMelEncoder, self).__init__()
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        mel_fb = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+        self.register_buffer("mel_fb", torch.from_numpy(mel_fb).float())
+        self.register_buffer("window", torch.hann_window(n_fft))
+
+    def forward(self, x, attention_mask=None):
+        with torch.cuda.amp.autocast(enabled=False):
+            spec = torch.stft(x.float(), self.n_fft, hop_length=self.hop_length, window=self.window,
+                center=False, return_complex=True).abs().pow(2)
+            mel = torch.matmul(self.mel_fb, spec)
+            log_mel = torch.log(mel + 1e-6).transpose(1, 2)
+        return AudioEncoderOutput(last_hidden_state=log_mel)
+
+
+@register_audio_encoder("log-mel", 80, use_mask=False)
+def build_log_mel():
+    return LogMelEncoder(n_mels=80)
@@ -9,8 +9,8 @@ class MultitaskFusion(nn.Module):
         super(MultitaskFusion, self).__init__()
         output_dim = model_args.output_num
         self.out_dropout = model_args.out_dropout
-        self.hidden_1 = 256
-        self.hidden_2 = 512
+        self.hidden_2 = getattr(model_args, "encoder_dim", 512)
+        self.hidden_1 = self.hidden_2 // 2
 
         self.projav1 = nn.Linear(2*self.hidden_2, self.hidden_2)
         self.projav2 = nn.Linear(self.hidden_2, self.hidden_1)
@@ -32,9 +32,9 @@ class Acoustic(nn.Module):
         super(Acoustic, self).__init__()
 
         # Model Hyperparameters
-        self.a_dim, self.v_dim = 1024, 1408
+        self.a_dim, self.v_dim = getattr(model_args, "a_dim", 1024), 1408
         self.d_v = 50
-        self.hidden_2 = 512
+        self.hidden_2 = getattr(model_args, "encoder_dim", 512)
 
         # 1D convolutional projection layers
         self.conv_1d_a = nn.Conv1d(self.a_dim, self.d_v, kernel_size=1, padding=0, bias=False)
@@ -43,7 +43,8 @@ class Acoustic(nn.Module):
         self.x_acoustic = Conformer(
                                 input_dim=self.d_v, 
                                 encoder_dim=self.hidden_2, 
-                                num_encoder_layers=3)
+                                num_encoder_layers=getattr(model_args, "acoustic_layers", 3),
+                                num_attention_heads=getattr(model_args, "num_heads", 8))
 
 
     def forward(self, x_aud):
@@ -62,9 +63,9 @@ class Visual(nn.Module):
         super(Visual, self).__init__()
 
         # Model Hyperparameters
-        self.a_dim, self.v_dim = 1024, 1408
+        self.a_dim, self.v_dim = getattr(model_args, "a_dim", 1024), 1408
         self.d_v = 50
-        self.hidden_2 = 512
+        self.hidden_2 = getattr(model_args, "encoder_dim", 512)
 
 
         # 1D convolutional projection layers
@@ -72,7 +73,8 @@ class Visual(nn.Module):
 
         self.x_visual = Conformer(input_dim=self.d_v, 
                                 encoder_dim=self.hidden_2, 
-                                num_encoder_layers=3)
+                                num_encoder_layers=getattr(model_args, "visual_layers", 3),
+                                num_attention_heads=getattr(model_args, "num_heads", 8))
 
 
     def forward(self, x_vid):
@@ -95,22 +97,31 @@ class Shared(nn.Module):
         super(Shared, self).__init__()
 
         # Model Hyperparameters
-        self.hidden_2 = 512
+        self.hidden_2 = getattr(model_args, "encoder_dim", 512)
 
         self.x_shared = Conformer(input_dim=self.hidden_2, 
                                 encoder_dim=self.hidden_2, 
-                                num_encoder_layers=2)
+                                num_encoder_layers=getattr(model_args, "shared_layers", 2),
+                                num_attention_heads=getattr(model_args, "num_heads", 8))
 
         self.layer_norm = nn.LayerNorm(self.hidden_2)
 
 
-    def forward(self, input):
-
+    def frame_features(self, input):
+        """
+        Per-frame shared representation before temporal pooling
+        input: (T, N, D), output: (N, T, D)
+        """
         feats = self.x_shared(input)
         feats += input
         normalized_tensor = self.layer_norm(feats)
         normalized_tensor = normalized_tensor.permute(1, 0, 2) 
 
+        return normalized_tensor
+
+    def forward(self, input):
+
+        normalized_tensor = self.frame_features(input)
 
         representation_feats = nn.AdaptiveAvgPool1d(1)(normalized_tensor.permute(0, 2, 1)).squeeze(2)
 
@@ -124,8 +135,8 @@ class MLP(nn.Module):
         # Model Hyperparameters
         output_dim = model_args.output_num
         self.out_dropout = model_args.out_dropout
-        self.hidden_1 = 256
-        self.hidden_2 = 512
+        self.hidden_2 = getattr(model_args, "encoder_dim", 512)
+        self.hidden_1 = self.hidden_2 // 2
 
         # print('Out dim:', output_dim)
         self.projav1 = nn.Linear(self.hidden_2, self.hidden_2)
@@ -147,10 +158,10 @@ class MLP_reconst_v(nn.Module):
         super(MLP_reconst_v, self).__init__()
 
         # Model Hyperparameters
-        self.a_dim, self.v_dim = 1024, 1408
+        self.a_dim, self.v_dim = getattr(model_args, "a_dim", 1024), 1408
         self.out_dropout = model_args.out_dropout
-        self.hidden_1 = 256
-        self.hidden_2 = 512
+        self.hidden_2 = getattr(model_args, "encoder_dim", 512)
+        self.hidden_1 = self.hidden_2 // 2
 
 
         self.projav1 = nn.Linear(self.hidden_2, self.hidden_2)
@@ -173,10 +184,10 @@ class MLP_reconst_a(nn.Module):
         super(MLP_reconst_a, self).__init__()
 
         # Model Hyperparameters
-        self.a_dim, self.v_dim = 1024, 1408
+        self.a_dim, self.v_dim = getattr(model_args, "a_dim", 1024), 1408
         self.out_dropout = model_args.out_dropout
-        self.hidden_1 = 256
-        self.hidden_2 = 512
+        self.hidden_2 = getattr(model_args, "encoder_dim", 512)
+        self.hidden_1 = self.hidden_2 // 2
 
 
         self.projav1 = nn.Linear(self.hidden_2, self.hidden_2)
@@ -1,7 +1,7 @@
 import os
 import sys
 from . import avmodel
-from transformers import Wav2Vec2Model
+from .audio_encoder import get_audio_encoder
 import torch
 from torch import nn
 import torch.optim as optim
@@ -10,6 +10,10 @@ from torch.cuda.amp import GradScaler, autocast
 sys.path.append(os.getcwd())
 import utils
 
+def save_state_dicts(head_states):
+    for state_dict, path in head_states:
+        utils.atomic_torch_save(state_dict, path)
+
 class ModelWrapper():
     def __init__(self, args, **kwargs):
         self.args = args
@@ -22,6 +26,9 @@ class ModelWrapper():
         self.lbl_learning  = args.label_learning
         self.lr = args.lr
         self.model_path = args.model_path
+        # Disabled unless train.py installs an enabled one (--profile_path)
+        self.profiler = utils.StepProfiler()
+        self.audio_encoder_use_mask = True
 
 
         return
@@ -30,39 +37,21 @@ class ModelWrapper():
     def init_model(self):
         """
         Define model and load pretrained weights
+        The audio encoder is chosen by model_type (see net/audio_encoder.py);
+        its output dimension is passed to the heads as args.a_dim.
         """
-        assert self.model_type in [
-            "wav2vec2-large", "wav2vec2-large-robust"], \
-            print("Wrong model type")
-        
-        default_models={
-            "wav2vec2": "wav2vec2-large-robust",
-        }
-        real_model_name = default_models.get(self.model_type, self.model_type)
-        assert real_model_name not in ["wav2vec2"], \
-            print("Model name is not properly converted.\n \
-                Current model_name:", real_model_name
-            )
-        
-        root_model_type = real_model_name.split("-")[0]
-        assert root_model_type in ["wav2vec2"], \
-            print("Can't specify the root model type\n \
-                Current root_model_type:", root_model_type
-            )
-
-        #### Wav2vec2
-        if root_model_type == "wav2vec2":
-            """
-            Additional settings
-            - Freeze feature encoder (for all wav2vec2 models)
-            - Prune top 12 transformer layers (for wav2vec2-large-robust)
-            """
-            self.wav2vec_model= Wav2Vec2Model.from_pretrained("facebook/"+real_model_name)
-            self.wav2vec_model.freeze_feature_encoder()
-            if real_model_name == "wav2vec2-large-robust":
-                del self.wav2vec_model.encoder.layers[12:]
- 
+        spec = get_audio_encoder(self.model_type)
+        # Kept under the wav2vec_model name for checkpoint compatibility, whatever the encoder
+        self.wav2vec_model = spec.build()
+        self.audio_encoder_use_mask = spec.use_mask
+        self.args.a_dim = spec.dim
+
+        self.init_heads()
 
+    def init_heads(self):
+        """
+        Define the trainable heads on top of an already set self.wav2vec_model
+        """
         self.acoustic_model = avmodel.Acoustic(self.args)
         self.visual_model = avmodel.Visual(self.args)
         self.shared_model = avmodel.Shared(self.args)
@@ -76,7 +65,7 @@ class ModelWrapper():
         self.MLP_rec_a = avmodel.MLP_reconst_a(self.args)
         self.MLP_rec_v = avmodel.MLP_reconst_v(self.args)
 
-        self.wav2vec_model.to("cuda:0")
+        self.wav2vec_model.to(self.device)
 
         self.acoustic_model.to(self.device)
         self.visual_model.to(self.device)
@@ -126,8 +115,10 @@ class ModelWrapper():
 
             if mode == 'acoustic':  
                 # print(0)
-                x_in = self.wav2vec_model(x_aud, attention_mask=mask).last_hidden_state
-                representation_aud = self.acoustic_model(x_in)
+                with self.profiler.phase("wav2vec"):
+                    x_in = self.encode_audio(x_aud, mask)
+                with self.profiler.phase("conformer"):
+                    representation_aud = self.acoustic_model(x_in)
                 rep = self.shared_model(representation_aud)
 
                 pred = self.MLP_a(rep)
@@ -138,7 +129,8 @@ class ModelWrapper():
 
             elif mode == 'visual':
                 # print(1)
-                representation_vid = self.visual_model(x_vid)
+                with self.profiler.phase("conformer"):
+                    representation_vid = self.visual_model(x_vid)
                 rep = self.shared_model(representation_vid)
 
                 pred = self.MLP_v(rep)
@@ -146,25 +138,30 @@ class ModelWrapper():
 
                 return pred, torch.mean(x_vid, dim=1), rec_pred
 
-            elif mode == 'weights':
+            elif mode in ['weights', 'embeddings']:
                 self.acoustic_model.eval()
                 self.visual_model.eval()
                 self.MLP_a.eval()
                 self.MLP_v.eval()
                 self.shared_model.eval()
-                x_in = self.wav2vec_model(x_aud, attention_mask=mask).last_hidden_state
-                representation_aud = self.acoustic_model(x_in)
+                with self.profiler.phase("wav2vec"):
+                    x_in = self.encode_audio(x_aud, mask)
+                with self.profiler.phase("conformer_a"):
+                    representation_aud = self.acoustic_model(x_in)
                 rep_a = self.shared_model(representation_aud)
 
                 pred_a = self.MLP_a(rep_a)
 
-                representation_vid = self.visual_model(x_vid)
+                with self.profiler.phase("conformer_v"):
+                    representation_vid = self.visual_model(x_vid)
                 rep_v = self.shared_model(representation_vid)
 
                 pred_v = self.MLP_v(rep_v)
 
                 pred = self.weights(rep_a, rep_v)  # Shape: [batch_size, num_tasks]
 
+                if mode == 'embeddings':
+                    return rep_a, rep_v, pred_a, pred_v, pred
                 return pred_a, pred_v, pred
         
         if eval:
@@ -173,64 +170,152 @@ class ModelWrapper():
         else:
             return __inference__(self, xa, xv, **kwargs)
     
-    def backprop(self, total_loss, mode):
+    def encode_audio(self, x_aud, mask=None):
         """
-        Update the model given loss
+        (B, samples) waveform -> (B, frames, a_dim) audio encoder features
         """
+        if not self.audio_encoder_use_mask:
+            mask = None
+        return self.wav2vec_model(x_aud, attention_mask=mask).last_hidden_state
 
+    def phase_models(self, mode):
+        """
+        Modules updated by each training phase
+        """
         if mode == 'acoustic':
-            self.acoustic_model_opt.zero_grad(set_to_none=True)
-            self.shared_model_opt.zero_grad(set_to_none=True)
-            self.MLP_a_opt.zero_grad(set_to_none=True)
-            self.MLP_rec_a_opt.zero_grad(set_to_none=True)
-            total_loss.backward()
-            self.acoustic_model_opt.step()
-            self.shared_model_opt.step()
-            self.MLP_a_opt.step()
-            self.MLP_rec_a_opt.step()
-
+            return [self.acoustic_model, self.shared_model, self.MLP_a, self.MLP_rec_a]
         elif mode == 'visual':
-            self.visual_model_opt.zero_grad(set_to_none=True)
-            self.shared_model_opt.zero_grad(set_to_none=True)
-            self.MLP_v_opt.zero_grad(set_to_none=True)
-            self.MLP_rec_v_opt.zero_grad(set_to_none=True)
-            total_loss.backward()
-            self.visual_model_opt.step()
-            self.shared_model_opt.step()
-            self.MLP_v_opt.step()
-            self.MLP_rec_v_opt.step()
+            return [self.visual_model, self.shared_model, self.MLP_v, self.MLP_rec_v]
+        elif mode == 'weights':
+            return [self.weights]
+
+    def head_models(self):
+        return [self.acoustic_model, self.visual_model, self.weights, self.shared_model,
+            self.MLP_a, self.MLP_av, self.MLP_v, self.MLP_rec_a, self.MLP_rec_v]
+
+    def broadcast_state(self, src=0):
+        """
+        Make every process hold the heads (parameters and buffers) of rank src
+        """
+        for model in self.head_models():
+            utils.broadcast_module(model, src=src)
+
+    def sync_grads(self, mode):
+        # Each phase updates its own modules with its own optimizers, so the
+        # gradients are averaged over processes per phase rather than through DDP hooks
+        if utils.is_distributed():
+            utils.all_reduce_grads([p for model in self.phase_models(mode) for p in model.parameters()])
 
+    def phase_optimizers(self, mode):
+        if mode == 'acoustic':
+            return [self.acoustic_model_opt, self.shared_model_opt, self.MLP_a_opt, self.MLP_rec_a_opt]
+        elif mode == 'visual':
+            return [self.visual_model_opt, self.shared_model_opt, self.MLP_v_opt, self.MLP_rec_v_opt]
         elif mode == 'weights':
-            self.weights_opt.zero_grad(set_to_none=True)
-            total_loss.backward()
-            self.weights_opt.step()
+            return [self.weights_opt]
 
-    def save_model(self, epoch):
+    def zero_grad(self, mode):
+        for opt in self.phase_optimizers(mode):
+            opt.zero_grad(set_to_none=True)
+
+    def accumulate(self, total_loss, mode):
+        """
+        Add the gradients of a (micro-batch) loss, without updating
+        """
+        total_loss.backward()
+
+    def step(self, mode):
+        self.sync_grads(mode)
+        for opt in self.phase_optimizers(mode):
+            opt.step()
+
+    def backprop(self, total_loss, mode):
+        """
+        Update the model given loss
+        """
+        self.zero_grad(mode)
+        self.accumulate(total_loss, mode)
+        self.step(mode)
+
+    def save_model(self, epoch, writer=None):
         """
         Save the model for each epoch
+        If writer (utils.AsyncWriter) is given, files are written on its background thread
         """
-        torch.save(self.acoustic_model.state_dict(), \
-            os.path.join(self.model_path, "final_acoustic_head.pt"))
-        torch.save(self.visual_model.state_dict(), \
-            os.path.join(self.model_path, "final_visual_head.pt"))
-        torch.save(self.weights.state_dict(), \
-            os.path.join(self.model_path, "final_weights_head.pt"))
-        torch.save(self.shared_model.state_dict(), \
-            os.path.join(self.model_path, "final_shared_head.pt"))
-
-        torch.save(self.MLP_a.state_dict(), \
-            os.path.join(self.model_path, "MLP_a_head.pt"))
-        torch.save(self.MLP_v.state_dict(), \
-            os.path.join(self.model_path, "MLP_v_head.pt"))
-        torch.save(self.MLP_av.state_dict(), \
-            os.path.join(self.model_path, "MLP_av_head.pt"))
-
-        torch.save(self.MLP_rec_a.state_dict(), \
-            os.path.join(self.model_path, "MLP_rec_a_head.pt"))
-        torch.save(self.MLP_rec_v.state_dict(), \
-            os.path.join(self.model_path, "MLP_rec_v_head.pt"))
+        head_files = [
+            (self.acoustic_model, "final_acoustic_head.pt"),
+            (self.visual_model, "final_visual_head.pt"),
+            (self.weights, "final_weights_head.pt"),
+            (self.shared_model, "final_shared_head.pt"),
+            (self.MLP_a, "MLP_a_head.pt"),
+            (self.MLP_v, "MLP_v_head.pt"),
+            (self.MLP_av, "MLP_av_head.pt"),
+            (self.MLP_rec_a, "MLP_rec_a_head.pt"),
+            (self.MLP_rec_v, "MLP_rec_v_head.pt"),
+        ]
+        head_states = [(model.state_dict(), os.path.join(self.model_path, fname)) for model, fname in head_files]
+        if writer is None:
+            for state_dict, path in head_states:
+                torch.save(state_dict, path)
+        else:
+            writer.submit(save_state_dicts, utils.to_cpu(head_states))
             
 
+    def get_train_state(self):
+        """
+        Trainable heads, optimizers and grad scaler for resumable checkpoints.
+        The frozen audio encoder is restored with load_model(..., 'train') instead.
+        """
+        return {
+            "models": {
+                "acoustic_model": self.acoustic_model.state_dict(),
+                "visual_model": self.visual_model.state_dict(),
+                "weights": self.weights.state_dict(),
+                "shared_model": self.shared_model.state_dict(),
+                "MLP_a": self.MLP_a.state_dict(),
+                "MLP_av": self.MLP_av.state_dict(),
+                "MLP_v": self.MLP_v.state_dict(),
+                "MLP_rec_a": self.MLP_rec_a.state_dict(),
+                "MLP_rec_v": self.MLP_rec_v.state_dict(),
+            },
+            "optimizers": {
+                "acoustic_model_opt": self.acoustic_model_opt.state_dict(),
+                "visual_model_opt": self.visual_model_opt.state_dict(),
+                "weights_opt": self.weights_opt.state_dict(),
+                "shared_model_opt": self.shared_model_opt.state_dict(),
+                "MLP_a_opt": self.MLP_a_opt.state_dict(),
+                "MLP_v_opt": self.MLP_v_opt.state_dict(),
+                "MLP_av_opt": self.MLP_av_opt.state_dict(),
+                "MLP_rec_a_opt": self.MLP_rec_a_opt.state_dict(),
+                "MLP_rec_v_opt": self.MLP_rec_v_opt.state_dict(),
+            },
+            "scaler": self.scaler.state_dict(),
+        }
+
+    def load_train_state(self, state):
+        for name, state_dict in state["models"].items():
+            getattr(self, name).load_state_dict(state_dict)
+        for name, state_dict in state["optimizers"].items():
+            getattr(self, name).load_state_dict(state_dict)
+        self.scaler.load_state_dict(state["scaler"])
+
+    def checkpoint_hash(self):
+        """
+        Content hash of all model weights, used to key cached predictions
+        """
+        return utils.state_dict_hash([
+            self.wav2vec_model.state_dict(),
+            self.acoustic_model.state_dict(),
+            self.visual_model.state_dict(),
+            self.weights.state_dict(),
+            self.shared_model.state_dict(),
+            self.MLP_a.state_dict(),
+            self.MLP_av.state_dict(),
+            self.MLP_v.state_dict(),
+            self.MLP_rec_a.state_dict(),
+            self.MLP_rec_v.state_dict(),
+        ])
+
     def set_eval(self):
         """
         Set the model to eval mode
@@ -262,18 +347,26 @@ class ModelWrapper():
 
     def load_model(self, model_path, run_type):
         if run_type == 'train':
-            self.wav2vec_model.load_state_dict(torch.load(model_path+"/final_wav2vec.pt"))
+            if len(list(self.wav2vec_model.parameters())) == 0:
+                # e.g. log-mel: nothing was fine-tuned
+                return
+            if model_path is None or not os.path.isfile(model_path+"/final_wav2vec.pt"):
+                # the encoder is frozen, its pretrained weights can be used as they are
+                print("No fine-tuned audio encoder (%s), using the pretrained %s weights"
+                    % (None if model_path is None else model_path+"/final_wav2vec.pt", self.args.model_type))
+                return
+            self.wav2vec_model.load_state_dict(torch.load(model_path+"/final_wav2vec.pt", map_location=self.device))
         else:
-            self.acoustic_model.load_state_dict(torch.load(model_path+"/final_acoustic_head.pt"))
-            self.visual_model.load_state_dict(torch.load(model_path+"/final_visual_head.pt"))
-            self.weights.load_state_dict(torch.load(model_path+"/final_weights_head.pt"))
-            self.shared_model.load_state_dict(torch.load(model_path+"/final_shared_head.pt"))
+            self.acoustic_model.load_state_dict(torch.load(model_path+"/final_acoustic_head.pt", map_location=self.device))
+            self.visual_model.load_state_dict(torch.load(model_path+"/final_visual_head.pt", map_location=self.device))
+            self.weights.load_state_dict(torch.load(model_path+"/final_weights_head.pt", map_location=self.device))
+            self.shared_model.load_state_dict(torch.load(model_path+"/final_shared_head.pt", map_location=self.device))
 
-            self.MLP_a.load_state_dict(torch.load(model_path+"/MLP_a_head.pt"))
-            self.MLP_av.load_state_dict(torch.load(model_path+"/MLP_av_head.pt"))
-            self.MLP_v.load_state_dict(torch.load(model_path+"/MLP_v_head.pt"))
+            self.MLP_a.load_state_dict(torch.load(model_path+"/MLP_a_head.pt", map_location=self.device))
+            self.MLP_av.load_state_dict(torch.load(model_path+"/MLP_av_head.pt", map_location=self.device))
+            self.MLP_v.load_state_dict(torch.load(model_path+"/MLP_v_head.pt", map_location=self.device))
 
-            self.MLP_rec_a.load_state_dict(torch.load(model_path+"MLP_rec_a_head.pt"))
-            self.MLP_rec_v.load_state_dict(torch.load(model_path+"MLP_rec_v_head.pt"))
+            self.MLP_rec_a.load_state_dict(torch.load(model_path+"/MLP_rec_a_head.pt", map_location=self.device))
+            self.MLP_rec_v.load_state_dict(torch.load(model_path+"/MLP_rec_v_head.pt", map_location=self.device))
 
 
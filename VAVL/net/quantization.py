@@ -0,0 +1,192 @@
+import io
+import inspect
+
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from conformer.embedding import PositionalEncoding
+
+
+"""
+Post-training INT8 quantization of a ModelWrapper for CPU inference.
+
+dynamic: weights of every nn.Linear are stored in int8 and activations are
+         quantized on the fly; no calibration data is needed.
+static:  FX graph mode quantization of the heads. Activation ranges are
+         observed on calibration batches, so Linear, LayerNorm and the
+         element-wise ops run in int8. Conv1d stays in fp32 unless
+         quantize_conv=True: the Conformer convolutions run over the short
+         batch axis of their (T, B, D) input, where quantized conv1d is slower
+         than fp32. Modules FX cannot trace are quantized child by child
+         instead; leaves that still cannot be traced fall back to dynamic
+         quantization.
+
+Quantized models only run on CPU.
+"""
+
+
+HEAD_NAMES = ["acoustic_model", "visual_model", "shared_model", "weights",
+    "MLP_a", "MLP_av", "MLP_v", "MLP_rec_a", "MLP_rec_v"]
+
+
+def select_engine(engine=None):
+    """
+    fbgemm on x86, qnnpack on ARM, unless given
+    """
+    supported = torch.backends.quantized.supported_engines
+    if engine is None:
+        engine = "fbgemm" if "fbgemm" in supported else "qnnpack"
+    assert engine in supported, "Quantized engine %s not supported, choose from %s" % (engine, supported)
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def model_size_mb(module):
+    buf = io.BytesIO()
+    torch.save(module.state_dict(), buf)
+    return buf.tell() / 2**20
+
+
+def quantize_dynamic_model(modelWrapper, include_encoder=False, heads=True):
+    """
+    Replace the heads (and the audio encoder if include_encoder) by dynamically quantized copies
+    """
+    names = (HEAD_NAMES if heads else []) + (["wav2vec_model"] if include_encoder else [])
+    for name in names:
+        model = getattr(modelWrapper, name).cpu().eval()
+        setattr(modelWrapper, name, quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8))
+    return modelWrapper
+
+
+def _prepare(module, example_inputs, qconfig_dict):
+    # The positional encoding is called with a traced length, keep it as an opaque call
+    custom_config = {"non_traceable_module_class": [PositionalEncoding]}
+    # prepare_fx takes example_inputs and prepare_custom_config from torch 1.13 on
+    params = inspect.signature(prepare_fx).parameters
+    kwargs = {}
+    if "example_inputs" in params:
+        kwargs["example_inputs"] = example_inputs
+    if "prepare_custom_config" in params:
+        kwargs["prepare_custom_config"] = custom_config
+    else:
+        kwargs["prepare_custom_config_dict"] = custom_config
+    return prepare_fx(module, qconfig_dict, **kwargs)
+
+
+def _has_linear(module):
+    return any(isinstance(m, nn.Linear) for m in module.modules())
+
+
+class StaticQuantizer:
+    """
+    Usage:
+        quantizer = StaticQuantizer(modelWrapper)
+        quantizer.prepare(run_fn)      # run_fn() feeds the same batch through modelWrapper on every call
+        for batch in calibration_batches:
+            quantizer.calibrate(lambda: ...feed forward...)
+        quantizer.convert()
+    """
+    def __init__(self, modelWrapper, engine=None, quantize_conv=False):
+        self.modelWrapper = modelWrapper
+        self.qconfig_dict = {"": get_default_qconfig(select_engine(engine))}
+        if not quantize_conv:
+            self.qconfig_dict["object_type"] = [(nn.Conv1d, None)]
+        self.prepared = []      # (parent module, attribute name, qualified name)
+        self.fallback = []      # qualified names quantized dynamically
+        self.skipped = []       # qualified names left in fp32 (never called)
+        self.num_batches = 0    # calibration batches seen by the observers
+
+    def _record_inputs(self, run_fn):
+        """
+        Positional inputs of the first call of every head submodule, as FX example inputs
+        """
+        inputs, hooks = {}, []
+        for head_name in HEAD_NAMES:
+            for name, module in getattr(self.modelWrapper, head_name).named_modules(prefix=head_name):
+                def hook(module, args, name=name):
+                    inputs.setdefault(name, args)
+                hooks.append(module.register_forward_pre_hook(hook))
+        with torch.no_grad():
+            run_fn()
+        for handle in hooks:
+            handle.remove()
+        return inputs
+
+    def _prepare_module(self, parent, attr, name, inputs):
+        module = getattr(parent, attr)
+        # Optional arguments (e.g. mask=None) would be traced as tensors, so
+        # only modules called with all of their arguments are traced as a whole
+        if name in inputs and len(inputs[name]) == len(inspect.signature(module.forward).parameters):
+            try:
+                setattr(parent, attr, _prepare(module, inputs[name], self.qconfig_dict))
+                self.prepared.append((parent, attr, name))
+                return
+            except Exception:
+                pass
+        children = list(module.named_children())
+        if len(children) != 0:
+            for child_attr, _ in children:
+                self._prepare_module(module, child_attr, name + "." + child_attr, inputs)
+        elif name not in inputs:
+            if len(list(module.parameters())) != 0:
+                self.skipped.append(name)
+        elif _has_linear(module):
+            setattr(parent, attr, quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8))
+            self.fallback.append(name)
+
+    def prepare(self, run_fn):
+        """
+        Insert observers into the heads; run_fn() must feed one (calibration) batch through the model.
+        It is called twice: once to record the example inputs, once more to observe the batch.
+        """
+        for head_name in HEAD_NAMES:
+            getattr(self.modelWrapper, head_name).cpu().eval()
+        inputs = self._record_inputs(run_fn)
+        for head_name in HEAD_NAMES:
+            self._prepare_module(self.modelWrapper, head_name, head_name, inputs)
+        # the recorded batch went through the model before the observers existed
+        self.calibrate(run_fn)
+        return self
+
+    def calibrate(self, run_fn):
+        """
+        Observe the activation ranges of one batch; run_fn() feeds it through the prepared model
+        """
+        with torch.no_grad():
+            run_fn()
+        self.num_batches += 1
+
+    def convert(self):
+        if self.num_batches == 0:
+            raise RuntimeError("No calibration batch was observed, call prepare() and calibrate() before convert()")
+        for parent, attr, name in self.prepared:
+            setattr(parent, attr, convert_fx(getattr(parent, attr)))
+        return self.modelWrapper
+
+    def summary(self):
+        return {
+            "calibration_batches": self.num_batches,
+            "static": [name for _, _, name in self.prepared],
+            "dynamic_fallback": self.fallback,
+            "fp32": self.skipped,
+        }
+
+
+def save_quantized(modelWrapper, path, include_encoder=False):
+    """
+    Quantized modules (including FX GraphModules) are pickled whole, since
+    their state dicts do not fit the fp32 module definitions
+    """
+    names = HEAD_NAMES + (["wav2vec_model"] if include_encoder else [])
+    torch.save({name: getattr(modelWrapper, name) for name in names}, path)
+
+
+def load_quantized(modelWrapper, path):
+    """
+    Replace the modules of an initialised (fp32) ModelWrapper by the ones saved with save_quantized
+    """
+    for name, module in torch.load(path, map_location='cpu').items():
+        setattr(modelWrapper, name, module)
+    modelWrapper.device = 'cpu'
+    return modelWrapper
@@ -0,0 +1,148 @@
+import math
+from collections import deque
+
+import numpy as np
+import torch
+
+
+class StreamingPredictor():
+    """
+    Windowed emotion inference over long recordings.
+
+    Audio is consumed hop by hop. Each hop is fed to the audio encoder together
+    with a cached left context of raw samples, and the encoder frames belonging
+    to the context are dropped again. The acoustic, visual and shared Conformers
+    receive (T, N, D) inputs with N=1 here, so they do not mix information across
+    frames and need no cache of their own. Pooled shared features are kept as
+    per-hop sums, so memory is bounded by the window length regardless of the
+    recording length.
+    """
+    def __init__(self, modelWrapper, norm_stat=None, window_sec=12.0, hop_sec=1.0,
+                 left_context_sec=2.0, vid_fps=1.0, sr=16000):
+        self.modelWrapper = modelWrapper
+        self.device = modelWrapper.device
+        self.sr = sr
+        # wav2vec2 feature encoder stride (20 ms at 16 kHz)
+        self.frame_shift = 320
+
+        self.hop = max(1, int(round(hop_sec * sr / self.frame_shift))) * self.frame_shift
+        self.left_context = int(round(left_context_sec * sr / self.frame_shift)) * self.frame_shift
+        self.num_hops = max(1, int(round(window_sec / hop_sec)))
+        self.vid_fps = vid_fps
+
+        if norm_stat is None:
+            norm_stat = (0.0, 1.0, 0.0, 1.0)
+        self.wav_mean, self.wav_std, self.vid_mean, self.vid_std = norm_stat
+
+    def _iter_hops(self, wav_blocks):
+        pending = []
+        pending_len = 0
+        for block in wav_blocks:
+            pending.append(np.asarray(block, dtype=np.float32))
+            pending_len += len(block)
+            if pending_len < self.hop:
+                continue
+            buf = np.concatenate(pending)
+            num_full = len(buf) // self.hop
+            for hi in range(num_full):
+                yield buf[hi*self.hop:(hi+1)*self.hop]
+            rest = buf[num_full*self.hop:]
+            pending = [rest]
+            pending_len = len(rest)
+        if pending_len > 0:
+            yield np.concatenate(pending)
+
+    def _encode_audio(self, chunk, num_context):
+        x = (chunk - self.wav_mean) / (self.wav_std+0.000001)
+        x = torch.from_numpy(x).float().to(self.device).unsqueeze(0)
+        x_in = self.modelWrapper.encode_audio(x)
+        x_in = x_in[:, num_context // self.frame_shift:]
+        if x_in.size(1) == 0:
+            return None
+        representation_aud = self.modelWrapper.acoustic_model(x_in)
+        return self.modelWrapper.shared_model.frame_features(representation_aud)[0]
+
+    def _encode_visual(self, frames):
+        x = (frames - self.vid_mean) / (self.vid_std+0.000001)
+        x = torch.from_numpy(np.asarray(x)).float().to(self.device).unsqueeze(0)
+        representation_vid = self.modelWrapper.visual_model(x)
+        return self.modelWrapper.shared_model.frame_features(representation_vid)[0]
+
+    def predict(self, wav_blocks, vid, frame_index=None):
+        """
+        wav_blocks: iterable of 1-D sample arrays (16 kHz, mono), any block size
+        vid: (frames, D) visual features sampled at vid_fps, may be a memmap
+        frame_index: (rows,) frame of every row of vid (face features have one row per detected face),
+                     by default every row is one frame
+        yields one dict per hop with the window bounds in seconds and the
+        acoustic, visual and fused predictions for that window
+        """
+        self.modelWrapper.set_eval()
+        vid_dim = np.shape(vid)[1]
+        window = deque(maxlen=self.num_hops)
+        context = np.zeros(0, dtype=np.float32)
+        hop_start = 0
+
+        with torch.no_grad():
+            for samples in self._iter_hops(wav_blocks):
+                hop_end = hop_start + len(samples)
+                chunk = np.concatenate([context, samples])
+
+                feats_a = self._encode_audio(chunk, len(context))
+
+                v_start = int(math.ceil(hop_start / self.sr * self.vid_fps))
+                v_end = int(math.ceil(hop_end / self.sr * self.vid_fps))
+                if frame_index is not None:
+                    # rows of the frames of the hop
+                    v_start, v_end = np.searchsorted(frame_index, [v_start, v_end], side='left')
+                v_end = min(v_end, len(vid))
+                feats_v = None
+                if v_end > v_start:
+                    feats_v = self._encode_visual(vid[v_start:v_end])
+
+                window.append((
+                    hop_start,
+                    None if feats_a is None else feats_a.sum(0), 0 if feats_a is None else feats_a.size(0),
+                    None if feats_v is None else feats_v.sum(0), 0 if feats_v is None else feats_v.size(0),
+                ))
+                context = chunk[max(0, len(chunk)-self.left_context):] if self.left_context > 0 \
+                    else np.zeros(0, dtype=np.float32)
+                hop_start = hop_end
+
+                a_sums = [w[1] for w in window if w[1] is not None]
+                if len(a_sums) == 0:
+                    continue
+                rep_a = torch.stack(a_sums).sum(0) / sum(w[2] for w in window)
+
+                v_sums = [w[3] for w in window if w[3] is not None]
+                if len(v_sums) != 0:
+                    rep_v = torch.stack(v_sums).sum(0) / sum(w[4] for w in window)
+                else:
+                    # No face frames in this window: behave like a zero-padded video
+                    rep_v = self._encode_visual(np.zeros((1, vid_dim), dtype=np.float32) + self.vid_mean).mean(0)
+
+                rep_a = rep_a.unsqueeze(0)
+                rep_v = rep_v.unsqueeze(0)
+                pred_a = self.modelWrapper.MLP_a(rep_a)
+                pred_v = self.modelWrapper.MLP_v(rep_v)
+                pred = self.modelWrapper.weights(rep_a, rep_v)
+
+                yield {
+                    "start": window[0][0] / self.sr,
+                    "end": hop_end / self.sr,
+                    "pred_a": pred_a[0].cpu().numpy(),
+                    "pred_v": pred_v[0].cpu().numpy(),
+                    "pred": pred[0].cpu().numpy(),
+                }
+
+
+def iter_wav_blocks(wav_path, block_sec=10.0, sr=16000):
+    """
+    Read a 16 kHz mono wav file block by block
+    """
+    import soundfile as sf
+    block_size = int(block_sec * sr)
+    for block in sf.blocks(wav_path, blocksize=block_size, dtype='float32', always_2d=False):
+        if block.ndim > 1:
+            block = block.mean(axis=1)
+        yield block
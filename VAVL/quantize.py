@@ -0,0 +1,293 @@
+# -*- coding: UTF-8 -*-
+# Local modules
+import os
+import sys
+import copy
+import json
+import argparse
+# 3rd-Party Modules
+import numpy as np
+
+# PyTorch Modules
+import torch
+from torch.utils.data import DataLoader, Subset
+# Self-Written Modules
+sys.path.append(os.getcwd())
+import utils
+import net
+from net import quantization
+from train import evaluate_test
+from distill import measure_inference
+
+
+"""
+Post-training INT8 quantization of a trained model for CPU inference (see
+net/quantization.py). Each mode is compared with the fp32 model on the dev
+split: metrics and their delta, agreement of the predictions, serialized size
+and CPU latency. The comparison is written to
+<model_path>/quantization_report.json. With --save, the quantized heads are
+written to <model_path>/quantized_<mode>.pt. net.quantization.load_quantized() loads them
+into a ModelWrapper.
+
+Example:
+    python quantize.py --model_path model/CREMA-D_ALL_primary/AuxFormer/partition1 --modes dynamic,static \\
+        --corpus CREMA-D --num_classes ALL --label_rule M --partition_number 1 --corpus_type CREMA-D_ALL_primary ...
+"""
+
+
+def dev_metrics(out, args):
+    pred, y = out["audiovisual"].float(), out["y"].float()
+    if args.label_type == "categorical":
+        result = utils.classification_metrics(pred, y)
+        return {metric: result[metric].item() for metric in ["wa", "ua", "f1_macro"]}
+    ccc = utils.CCC_loss(pred, y)
+    return {"ccc_aro": ccc[0].item(), "ccc_dom": ccc[1].item(), "ccc_val": ccc[2].item()}
+
+
+def agreement(out, ref_out, args):
+    pred, ref = out["audiovisual"].float(), ref_out["audiovisual"].float()
+    if args.label_type == "categorical":
+        return {"agreement": (pred.argmax(1) == ref.argmax(1)).float().mean().item()}
+    return {"mean_abs_diff": (pred - ref).abs().mean().item()}
+
+
+def evaluate(modelWrapper, loader, args):
+    lm = utils.LogManager()
+    lm.alloc_stat_type_list(["test_loss", "test_acc", "test_aro", "test_dom", "test_val",
+        "test_aro_a", "test_dom_a", "test_val_a", "test_aro_v", "test_dom_v", "test_val_v"])
+    modelWrapper.set_eval()
+    return evaluate_test(modelWrapper, loader, args, lm)
+
+
+def size_mb(modelWrapper, include_encoder):
+    models = [getattr(modelWrapper, name) for name in quantization.HEAD_NAMES]
+    if include_encoder:
+        models.append(modelWrapper.wav2vec_model)
+    return round(sum(quantization.model_size_mb(model) for model in models), 2)
+
+
+def main(args):
+    utils.print_config_description(args.conf_path)
+    config_dict = utils.load_env(args.conf_path)
+    assert config_dict.get("config_root", None) != None, "No config_root in config/conf.json"
+    config_path = os.path.join(config_dict["config_root"], config_dict[args.corpus_type])
+    utils.print_config_description(config_path)
+
+    # Quantized kernels are CPU only
+    args.device = 'cpu'
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    utils.set_deterministic(args.seed)
+    model_path = args.model_path
+
+    DataManager=utils.DataManager(config_path)
+    lab_type = args.label_type
+
+    audio_path, video_path, label_path = utils.load_audio_and_label_file_paths(args)
+    fnames_aud, fnames_vid = utils.get_matched_fnames(audio_path, video_path)
+    wav_mean, wav_std, vid_mean, vid_std = utils.load_norm_stat(os.path.join(model_path, "train_norm_stat.pkl"))
+
+    total_set = {}
+    for split_type in ["train", "dev"]:
+        wavs, vids, labs, utts = DataManager.get_split_data(split_type,
+            audio_path, video_path, label_path, fnames_aud, fnames_vid, lab_type)
+        total_set[split_type] = utils.AudVidSet(wavs, vids, labs, utts,
+            print_dur=True, lab_type=lab_type, print_utt=True,
+            wav_mean = wav_mean, wav_std = wav_std,
+            vid_mean = vid_mean, vid_std = vid_std,
+            label_config = DataManager.get_label_config(lab_type),
+            vid_fps = DataManager.get_vid_fps(utts),
+            vid_frame_index = DataManager.get_vid_frame_index(utts)
+        )
+    dev_loader = DataLoader(total_set["dev"], batch_size=args.batch_size, collate_fn=utils.collate_fn_padd, shuffle=False)
+    # Calibration utterances are drawn from the train split, never from dev
+    calib_idx = np.random.RandomState(args.seed).permutation(len(total_set["train"]))[:args.calib_utts]
+    calib_loader = DataLoader(Subset(total_set["train"], calib_idx.tolist()), batch_size=args.batch_size,
+        collate_fn=utils.collate_fn_padd, shuffle=False)
+
+    utils.load_model_config(model_path, args)
+    modelWrapper = net.ModelWrapper(args)
+    modelWrapper.init_model()
+    modelWrapper.load_model(args.wav2vec_path, 'train')
+    modelWrapper.load_model(model_path, 'test')
+    modelWrapper.set_eval()
+
+    def feed(wrapper, xy_pair):
+        xa = xy_pair[0].float()
+        xv = xy_pair[1].float()
+        mask = xy_pair[3].float()
+        return wrapper.feed_forward(xa, xv, mode='weights', attention_mask=mask, eval=True)
+
+    print("Evaluating fp32 model")
+    ref_out = evaluate(modelWrapper, dev_loader, args)
+    report = {"engine": quantization.select_engine(args.engine), "threads": torch.get_num_threads(),
+        "quantize_encoder": args.quantize_encoder, "calib_utts": len(calib_idx)}
+    report["fp32"] = dev_metrics(ref_out, args)
+    report["fp32"]["size_mb"] = size_mb(modelWrapper, args.quantize_encoder)
+    report["fp32"].update(measure_inference(modelWrapper, dev_loader, args, args.latency_batches))
+
+    for mode in args.modes.split(","):
+        print("Quantizing:", mode)
+        qWrapper = copy.deepcopy(modelWrapper)
+        if mode == "dynamic":
+            quantization.quantize_dynamic_model(qWrapper, include_encoder=args.quantize_encoder)
+            summary = {}
+        elif mode == "static":
+            quantizer = quantization.StaticQuantizer(qWrapper, engine=args.engine, quantize_conv=args.quantize_conv)
+            calib_batches = iter(calib_loader)
+            first_batch = next(calib_batches, None)
+            if first_batch is None:
+                raise ValueError("No calibration utterances, check --calib_utts and the train split")
+            quantizer.prepare(lambda: feed(qWrapper, first_batch))
+            for xy_pair in calib_batches:
+                quantizer.calibrate(lambda: feed(qWrapper, xy_pair))
+            quantizer.convert()
+            if args.quantize_encoder:
+                quantization.quantize_dynamic_model(qWrapper, include_encoder=True, heads=False)
+            summary = quantizer.summary()
+        else:
+            raise ValueError("Unknown quantization mode " + mode)
+
+        out = evaluate(qWrapper, dev_loader, args)
+        result = dev_metrics(out, args)
+        result.update({"delta_" + key: value - report["fp32"][key] for key, value in list(result.items())})
+        result.update(agreement(out, ref_out, args))
+        result["size_mb"] = size_mb(qWrapper, args.quantize_encoder)
+        result.update(measure_inference(qWrapper, dev_loader, args, args.latency_batches))
+        result["speedup"] = round(report["fp32"]["ms_per_batch"] / result["ms_per_batch"], 3) \
+            if result["ms_per_batch"] else None
+        result["modules"] = summary
+        report[mode] = result
+        if args.save:
+            quantization.save_quantized(qWrapper, os.path.join(model_path, "quantized_%s.pt" % mode),
+                include_encoder=args.quantize_encoder)
+        del qWrapper
+
+    report_path = os.path.join(model_path, "quantization_report.json")
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    keys = [key for key, value in report["fp32"].items() if isinstance(value, (int, float))]
+    modes = ["fp32"] + args.modes.split(",")
+    print(("%-16s" + " %12s" * len(modes)) % tuple([""] + modes))
+    for key in keys:
+        print(("%-16s" + " %12.4f" * len(modes)) % tuple([key] + [report[mode][key] for mode in modes]))
+    print("Report saved to", report_path)
+
+
+if __name__ == "__main__":
+    # Inputs for the main function
+    parser = argparse.ArgumentParser()
+
+    # Experiment Arguments
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int)
+    parser.add_argument(
+        '--conf_path',
+        default="config/conf.json",
+        type=str)
+
+    # Data Arguments
+    parser.add_argument(
+        '--corpus_type',
+        default="podcast_v1.7",
+        type=str)
+    parser.add_argument(
+        '--model_type',
+        default="wav2vec2",
+        type=str)
+    parser.add_argument(
+        '--label_type',
+        choices=['dimensional', 'categorical'],
+        default='categorical',
+        type=str)
+
+    # Model Arguments
+    parser.add_argument(
+        '--model_path',
+        default=None,
+        type=str)
+    parser.add_argument(
+        '--wav2vec_path', type=str, default=None,
+        help='directory of a fine-tuned final_wav2vec.pt for the audio encoder (default: pretrained weights)')
+    parser.add_argument(
+        '--output_num',
+        default=4,
+        type=int)
+    parser.add_argument(
+        '--batch_size',
+        default=32,
+        type=int)
+    parser.add_argument(
+        '--hidden_dim',
+        default=256,
+        type=int)
+    parser.add_argument(
+        '--num_layers',
+        default=3,
+        type=int)
+    parser.add_argument(
+        '--lr',
+        default=1e-5,
+        type=float)
+    parser.add_argument(
+        '--out_dropout', type=float, default=0.2,
+        help='output layer dropout (default: 0.2')
+
+    # Quantization Arguments
+    parser.add_argument(
+        '--modes', type=str, default="dynamic,static",
+        help='comma separated quantization modes (dynamic, static)')
+    parser.add_argument(
+        '--calib_utts', type=int, default=256,
+        help='train utterances used to calibrate static quantization (default: 256)')
+    parser.add_argument(
+        '--quantize_encoder', action='store_true',
+        help='also quantize the Linear layers of the audio encoder (dynamically)')
+    parser.add_argument(
+        '--quantize_conv', action='store_true',
+        help='also quantize the Conv1d layers in static mode')
+    parser.add_argument(
+        '--engine', type=str, default=None,
+        help='quantized engine, fbgemm (x86) or qnnpack (ARM) (default: fbgemm if available)')
+    parser.add_argument(
+        '--threads', type=int, default=None,
+        help='torch intra-op threads (default: torch default)')
+    parser.add_argument(
+        '--latency_batches', type=int, default=20,
+        help='dev batches timed for the latency report (default: 20)')
+    parser.add_argument(
+        '--save', action='store_true',
+        help='save the quantized heads to <model_path>/quantized_<mode>.pt')
+
+     # Label Learning Arguments
+    parser.add_argument(
+        '--label_learning',
+        default="hard-label",
+        type=str)
+    parser.add_argument(
+        '--corpus',
+        default="USC-IEMOCAP",
+        type=str)
+    parser.add_argument(
+        '--num_classes',
+        default="four",
+        type=str)
+    parser.add_argument(
+        '--label_rule',
+        default="M",
+        type=str)
+    parser.add_argument(
+        '--partition_number',
+        default="1",
+        type=str)
+    parser.add_argument(
+        '--data_mode',
+        default="primary",
+        type=str)
+
+    args = parser.parse_args()
+
+    # Call main function
+    main(args)
@@ -0,0 +1,205 @@
+# -*- coding: UTF-8 -*-
+# Local modules
+import os
+import sys
+import json
+import queue
+import argparse
+import threading
+import subprocess
+# 3rd-Party Modules
+import pandas as pd
+
+# Self-Written Modules
+sys.path.append(os.getcwd())
+import utils
+
+
+"""
+Runs the partition x seed grid of train.py jobs over the given devices.
+
+The corpus is decoded once into a CorpusCache that every job memory-maps
+read-only, and jobs of the same partition share its train normalisation
+statistics. Each job writes <model_root>/partition<p>/seed_<s>/results.json;
+these are aggregated into one summary table at the end. Jobs that already have
+a results.json are skipped, so an interrupted grid can simply be restarted.
+
+Example:
+    python -u run_experiments.py --partitions 1,2,3,4,5 --seeds 0,1,2 --devices cuda:0,cuda:1 \\
+        --corpus CREMA-D --num_classes ALL --label_rule M --data_mode primary \\
+        --model_root model/CREMA-D_ALL_primary/AuxFormer \\
+        -- --corpus_type CREMA-D_ALL_primary --model_type wav2vec2-large-robust --output_num 6 ...
+"""
+
+
+def job_model_path(model_root, partition, seed):
+    return os.path.join(model_root, "partition%s" % partition, "seed_%d" % seed)
+
+
+def device_slots(devices, jobs_per_device):
+    """
+    (device argument of train.py, environment) per concurrent job
+    """
+    device_list = devices.split(",")
+    num_slots = len(device_list) * jobs_per_device
+    slots = []
+    for device in device_list:
+        for _ in range(jobs_per_device):
+            env = dict(os.environ)
+            if device.startswith("cuda"):
+                env["CUDA_VISIBLE_DEVICES"] = device.split(":")[1] if ":" in device else "0"
+                slots.append(("cuda", env))
+            else:
+                env["OMP_NUM_THREADS"] = str(max(1, os.cpu_count() // num_slots))
+                slots.append(("cpu", env))
+    return slots
+
+
+def run_worker(jobs, device, env, train_args, failed):
+    while True:
+        try:
+            partition, seed, model_path = jobs.get_nowait()
+        except queue.Empty:
+            return
+        os.makedirs(model_path, exist_ok=True)
+        cmd = [sys.executable, "-u", "train.py",
+            "--device", device,
+            "--partition_number", str(partition),
+            "--seed", str(seed),
+            "--model_path", model_path] + train_args
+        print("Start partition", partition, "seed", seed, "on", device, env.get("CUDA_VISIBLE_DEVICES", ""))
+        with open(os.path.join(model_path, "train.log"), 'w') as log_f:
+            returncode = subprocess.call(cmd, stdout=log_f, stderr=subprocess.STDOUT, env=env)
+        if returncode != 0:
+            failed.append((partition, seed))
+            print("Failed partition", partition, "seed", seed, "- see", os.path.join(model_path, "train.log"))
+        else:
+            print("Done partition", partition, "seed", seed)
+
+
+def summarize(model_root, partitions, seeds):
+    rows = []
+    for partition in partitions:
+        for seed in seeds:
+            result_path = os.path.join(job_model_path(model_root, partition, seed), "results.json")
+            if not os.path.isfile(result_path):
+                continue
+            with open(result_path, 'r') as f:
+                result = json.load(f)
+            row = {"partition": partition, "seed": seed}
+            row.update(result["best"])
+            rows.append(row)
+    if len(rows) == 0:
+        return None, None
+    result_df = pd.DataFrame(rows)
+    metric_cols = [col for col in result_df.columns if col not in ["partition", "seed"]]
+    summary_df = result_df.groupby("partition")[metric_cols].mean()
+    summary_df.loc["mean"] = result_df[metric_cols].mean()
+    summary_df.loc["std"] = result_df[metric_cols].std(ddof=0)
+    return result_df, summary_df
+
+
+def main(args, train_args):
+    partitions = args.partitions.split(",")
+    seeds = [int(seed) for seed in args.seeds.split(",")]
+
+    # Decode the corpus once, before any job starts
+    corpus_cache = args.corpus_cache or os.path.join("corpus_cache", args.corpus)
+    if not utils.CorpusCache.exists(corpus_cache):
+        args.partition_number = partitions[0]
+        audio_path, video_path, _ = utils.load_audio_and_label_file_paths(args)
+        fnames_aud, fnames_vid = utils.get_matched_fnames(audio_path, video_path)
+        utils.CorpusCache.build(corpus_cache, audio_path, video_path, fnames_aud, fnames_vid)
+
+    train_args = train_args + [
+        "--corpus", args.corpus,
+        "--num_classes", args.num_classes,
+        "--label_rule", args.label_rule,
+        "--data_mode", args.data_mode,
+        "--corpus_cache", corpus_cache]
+
+    # Seed-major order, so the jobs of one partition (which share normalisation statistics) are spread out
+    jobs = queue.Queue()
+    for seed in seeds:
+        for partition in partitions:
+            model_path = job_model_path(args.model_root, partition, seed)
+            if not args.rerun and os.path.isfile(os.path.join(model_path, "results.json")):
+                print("Skip partition", partition, "seed", seed, "(results.json exists)")
+                continue
+            jobs.put((partition, seed, model_path))
+
+    failed = []
+    workers = [threading.Thread(target=run_worker, args=(jobs, device, env, train_args, failed))
+        for device, env in device_slots(args.devices, args.jobs_per_device)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    result_df, summary_df = summarize(args.model_root, partitions, seeds)
+    if summary_df is None:
+        print("No results found")
+        return
+    print(summary_df.to_string(float_format=lambda x: "%.4f" % x))
+    summary_path = args.summary_path or os.path.join(args.model_root, "summary.csv")
+    result_df.to_csv(summary_path.replace(".csv", "_runs.csv"), index=False)
+    summary_df.to_csv(summary_path)
+    print("Summary saved to", summary_path)
+    if len(failed) != 0:
+        print("Failed jobs (partition, seed):", failed)
+
+
+if __name__ == "__main__":
+    # Inputs for the main function
+    parser = argparse.ArgumentParser(
+        description="Arguments after '--' (or any unknown argument) are passed to train.py")
+
+    # Grid Arguments
+    parser.add_argument(
+        '--partitions', type=str, default="1,2,3,4,5",
+        help='comma separated partition numbers')
+    parser.add_argument(
+        '--seeds', type=str, default="0",
+        help='comma separated seeds')
+    parser.add_argument(
+        '--devices', type=str, default="cuda:0",
+        help='comma separated devices (cuda:<idx> or cpu)')
+    parser.add_argument(
+        '--jobs_per_device', type=int, default=1,
+        help='concurrent jobs on each device')
+    parser.add_argument(
+        '--model_root', type=str, required=True,
+        help='runs are saved to <model_root>/partition<p>/seed_<s>')
+    parser.add_argument(
+        '--corpus_cache', type=str, default=None,
+        help='decoded corpus shared by all jobs (default: corpus_cache/<corpus>)')
+    parser.add_argument(
+        '--summary_path', type=str, default=None,
+        help='summary table (default: <model_root>/summary.csv)')
+    parser.add_argument(
+        '--rerun', action='store_true',
+        help='run jobs even if their results.json exists')
+
+    # Data Arguments
+    parser.add_argument(
+        '--corpus',
+        default="CREMA-D",
+        type=str)
+    parser.add_argument(
+        '--num_classes',
+        default="ALL",
+        type=str)
+    parser.add_argument(
+        '--label_rule',
+        default="M",
+        type=str)
+    parser.add_argument(
+        '--data_mode',
+        default="primary",
+        type=str)
+
+    args, train_args = parser.parse_known_args()
+    train_args = [arg for arg in train_args if arg != "--"]
+
+    # Call main function
+    main(args, train_args)
@@ -20,6 +20,7 @@ corpus_type=${corpus}_${num_classes}_${data_mode}
 python -u train.py \
 --device            cuda \
 --model_type        $audio_model_type \
+--wav2vec_path      wav2vec \
 --lr                .05e-3 \
 --corpus_type       $corpus_type \
 --seed              $seed \
@@ -41,6 +42,7 @@ python -u train.py \
 # python -u test.py \
 # --device            cuda \
 # --model_type        $audio_model_type \
+# --wav2vec_path      wav2vec \
 # --corpus_type       $corpus_type \
 # --seed              $seed \
 # --batch_size        1 \
@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+# Local modules
+import os
+import sys
+import csv
+import argparse
+# 3rd-Party Modules
+import numpy as np
+
+# Self-Written Modules
+sys.path.append(os.getcwd())
+import utils
+import net
+
+
+def main(args):
+    # Heads of a non-default size (e.g. distill.py students) are described by model_config.json
+    utils.load_model_config(args.model_path, args)
+    # frame rate and frame of every row recorded by facial_features/face_extractor.py
+    vid_meta = utils.load_vid_meta(os.path.splitext(args.vid)[0])
+    vid = np.load(args.vid, mmap_mode='r')
+    frame_index = None
+    if args.vid_fps is None:
+        if vid_meta.get("fps", None) is None:
+            raise ValueError("No frame rate metadata (%s.json) for %s, pass --vid_fps. Features extracted "
+                "before it was recorded keep every frame, i.e. the frame rate of the source video."
+                % (os.path.splitext(args.vid)[0], args.vid))
+        args.vid_fps = vid_meta["fps"]
+    if len(vid_meta) > 0:
+        frame_index = utils.get_frame_index(vid_meta, len(vid))
+        if frame_index is None:
+            print("[WARNING] The frames of the rows of %s are unknown, every row is taken as one frame" % args.vid)
+    modelWrapper = net.ModelWrapper(args)
+    modelWrapper.init_model()
+    modelWrapper.load_model(args.wav2vec_path, 'train')
+    modelWrapper.load_model(args.model_path, 'test')
+
+    norm_stat = utils.load_norm_stat(os.path.join(args.model_path, "train_norm_stat.pkl"))
+    predictor = net.StreamingPredictor(modelWrapper, norm_stat=norm_stat,
+        window_sec=args.window_sec, hop_sec=args.hop_sec,
+        left_context_sec=args.left_context_sec, vid_fps=args.vid_fps)
+
+    wav_blocks = net.iter_wav_blocks(args.wav, block_sec=args.block_sec)
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        header = ["start", "end"]
+        for prefix in ["pred", "pred_a", "pred_v"]:
+            header += [prefix + "_" + str(i) for i in range(args.output_num)]
+        writer.writerow(header)
+        for result in predictor.predict(wav_blocks, vid, frame_index=frame_index):
+            row = ["%.2f" % result["start"], "%.2f" % result["end"]]
+            for prefix in ["pred", "pred_a", "pred_v"]:
+                row += ["%.6f" % v for v in result[prefix]]
+            writer.writerow(row)
+            f.flush()
+            print("[%.2f - %.2f]" % (result["start"], result["end"]), np.round(result["pred"], 4))
+
+
+if __name__ == "__main__":
+    # Inputs for the main function
+    parser = argparse.ArgumentParser()
+
+    # Experiment Arguments
+    parser.add_argument(
+        '--device',
+        choices=['cuda', 'cpu'],
+        default='cuda',
+        type=str)
+    parser.add_argument(
+        '--model_type',
+        default="wav2vec2-large-robust",
+        type=str)
+    parser.add_argument(
+        '--label_type',
+        choices=['dimensional', 'categorical'],
+        default='categorical',
+        type=str)
+
+    # Model Arguments
+    parser.add_argument(
+        '--model_path',
+        default=None,
+        type=str)
+    parser.add_argument(
+        '--wav2vec_path', type=str, default=None,
+        help='directory of a fine-tuned final_wav2vec.pt for the audio encoder (default: pretrained weights)')
+    parser.add_argument(
+        '--output_num',
+        default=6,
+        type=int)
+    parser.add_argument(
+        '--hidden_dim',
+        default=1024,
+        type=int)
+    parser.add_argument(
+        '--num_layers',
+        default=2,
+        type=int)
+    parser.add_argument(
+        '--lr',
+        default=1e-5,
+        type=float)
+    parser.add_argument(
+        '--label_learning',
+        default="hard-label",
+        type=str)
+    parser.add_argument(
+        '--out_dropout', type=float, default=0.2,
+        help='output layer dropout (default: 0.2')
+
+    # Streaming Arguments
+    parser.add_argument(
+        '--wav',
+        required=True,
+        type=str,
+        help='16 kHz mono wav file')
+    parser.add_argument(
+        '--vid',
+        required=True,
+        type=str,
+        help='face feature file (.npy)')
+    parser.add_argument(
+        '--output',
+        default="stream_predictions.csv",
+        type=str)
+    parser.add_argument(
+        '--window_sec', type=float, default=12.0,
+        help='length of the pooling window (default: 12.0)')
+    parser.add_argument(
+        '--hop_sec', type=float, default=1.0,
+        help='prediction interval (default: 1.0)')
+    parser.add_argument(
+        '--left_context_sec', type=float, default=2.0,
+        help='cached audio context fed to the audio encoder (default: 2.0)')
+    parser.add_argument(
+        '--vid_fps', type=float, default=None,
+        help='frame rate of the face features (default: from the <vid>.json metadata, required without it)')
+    parser.add_argument(
+        '--block_sec', type=float, default=10.0,
+        help='audio read block size (default: 10.0)')
+
+    args = parser.parse_args()
+
+    # Call main function
+    main(args)
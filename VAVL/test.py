@@ -0,0 +1,273 @@
+# -*- coding: UTF-8 -*-
+# Local modules
+import os
+import sys
+import argparse
+# 3rd-Party Modules
+from tqdm import tqdm
+import numpy as np
+
+# PyTorch Modules
+import torch
+from torch.utils.data import DataLoader
+# Self-Written Modules
+sys.path.append(os.getcwd())
+import utils
+import net
+
+
+def main(args):
+    utils.print_config_description(args.conf_path)
+    config_dict = utils.load_env(args.conf_path)
+    assert config_dict.get("config_root", None) != None, "No config_root in config/conf.json"
+    config_path = os.path.join(config_dict["config_root"], config_dict[args.corpus_type])
+    utils.print_config_description(config_path)
+
+    model_path = args.model_path
+
+    # Initialize dataset
+    DataManager=utils.DataManager(config_path)
+    lab_type = args.label_type
+
+    audio_path, video_path, label_path = utils.load_audio_and_label_file_paths(args)
+
+    fnames_aud, fnames_vid = utils.get_matched_fnames(audio_path, video_path)
+    test_wavs, test_vids, test_labs, test_utts = DataManager.get_split_data("test",
+        audio_path, video_path, label_path, fnames_aud, fnames_vid, lab_type)
+
+    norm_stat_file = os.path.join(model_path, "train_norm_stat.pkl")
+    wav_mean, wav_std, vid_mean, vid_std = utils.load_norm_stat(norm_stat_file)
+    test_set = utils.AudVidSet(test_wavs, test_vids, test_labs, test_utts,
+        print_dur=True, lab_type=lab_type, print_utt=True,
+        wav_mean = wav_mean, wav_std = wav_std,
+        vid_mean = vid_mean, vid_std = vid_std,
+        label_config = DataManager.get_label_config(lab_type),
+        vid_fps = DataManager.get_vid_fps(test_utts),
+        vid_frame_index = DataManager.get_vid_frame_index(test_utts)
+    )
+    test_loader = DataLoader(test_set, batch_size=args.batch_size, collate_fn=utils.collate_fn_padd, shuffle=False)
+
+    # Initialize model
+    # Heads of a non-default size (e.g. distill.py students) are described by model_config.json
+    utils.load_model_config(model_path, args)
+    modelWrapper = net.ModelWrapper(args)
+    modelWrapper.init_model()
+    modelWrapper.load_model(args.wav2vec_path, 'train')
+    modelWrapper.load_model(model_path, 'test')
+    modelWrapper.set_eval()
+
+    # Predictions depend on the whole batch (the Conformers attend over the batch axis and
+    # the padding follows the longest utterance), so every entry is keyed on the ordered
+    # contents of its batch and on its position in it, not only on its own features.
+    cache = None
+    if not args.no_cache:
+        cache = utils.PredictionCache(max_items=args.cache_items, cache_dir=args.cache_dir,
+            max_disk_bytes=None if args.cache_max_mb is None else int(args.cache_max_mb * 1024 * 1024))
+        with open(norm_stat_file, 'rb') as f:
+            ckpt_hash = modelWrapper.checkpoint_hash() + utils.feature_hash(np.frombuffer(f.read(), dtype=np.uint8))
+        mode = "weights/bs%d/dur%d" % (args.batch_size, test_set.max_dur)
+        feat_hashes = [utils.feature_hash(test_wavs[idx], test_vids[idx]) for idx in tqdm(range(len(test_set)))]
+
+    total_pred_t, total_pred_a, total_pred_v = [], [], []
+    total_y_t = []
+    total_utts = []
+    sidx = 0
+    with torch.no_grad():
+        for xy_pair in tqdm(test_loader):
+            xa = xy_pair[0]
+            xv = xy_pair[1]
+            y = xy_pair[2]
+            mask = xy_pair[3]
+            utt_ids = xy_pair[4]
+            eidx = sidx + len(utt_ids)
+
+            cached = None
+            if cache is not None:
+                keys = cache.batch_keys(ckpt_hash, feat_hashes[sidx:eidx], mode)
+                cached = [cache.get(key) for key in keys]
+                if any(c is None for c in cached):
+                    cached = None
+
+            if cached is None:
+                xa=xa.to(args.device, non_blocking=True).float()
+                xv=xv.to(args.device, non_blocking=True).float()
+                mask=mask.to(args.device, non_blocking=True).float()
+
+                preds_a, preds_v, preds_av = modelWrapper.feed_forward(xa, xv, mode = 'weights', attention_mask=mask)
+                preds_a = preds_a.float().cpu()
+                preds_v = preds_v.float().cpu()
+                preds_av = preds_av.float().cpu()
+                if cache is not None:
+                    for bi, key in enumerate(keys):
+                        cache.put(key, {"preds_a": preds_a[bi].numpy(), "preds_v": preds_v[bi].numpy(),
+                                        "preds": preds_av[bi].numpy()})
+            else:
+                preds_a = torch.from_numpy(np.stack([c["preds_a"] for c in cached]))
+                preds_v = torch.from_numpy(np.stack([c["preds_v"] for c in cached]))
+                preds_av = torch.from_numpy(np.stack([c["preds"] for c in cached]))
+
+            total_pred_t.append(preds_av)
+            total_pred_a.append(preds_a)
+            total_pred_v.append(preds_v)
+            total_y_t.append(y.float())
+            total_utts.extend(utt_ids)
+            sidx = eidx
+
+    total_pred_t = torch.cat(total_pred_t, 0)
+    total_pred_a = torch.cat(total_pred_a, 0)
+    total_pred_v = torch.cat(total_pred_v, 0)
+    total_y_t = torch.cat(total_y_t, 0)
+
+    if cache is not None:
+        cache.print_stat()
+
+    if args.label_type == "categorical":
+        loss_t = utils.CE_category(total_pred_t, total_y_t)
+        acc_t = utils.calc_acc(total_pred_t, total_y_t)
+        print("test_loss :", np.round(loss_t.item(), 4), "/ test_acc :", np.round(acc_t.item(), 4))
+    elif args.label_type == "dimensional":
+        for name, total_pred in [("audiovisual", total_pred_t), ("acoustic", total_pred_a), ("visual", total_pred_v)]:
+            ccc = utils.CCC_loss(total_pred, total_y_t)
+            print(name, "aro :", np.round(ccc[0].item(), 4), "/ dom :", np.round(ccc[1].item(), 4),
+                "/ val :", np.round(ccc[2].item(), 4))
+            if args.n_boot > 0:
+                ccc_acc = utils.CCCAccumulator(n_boot=args.n_boot, seed=0)
+                ccc_acc.update(total_pred, total_y_t)
+                lower, upper = ccc_acc.compute_ci(args.ci_alpha)
+                print(" " * len(name), "%d%% CI" % round(100 * (1 - args.ci_alpha)),
+                    " / ".join("%s : [%.4f, %.4f]" % (attr, l, u) for attr, l, u in zip(["aro", "dom", "val"], lower.tolist(), upper.tolist())))
+
+    preds_np = {
+        "acoustic": total_pred_a.float().numpy(),
+        "visual": total_pred_v.float().numpy(),
+        "audiovisual": total_pred_t.float().numpy(),
+    }
+    total_y_np = total_y_t.numpy()
+    os.makedirs(model_path + '/predictions', exist_ok=True)
+    utils.save_predictions(model_path + '/predictions/eval.npz', total_utts, total_y_np, **preds_np)
+    if args.label_type == "categorical":
+        for mode in ['acoustic', 'visual', 'audiovisual']:
+            print("This is mode:", mode)
+            utils.scores(preds_np[mode], total_y_np)
+
+
+if __name__ == "__main__":
+    # Inputs for the main function
+    parser = argparse.ArgumentParser()
+
+    # Experiment Arguments
+    parser.add_argument(
+        '--device',
+        choices=['cuda', 'cpu'],
+        default='cuda',
+        type=str)
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int)
+    parser.add_argument(
+        '--conf_path',
+        default="config/conf.json",
+        type=str)
+
+    # Data Arguments
+    parser.add_argument(
+        '--corpus_type',
+        default="podcast_v1.7",
+        type=str)
+    parser.add_argument(
+        '--model_type',
+        default="wav2vec2",
+        type=str)
+    parser.add_argument(
+        '--label_type',
+        choices=['dimensional', 'categorical'],
+        default='categorical',
+        type=str)
+
+    # Model Arguments
+    parser.add_argument(
+        '--model_path',
+        default=None,
+        type=str)
+    parser.add_argument(
+        '--wav2vec_path', type=str, default=None,
+        help='directory of a fine-tuned final_wav2vec.pt for the audio encoder (default: pretrained weights)')
+    parser.add_argument(
+        '--output_num',
+        default=4,
+        type=int)
+    parser.add_argument(
+        '--batch_size',
+        default=1,
+        type=int)
+    parser.add_argument(
+        '--hidden_dim',
+        default=256,
+        type=int)
+    parser.add_argument(
+        '--num_layers',
+        default=3,
+        type=int)
+    parser.add_argument(
+        '--lr',
+        default=1e-5,
+        type=float)
+
+     # Label Learning Arguments
+    parser.add_argument(
+        '--label_learning',
+        default="multi-label",
+        type=str)
+    parser.add_argument(
+        '--corpus',
+        default="USC-IEMOCAP",
+        type=str)
+    parser.add_argument(
+        '--num_classes',
+        default="four",
+        type=str)
+    parser.add_argument(
+        '--label_rule',
+        default="M",
+        type=str)
+    parser.add_argument(
+        '--partition_number',
+        default="1",
+        type=str)
+    parser.add_argument(
+        '--data_mode',
+        default="primary",
+        type=str)
+    parser.add_argument(
+        '--output_dim',
+        default=6,
+        type=int)
+    parser.add_argument(
+        '--out_dropout', type=float, default=0.2,
+        help='output layer dropout (default: 0.2')
+
+    # Prediction Cache Arguments
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='directory for the persistent prediction cache (default: in-memory only)')
+    parser.add_argument(
+        '--cache_items', type=int, default=100000,
+        help='maximum number of cached utterances kept in memory')
+    parser.add_argument(
+        '--cache_max_mb', type=float, default=None,
+        help='maximum size of the on-disk prediction cache in MB')
+    parser.add_argument(
+        '--no_cache', action='store_true',
+        help='disable the prediction cache')
+    parser.add_argument(
+        '--n_boot', type=int, default=0,
+        help='bootstrap resamples for CCC confidence intervals (dimensional only, 0 disables)')
+    parser.add_argument(
+        '--ci_alpha', type=float, default=0.05,
+        help='confidence interval level is 1 - ci_alpha')
+
+    args = parser.parse_args()
+
+    # Call main function
+    main(args)
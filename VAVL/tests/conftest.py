@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the VAVL scripts import utils and net from the VAVL directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
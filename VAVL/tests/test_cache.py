@@ -0,0 +1,33 @@
+import numpy as np
+
+import utils
+
+
+def _keys(feat_hashes, batch_size):
+    keys = {}
+    for sidx in range(0, len(feat_hashes), batch_size):
+        batch = feat_hashes[sidx:sidx + batch_size]
+        keys.update(zip(batch, utils.PredictionCache.batch_keys("ckpt", batch, "weights")))
+    return keys
+
+
+def test_keys_depend_on_the_batch():
+    rng = np.random.RandomState(0)
+    feat_hashes = [utils.feature_hash(rng.randn(100 * (i + 1)), rng.randn(i + 1, 8)) for i in range(4)]
+    keys = _keys(feat_hashes, 2)
+    assert keys == _keys(list(feat_hashes), 2)
+    # another partition, order or neighbour gives other predictions
+    assert not set(keys.values()) & set(_keys(feat_hashes[1:] + feat_hashes[:1], 2).values())
+    assert not set(keys.values()) & set(_keys(feat_hashes[::-1], 2).values())
+    other = _keys(feat_hashes[:3] + [utils.feature_hash(rng.randn(10))], 2)
+    assert keys[feat_hashes[0]] == other[feat_hashes[0]]
+    assert keys[feat_hashes[2]] != other[feat_hashes[2]]
+
+
+def test_cache_round_trip(tmp_path):
+    cache = utils.PredictionCache(max_items=1, cache_dir=str(tmp_path))
+    key = utils.PredictionCache.make_key("ckpt", "feat", "weights/batch/0")
+    cache.put(key, {"preds": np.arange(3, dtype=np.float32)})
+    cache.put(utils.PredictionCache.make_key("ckpt", "feat", "weights/batch/1"), {"preds": np.zeros(3)})
+    # evicted from memory, read back from disk
+    np.testing.assert_array_equal(cache.get(key)["preds"], np.arange(3, dtype=np.float32))
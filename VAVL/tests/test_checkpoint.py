@@ -0,0 +1,51 @@
+import random
+
+import numpy as np
+import torch
+
+import utils
+
+
+def _train_state():
+    model = torch.nn.Linear(4, 2)
+    opt = torch.optim.Adam(model.parameters(), lr=1e-3)
+    model(torch.randn(3, 4)).sum().backward()
+    opt.step()
+    return {"model": model.state_dict(), "opt": opt.state_dict()}
+
+
+def test_checkpoint_round_trip(tmp_path):
+    # LossManager.get_stat returns NumPy scalars, which torch.load(weights_only=True) rejects
+    state = {
+        "epoch": 3,
+        "model": _train_state(),
+        "min_epoch": 2,
+        "min_loss": np.float64(0.25),
+        "temp_dev": 0.25,
+        "epochs_no_improve": 1,
+        "losses_train": [np.float64(0.5), np.float64(0.4)],
+        "losses_dev": [0.3, 0.25],
+        "losses_test": [],
+        "best_result": {"epoch": 2, "dev_loss": np.float64(0.25), "audiovisual_f1_macro": np.float32(0.5)},
+        "rng": utils.get_rng_state(),
+    }
+    ckpt_manager = utils.CheckpointManager(str(tmp_path), async_write=False)
+    ckpt_manager.save(state, state["epoch"])
+    ckpt = ckpt_manager.load()
+    ckpt_manager.close()
+
+    assert ckpt["epoch"] == 3
+    assert ckpt["min_loss"] == 0.25 and type(ckpt["min_loss"]) is float
+    assert ckpt["losses_train"] == [0.5, 0.4]
+    assert ckpt["best_result"] == {"epoch": 2, "dev_loss": 0.25, "audiovisual_f1_macro": 0.5}
+    for key, value in state["model"]["model"].items():
+        assert torch.equal(ckpt["model"]["model"][key], value)
+    assert ckpt["model"]["opt"]["state"][0]["step"] == state["model"]["opt"]["state"][0]["step"]
+
+
+def test_rng_state_round_trip(tmp_path):
+    ckpt_manager = utils.CheckpointManager(str(tmp_path), async_write=False)
+    ckpt_manager.save({"rng": utils.get_rng_state()}, 0)
+    expected = (random.random(), np.random.rand(), torch.rand(1).item())
+    utils.set_rng_state(ckpt_manager.load()["rng"])
+    assert (random.random(), np.random.rand(), torch.rand(1).item()) == expected
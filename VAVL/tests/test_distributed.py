@@ -0,0 +1,56 @@
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import utils
+
+
+WORLD_SIZE = 2
+
+
+def _gather(tensor):
+    tensors = [torch.zeros_like(tensor) for _ in range(WORLD_SIZE)]
+    dist.all_gather(tensors, tensor)
+    return tensors
+
+
+def _worker(rank, init_file):
+    dist.init_process_group("gloo", init_method="file://" + init_file, rank=rank, world_size=WORLD_SIZE)
+    try:
+        # different initialisations, and BatchNorm buffers, on every rank
+        torch.manual_seed(rank)
+        module = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.BatchNorm1d(3))
+        module(torch.randn(8, 4))
+        assert not torch.equal(*_gather(module[0].weight.detach().clone()))
+
+        utils.broadcast_module(module)
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            gathered = _gather(tensor.detach().clone())
+            assert all(torch.equal(gathered[0], other) for other in gathered[1:])
+
+        # gradients of several dtypes, and a parameter without gradient
+        double = torch.nn.Parameter(torch.zeros(5, dtype=torch.float64))
+        params = list(module.parameters()) + [double, torch.nn.Parameter(torch.zeros(2))]
+        for p in params[:-1]:
+            p.grad = torch.full_like(p, float(rank + 1))
+        utils.all_reduce_grads(params)
+        for p in params[:-1]:
+            assert torch.allclose(p.grad, torch.full_like(p, 1.5))
+        assert params[-1].grad is None
+
+        # training stats of the shards are merged, dev stats are already global
+        lm = utils.LogManager()
+        lm.alloc_stat_type_list(["train_loss", "dev_loss"])
+        lm.add_torch_stat("train_loss", torch.tensor(float(rank + 1)), weight=rank + 1)
+        lm.add_stat("dev_loss", 0.5)
+        lm.all_reduce(["train_loss"])
+        assert lm.get_stat("train_loss") == round((1 * 1 + 2 * 2) / 3, 4)
+        assert lm.get_stat("dev_loss") == 0.5
+    finally:
+        dist.destroy_process_group()
+
+
+def test_gloo_two_processes(tmp_path):
+    mp.spawn(_worker, args=(str(tmp_path / "init"),), nprocs=WORLD_SIZE, join=True)
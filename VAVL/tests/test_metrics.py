@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+import torch
+from sklearn import metrics as sk_metrics
+
+import utils
+
+
+def _random_case(seed, num_classes=5, n=200):
+    rng = np.random.RandomState(seed)
+    scores = rng.randn(n, num_classes).astype(np.float32)
+    true_idx = rng.randint(num_classes, size=n)
+    # leave one class out of the labels, as in small test splits
+    true_idx[true_idx == num_classes - 1] = 0
+    return scores, np.eye(num_classes, dtype=np.float32)[true_idx], true_idx
+
+
+def _expected(pred_idx, true_idx, num_classes):
+    expected = {}
+    for average in ["macro", "micro"]:
+        expected["f1_" + average] = sk_metrics.f1_score(true_idx, pred_idx, average=average, zero_division=0)
+        expected["precision_" + average] = sk_metrics.precision_score(true_idx, pred_idx, average=average,
+                                                                      zero_division=0)
+        expected["recall_" + average] = sk_metrics.recall_score(true_idx, pred_idx, average=average, zero_division=0)
+    expected["ua"] = sk_metrics.balanced_accuracy_score(true_idx, pred_idx)
+    expected["wa"] = sk_metrics.accuracy_score(true_idx, pred_idx)
+    expected["confusion_matrix"] = sk_metrics.confusion_matrix(true_idx, pred_idx, labels=list(range(num_classes)))
+    return expected
+
+
+def _check(result, expected):
+    np.testing.assert_array_equal(result["confusion_matrix"].numpy(), expected["confusion_matrix"])
+    for key, value in expected.items():
+        if key != "confusion_matrix":
+            assert result[key].item() == pytest.approx(value, abs=1e-12), key
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_parity_with_sklearn(seed):
+    scores, onehot, true_idx = _random_case(seed)
+    pred_idx = scores.argmax(1)
+    expected = _expected(pred_idx, true_idx, scores.shape[1])
+    _check(utils.classification_metrics(torch.from_numpy(scores), torch.from_numpy(onehot)), expected)
+    _check(utils.classification_metrics(scores, true_idx), expected)
+
+
+def test_class_indices_without_num_classes():
+    scores, _, true_idx = _random_case(3)
+    pred_idx = scores.argmax(1)
+    result = utils.classification_metrics(pred_idx, true_idx)
+    num_classes = max(pred_idx.max(), true_idx.max()) + 1
+    assert result["confusion_matrix"].shape == (num_classes, num_classes)
+    _check(result, _expected(pred_idx, true_idx, num_classes))
+
+
+def test_confusion_meter_matches_single_pass():
+    scores, onehot, true_idx = _random_case(4)
+    meter = utils.ConfusionMeter(scores.shape[1])
+    for sidx in range(0, len(scores), 32):
+        meter.update(torch.from_numpy(scores[sidx:sidx + 32]), torch.from_numpy(onehot[sidx:sidx + 32]))
+    _check(meter.compute(), _expected(scores.argmax(1), true_idx, scores.shape[1]))
+
+
+def _ccc_case(seed, n=300, dim=3):
+    gen = torch.Generator().manual_seed(seed)
+    lab = torch.randn(n, dim, generator=gen, dtype=torch.float64) * 2 + 1
+    pred = 0.7 * lab + torch.randn(n, dim, generator=gen, dtype=torch.float64) + 0.5
+    return pred, lab
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_ccc_accumulator_matches_ccc_loss(seed):
+    pred, lab = _ccc_case(seed)
+    acc = utils.CCCAccumulator()
+    # uneven batches, including a single row
+    bounds = [0, 1, 17, 64, 65, 190, len(pred)]
+    for sidx, eidx in zip(bounds[:-1], bounds[1:]):
+        acc.update(pred[sidx:eidx].float(), lab[sidx:eidx].float())
+    expected = utils.CCC_loss(pred.float(), lab.float())
+    np.testing.assert_allclose(acc.compute().numpy(), expected.numpy(), atol=1e-6)
+
+    acc.reset()
+    acc.update(pred.float(), lab.float())
+    np.testing.assert_allclose(acc.compute().numpy(), expected.numpy(), atol=1e-6)
+
+
+def test_ccc_accumulator_ci_brackets_estimate():
+    pred, lab = _ccc_case(2)
+    cis = []
+    for _ in range(2):
+        acc = utils.CCCAccumulator(n_boot=200, seed=0)
+        for sidx in range(0, len(pred), 48):
+            acc.update(pred[sidx:sidx + 48].float(), lab[sidx:sidx + 48].float())
+        ccc = acc.compute()
+        lower, upper = acc.compute_ci(alpha=0.05)
+        assert torch.all(lower < ccc) and torch.all(ccc < upper)
+        assert torch.all(upper - lower < 0.5)
+        cis.append((lower, upper))
+    # same seed, same intervals
+    assert torch.equal(cis[0][0], cis[1][0]) and torch.equal(cis[0][1], cis[1][1])
@@ -0,0 +1,44 @@
+import copy
+
+import pytest
+import torch
+from torch import nn
+
+from net import quantization
+
+
+class Heads(nn.Module):
+    """
+    Stand-in for ModelWrapper with one small head per quantized module name
+    """
+    def __init__(self):
+        super().__init__()
+        for name in quantization.HEAD_NAMES:
+            setattr(self, name, nn.Sequential(nn.Linear(16, 16), nn.ReLU()))
+
+    def forward(self, x):
+        for name in quantization.HEAD_NAMES:
+            x = getattr(self, name)(x)
+        return x
+
+
+def test_single_calibration_batch_is_observed():
+    torch.manual_seed(0)
+    model = Heads().eval()
+    x = torch.randn(8, 16) * 3
+    ref = model(x)
+
+    qmodel = copy.deepcopy(model)
+    quantizer = quantization.StaticQuantizer(qmodel)
+    quantizer.prepare(lambda: qmodel(x))
+    quantizer.convert()
+
+    assert quantizer.summary()["calibration_batches"] == 1
+    # an unobserved model is off by the magnitude of the output
+    assert (qmodel(x) - ref).abs().max() < 0.1 * ref.abs().max()
+
+
+def test_convert_without_calibration_raises():
+    quantizer = quantization.StaticQuantizer(Heads().eval())
+    with pytest.raises(RuntimeError):
+        quantizer.convert()
@@ -0,0 +1,78 @@
+import json
+import os
+
+import numpy as np
+import soundfile
+
+import utils
+
+
+def _write_features(root, name, num_rows, meta=None):
+    np.save(os.path.join(root, name + ".npy"), np.random.RandomState(0).randn(num_rows, 8).astype(np.float32))
+    if meta is not None:
+        with open(os.path.join(root, name + ".json"), 'w') as f:
+            json.dump(meta, f)
+
+
+# 4 s at 5 fps: no face in frames 3-4, two faces in frame 10
+FRAME_INDEX = [0, 1, 2] + list(range(5, 10)) + [10, 10] + list(range(11, 20))
+
+
+def _corpus(tmp_path):
+    vid_root = str(tmp_path / "vid")
+    aud_root = str(tmp_path / "aud")
+    os.makedirs(vid_root)
+    os.makedirs(aud_root)
+    # frame index recorded, older metadata with one face per frame, older metadata with a missed face, none
+    _write_features(vid_root, "indexed", len(FRAME_INDEX),
+        {"fps": 5.0, "num_frames": 20, "num_faces": len(FRAME_INDEX), "frame_index": FRAME_INDEX})
+    _write_features(vid_root, "aligned", 20, {"fps": 5.0, "num_frames": 20, "num_faces": 20})
+    _write_features(vid_root, "missed", 19, {"fps": 5.0, "num_frames": 20, "num_faces": 19})
+    _write_features(vid_root, "legacy", 100)
+    names = ["indexed", "aligned", "missed", "legacy"]
+    for name in names:
+        soundfile.write(os.path.join(aud_root, name + ".wav"), np.zeros(4 * 16000, dtype=np.float32), 16000)
+    return aud_root, vid_root, names
+
+
+def _check_frame_index(frame_index_list):
+    np.testing.assert_array_equal(frame_index_list[0], FRAME_INDEX)
+    np.testing.assert_array_equal(frame_index_list[1], np.arange(20))
+    assert frame_index_list[2] is None and frame_index_list[3] is None
+
+
+def test_vid_extractor_frame_index(tmp_path):
+    _, vid_root, names = _corpus(tmp_path)
+    extractor = utils.VidExtractor([os.path.join(vid_root, name) for name in names])
+    extractor.extract()
+    assert extractor.fps_list == [5.0, 5.0, 5.0, None]
+    _check_frame_index(extractor.frame_index_list)
+
+
+def test_corpus_cache_frame_index(tmp_path):
+    aud_root, vid_root, names = _corpus(tmp_path)
+    cache = utils.CorpusCache.build(str(tmp_path / "cache"), aud_root, vid_root,
+        [name + ".wav" for name in names], names)
+    utts = [name + ".wav" for name in names]
+    assert cache.get_fps(utts) == [5.0, 5.0, 5.0, None]
+    _check_frame_index(cache.get_frame_index(utts))
+    _check_frame_index(utils.CorpusCache(str(tmp_path / "cache")).get_frame_index(utts))
+
+
+def test_rows_in_the_audio_span_are_kept():
+    # 2.1 s of audio: frames 0-10 at 5 fps
+    wavs = [np.zeros(int(2.1 * 16000), dtype=np.float32)] * 3
+    vids = [np.zeros((len(FRAME_INDEX), 8), dtype=np.float32), np.zeros((20, 8), dtype=np.float32),
+            np.zeros((19, 8), dtype=np.float32)]
+    labs = [np.eye(6)[0]] * 3
+    kwargs = dict(lab_type="categorical", label_config={"emo_type": list(range(6))},
+        vid_mean=0.0, vid_std=1.0, wav_mean=0.0, wav_std=1.0)
+    dataset = utils.AudVidSet(wavs, vids, labs, ["indexed", "aligned", "missed"], vid_fps=[5.0, 5.0, 5.0],
+        vid_frame_index=[np.array(FRAME_INDEX), np.arange(20), None], **kwargs)
+    # frames 0-2, 5-9 and both faces of frame 10
+    assert len(dataset[0][1]) == 10
+    assert len(dataset[1][1]) == 11
+    assert len(dataset[2][1]) == 19
+    # without frame indices every row is one frame
+    dataset = utils.AudVidSet(wavs, vids, labs, ["indexed", "aligned", "missed"], vid_fps=5.0, **kwargs)
+    assert [len(dataset[idx][1]) for idx in range(3)] == [11, 11, 11]
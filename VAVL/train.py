@@ -2,6 +2,7 @@
 # Local modules
 import os
 import sys
+import json
 import argparse
 # 3rd-Party Modules
 from tqdm import tqdm
@@ -9,21 +10,134 @@ from tqdm import tqdm
 # PyTorch Modules
 import torch
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torch.cuda.amp import GradScaler, autocast
-import pandas as pd
 # Self-Written Modules
 sys.path.append(os.getcwd())
 import utils
 import net
 
 
+def split_batch(xa, xv, y, mask, micro_batch_size=None):
+    """
+    Split a padded batch into micro-batches of at most micro_batch_size utterances.
+    Returns (xa, xv, y, mask, fraction of the batch) per micro-batch.
+    """
+    batch_num = y.size(0)
+    if micro_batch_size is None or micro_batch_size >= batch_num:
+        return [(xa, xv, y, mask, 1.0)]
+    micro_batches = []
+    for sidx in range(0, batch_num, micro_batch_size):
+        eidx = min(sidx + micro_batch_size, batch_num)
+        micro_batches.append((xa[sidx:eidx], xv[sidx:eidx], y[sidx:eidx], mask[sidx:eidx], (eidx - sidx) / batch_num))
+    return micro_batches
+
+
+def evaluate_test(modelWrapper, loader, args, lm, show_progress=True):
+    """
+    Predict the test set and add its stats to lm.
+    Returns the acoustic/visual/audiovisual predictions, labels and utterance ids.
+    """
+    total_pred_t, total_pred_a, total_pred_v  = [] , [], []
+    total_y_t = []
+    total_utts = []
+    with torch.no_grad():
+        for xy_pair in tqdm(loader, disable=not show_progress):
+            xa = xy_pair[0]
+            xv = xy_pair[1]
+            y = xy_pair[2]
+            mask = xy_pair[3]
+            utt_ids = xy_pair[4]
+
+
+            xa=xa.to(args.device, non_blocking=True).float()
+            xv=xv.to(args.device, non_blocking=True).float()
+            y=y.to(args.device, non_blocking=True).float()
+            mask=mask.to(args.device, non_blocking=True).float()
+
+            preds_a, preds_v, preds_av = modelWrapper.feed_forward(xa, xv, mode = 'weights', attention_mask=mask)
+
+
+            total_pred_t.append(preds_av)
+            total_pred_a.append(preds_a)
+            total_pred_v.append(preds_v)
+            total_y_t.append(y)
+            total_utts.extend(utt_ids)
+
+    total_pred_t = torch.cat(total_pred_t, 0)
+    total_pred_a = torch.cat(total_pred_a, 0)
+    total_pred_v = torch.cat(total_pred_v, 0)
+    total_y_t = torch.cat(total_y_t, 0)
+
+    if args.label_type == "categorical":
+        if args.label_learning == "hard-label":
+            loss_t = utils.CE_category(total_pred_t, total_y_t)
+
+        acc_t = utils.calc_acc(total_pred_t, total_y_t)
+        lm.add_torch_stat("test_loss", loss_t)
+        lm.add_torch_stat("test_acc", acc_t)
+
+    if args.label_type == "dimensional":
+        ccc_test = utils.CCC_loss(total_pred_t, total_y_t)
+        ccc_test_a = utils.CCC_loss(total_pred_a, total_y_t)
+        ccc_test_v = utils.CCC_loss(total_pred_v, total_y_t)
+
+        lm.add_torch_stat("test_aro", ccc_test[0])
+        lm.add_torch_stat("test_dom", ccc_test[1])
+        lm.add_torch_stat("test_val", ccc_test[2])
+        lm.add_torch_stat("test_aro_a", ccc_test_a[0])
+        lm.add_torch_stat("test_dom_a", ccc_test_a[1])
+        lm.add_torch_stat("test_val_a", ccc_test_a[2])
+        lm.add_torch_stat("test_aro_v", ccc_test_v[0])
+        lm.add_torch_stat("test_dom_v", ccc_test_v[1])
+        lm.add_torch_stat("test_val_v", ccc_test_v[2])
+
+    return {
+        "acoustic": total_pred_a,
+        "visual": total_pred_v,
+        "audiovisual": total_pred_t,
+        "y": total_y_t,
+        "utts": total_utts,
+    }
+
+
+def report_test(test_out, args, lm, model_path, pred_writer=None):
+    """
+    Save the test predictions (if pred_writer is given) and return the test
+    metrics of the selected model, as reported in results.json
+    """
+    preds_np = {mode: test_out[mode].detach().float().cpu().numpy() for mode in ['acoustic', 'visual', 'audiovisual']}
+    total_y_np = test_out["y"].detach().cpu().numpy()
+    if pred_writer is not None:
+        pred_writer.write(model_path + '/predictions/test.npz', test_out["utts"], total_y_np, **preds_np)
+
+    result = {}
+    for stat_type in lm.log_book.keys():
+        if stat_type.startswith("test_") and lm.log_book[stat_type][1] != 0:
+            result[stat_type] = float(lm.get_stat(stat_type))
+    if args.label_type == "categorical":
+        for mode in ['acoustic', 'visual', 'audiovisual']:
+            print("This is mode:", mode)
+            mode_result = utils.scores(preds_np[mode], total_y_np)
+            for metric in ["f1_macro", "f1_micro", "ua", "wa"]:
+                result[mode + "_" + metric] = mode_result[metric].item()
+    return result
+
+
 def main(args):
+    # Multi-process training when launched with torchrun; logging and files only on rank 0
+    args.device = utils.init_distributed(args.device)
+    is_main = utils.is_main_process()
+    utils.setup_for_distributed(is_main)
+
     utils.print_config_description(args.conf_path)
     config_dict = utils.load_env(args.conf_path)
     assert config_dict.get("config_root", None) != None, "No config_root in config/conf.json"
     config_path = os.path.join(config_dict["config_root"], config_dict[args.corpus_type])
     utils.print_config_description(config_path)
 
+    utils.set_deterministic(args.seed)
+
     # Make model directory
     model_path = args.model_path
     os.makedirs(model_path, exist_ok=True)
@@ -36,73 +150,70 @@ def main(args):
     audio_path, video_path, label_path = utils.load_audio_and_label_file_paths(args)
 
     
-    fnames_aud, fnames_vid = [], []
-    v_fnames = os.listdir(video_path)
-    for fname_aud in os.listdir(audio_path):
-        if fname_aud.replace('.wav','.npy') in v_fnames:
-            fnames_aud.append(fname_aud)
-            fnames_vid.append(fname_aud.replace('.wav',''))
-    fnames_aud.sort()
-    fnames_vid.sort()
-
-
-    snum=100000000000000000
-    train_wav_path = DataManager.get_wav_path(split_type="train",wav_loc=audio_path, fnames=fnames_aud, lbl_loc=label_path)[:snum]
-    train_vid_path = DataManager.get_vid_path(split_type="train",vid_loc=video_path, fnames=fnames_vid, lbl_loc=label_path)[:snum]
-
-    train_utts = [fname.split('/')[-1] for fname in train_wav_path]
-
-    train_labs = DataManager.get_msp_labels(train_utts, lab_type=lab_type,lbl_loc=label_path)
-    
-    train_wavs = utils.WavExtractor(train_wav_path).extract()
-    train_vids = utils.VidExtractor(train_vid_path).extract()
-    
-    
-    dev_wav_path = DataManager.get_wav_path(split_type="dev", wav_loc=audio_path, fnames=fnames_aud, lbl_loc=label_path)[:snum]
-    dev_vid_path = DataManager.get_vid_path(split_type="dev", vid_loc=video_path, fnames=fnames_vid, lbl_loc=label_path)[:snum]
-
-    dev_utts = [fname.split('/')[-1] for fname in dev_wav_path]
-    dev_labs = DataManager.get_msp_labels(dev_utts, lab_type=lab_type,lbl_loc=label_path)
-    dev_wavs = utils.WavExtractor(dev_wav_path).extract()
-    dev_vids = utils.VidExtractor(dev_vid_path).extract()
-    ###################################################################################################
-
-    test_wav_path = DataManager.get_wav_path(split_type="test",wav_loc=audio_path, fnames=fnames_aud, lbl_loc=label_path)
-    test_vid_path = DataManager.get_vid_path(split_type="test",vid_loc=video_path, fnames=fnames_vid, lbl_loc=label_path)
-
-    test_wav_path.sort()
-    test_utts = [fname.split('/')[-1] for fname in test_wav_path]
-    test_utts.sort()
-    test_labs = DataManager.get_msp_labels(test_utts, lab_type=lab_type,lbl_loc=label_path)
-    test_wavs = utils.WavExtractor(test_wav_path).extract()
-    test_vids = utils.VidExtractor(test_vid_path).extract()
-
+    fnames_aud, fnames_vid = utils.get_matched_fnames(audio_path, video_path)
+
+    # Decoded corpus shared read-only between runs (see run_experiments.py)
+    corpus_cache = None
+    if args.corpus_cache is not None:
+        if is_main and not utils.CorpusCache.exists(args.corpus_cache):
+            utils.CorpusCache.build(args.corpus_cache, audio_path, video_path, fnames_aud, fnames_vid)
+        utils.barrier()
+        corpus_cache = utils.CorpusCache(args.corpus_cache)
+
+    train_wavs, train_vids, train_labs, train_utts = DataManager.get_split_data("train",
+        audio_path, video_path, label_path, fnames_aud, fnames_vid, lab_type, corpus_cache)
+    dev_wavs, dev_vids, dev_labs, dev_utts = DataManager.get_split_data("dev",
+        audio_path, video_path, label_path, fnames_aud, fnames_vid, lab_type, corpus_cache)
+    test_wavs, test_vids, test_labs, test_utts = DataManager.get_split_data("test",
+        audio_path, video_path, label_path, fnames_aud, fnames_vid, lab_type, corpus_cache)
+
+    norm_stat = [None] * 4
+    if corpus_cache is not None and os.path.isfile(corpus_cache.norm_stat_path(train_utts)):
+        norm_stat = utils.load_norm_stat(corpus_cache.norm_stat_path(train_utts))
 
     train_set = utils.AudVidSet(train_wavs, train_vids, train_labs, train_utts, 
         print_dur=True, lab_type=lab_type,print_utt=True,
-        label_config = DataManager.get_label_config(lab_type)
+        wav_mean = norm_stat[0], wav_std = norm_stat[1],
+        vid_mean = norm_stat[2], vid_std = norm_stat[3],
+        label_config = DataManager.get_label_config(lab_type),
+        vid_fps = DataManager.get_vid_fps(train_utts),
+        vid_frame_index = DataManager.get_vid_frame_index(train_utts)
     )
     
     dev_set = utils.AudVidSet(dev_wavs, dev_vids, dev_labs, dev_utts, 
         print_dur=True, lab_type=lab_type,print_utt=True,
         wav_mean = train_set.wav_mean, wav_std = train_set.wav_std,
         vid_mean = train_set.vid_mean, vid_std = train_set.vid_std,
-        label_config = DataManager.get_label_config(lab_type)
+        label_config = DataManager.get_label_config(lab_type),
+        vid_fps = DataManager.get_vid_fps(dev_utts),
+        vid_frame_index = DataManager.get_vid_frame_index(dev_utts)
     )
 
     test_set = utils.AudVidSet(test_wavs, test_vids, test_labs, test_utts, 
         print_dur=True, lab_type=lab_type, print_utt=True,
         wav_mean = train_set.wav_mean, wav_std = train_set.wav_std,
         vid_mean = train_set.vid_mean, vid_std = train_set.vid_std,
-        label_config = DataManager.get_label_config(lab_type)
+        label_config = DataManager.get_label_config(lab_type),
+        vid_fps = DataManager.get_vid_fps(test_utts),
+        vid_frame_index = DataManager.get_vid_frame_index(test_utts)
     )
 
     # print(train_set.wav_mean, train_set.wav_std, train_set.vid_mean, train_set.vid_std)
 
-    train_set.save_norm_stat(model_path+"/train_norm_stat.pkl")
+    if is_main:
+        train_set.save_norm_stat(model_path+"/train_norm_stat.pkl")
+    if is_main and corpus_cache is not None and norm_stat[0] is None:
+        norm_stat_path = corpus_cache.norm_stat_path(train_utts)
+        os.makedirs(os.path.dirname(norm_stat_path), exist_ok=True)
+        train_set.save_norm_stat(norm_stat_path + ".%d.tmp" % os.getpid())
+        os.replace(norm_stat_path + ".%d.tmp" % os.getpid(), norm_stat_path)
     print(args.batch_size, 'batch_size')
+    # Each process trains on its own shard; dev/test are evaluated in full on every process
+    train_sampler = None
+    if utils.is_distributed():
+        train_sampler = DistributedSampler(train_set, shuffle=False)
     total_dataloader={
-        "train": DataLoader(train_set, batch_size=args.batch_size, collate_fn=utils.collate_fn_padd, shuffle=False),
+        "train": DataLoader(train_set, batch_size=args.batch_size, collate_fn=utils.collate_fn_padd, shuffle=False, sampler=train_sampler),
         "dev": DataLoader(dev_set, batch_size=args.batch_size, collate_fn=utils.collate_fn_padd, shuffle=False),
         "test": DataLoader(test_set, batch_size=args.batch_size, collate_fn=utils.collate_fn_padd, shuffle=False)
     }
@@ -111,9 +222,18 @@ def main(args):
     modelWrapper = net.ModelWrapper(args) # Change this to use custom model
     modelWrapper.init_model()
     modelWrapper.init_optimizer()
-    modelWrapper.load_model("/path_to_pretrained/wav2vec2", 'train')
+    if args.wav2vec_path is not None:
+        modelWrapper.load_model(args.wav2vec_path, 'train')
 
     
+    # Opt-in step profiling (--profile_path), one JSONL file per process
+    profile_path = args.profile_path
+    if profile_path is not None and utils.get_world_size() > 1:
+        profile_path += ".rank%d" % utils.get_rank()
+    profiler = utils.StepProfiler(profile_path, device=args.device, trace_dir=args.profile_trace_dir,
+        trace_start=args.profile_trace_start, trace_steps=args.profile_trace_steps)
+    modelWrapper.profiler = profiler
+
     # Initialize loss function
     lm = utils.LogManager()
     if args.label_type == "dimensional":
@@ -129,246 +249,279 @@ def main(args):
     min_loss = 99999999999
     temp_dev = 99999999999
     losses_train, losses_dev, losses_test = [], [], []
-    for epoch in range(epochs):
+    best_result = {}
+    epochs_no_improve = 0
+    start_epoch = 0
+
+    # Resumable checkpoints (written on a background thread)
+    ckpt_manager = utils.CheckpointManager(os.path.join(model_path, "checkpoints"), keep=args.keep_ckpt)
+    pred_writer = utils.PredictionWriter()
+    if args.resume:
+        ckpt = ckpt_manager.load(map_location=args.device)
+        if ckpt is not None:
+            modelWrapper.load_train_state(ckpt["model"])
+            start_epoch = ckpt["epoch"] + 1
+            min_epoch = ckpt["min_epoch"]
+            min_loss = ckpt["min_loss"]
+            temp_dev = ckpt["temp_dev"]
+            epochs_no_improve = ckpt.get("epochs_no_improve", 0)
+            losses_train, losses_dev, losses_test = ckpt["losses_train"], ckpt["losses_dev"], ckpt["losses_test"]
+            best_result = ckpt.get("best_result", {})
+            utils.set_rng_state(ckpt["rng"])
+    modelWrapper.broadcast_state()
+
+    for epoch in range(start_epoch, epochs):
+        if args.patience > 0 and epochs_no_improve >= args.patience:
+            break
         print("Epoch:",epoch)
         lm.init_stat()
-        for xy_pair in tqdm(total_dataloader["train"]):
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        profiler.set_epoch(epoch)
+        for xy_pair in tqdm(profiler.iter_loader(total_dataloader["train"]), total=len(total_dataloader["train"]), disable=not is_main):
             modelWrapper.set_train()
             xa = xy_pair[0]
             xv = xy_pair[1]
             y = xy_pair[2]
             mask = xy_pair[3]
-            
-            xa=xa.cuda(non_blocking=True).float()
-            xv=xv.cuda(non_blocking=True).float()
-            y=y.cuda(non_blocking=True).float()
-            mask=mask.cuda(non_blocking=True).float()
-
-            with autocast():
-
-                preds_v, x_in, rec_pred = modelWrapper.feed_forward(None, xv, mode = 'visual', attention_mask=mask)
-                loss_rec_v = utils.MSE_loss(rec_pred, x_in)
-                total_loss_v = 0.0
-                if args.label_type == "dimensional":
-                    ccc = utils.CCC_loss(preds_v, y)
-                    loss = 1.0-ccc
-                    total_loss_v += loss[0] + loss[1] + loss[2] + loss_rec_v
-                
-
-                elif args.label_type == "categorical":
-                    total_loss_v += utils.CE_category(preds_v, y) + 2*loss_rec_v
-
-            
-            modelWrapper.backprop(total_loss_v, 'visual')
-
-            with autocast():
-
-                preds_a, x_in, rec_pred = modelWrapper.feed_forward(xa, None, mode = 'acoustic', attention_mask=mask)
-                loss_rec_a = utils.MSE_loss(rec_pred, x_in)
-
-                total_loss_a = 0.0
-                if args.label_type == "dimensional":
-                    ccc = utils.CCC_loss(preds_a, y)
-                    loss = 1.0-ccc
-                    total_loss_a += loss[0] + loss[1] + loss[2] + loss_rec_a
-
-                elif args.label_type == "categorical":
-                    total_loss_a += utils.CE_category(preds_a, y) + 2*loss_rec_a
-
-            ## Backpropagation
-            modelWrapper.backprop(total_loss_a, 'acoustic')
+            audio_samples = mask.sum()
+
+            with profiler.phase("h2d"):
+                xa=xa.to(args.device, non_blocking=True).float()
+                xv=xv.to(args.device, non_blocking=True).float()
+                y=y.to(args.device, non_blocking=True).float()
+                mask=mask.to(args.device, non_blocking=True).float()
+
+            # Each phase accumulates gradients over micro-batches of the loaded batch,
+            # each loss weighted by its share of the batch, then takes one optimizer step
+            micro_batches = split_batch(xa, xv, y, mask, args.micro_batch_size)
+
+            modelWrapper.zero_grad('visual')
+            for xa_m, xv_m, y_m, mask_m, frac in micro_batches:
+                with profiler.phase("visual_fwd"), autocast():
+
+                    preds_v, x_in, rec_pred = modelWrapper.feed_forward(None, xv_m, mode = 'visual', attention_mask=mask_m)
+                    loss_rec_v = utils.MSE_loss(rec_pred, x_in)
+                    total_loss_v = 0.0
+                    if args.label_type == "dimensional":
+                        ccc = utils.CCC_loss(preds_v, y_m)
+                        loss = 1.0-ccc
+                        total_loss_v += loss[0] + loss[1] + loss[2] + loss_rec_v
+
+
+                    elif args.label_type == "categorical":
+                        total_loss_v += utils.CE_category(preds_v, y_m) + 2*loss_rec_v
+
+                with profiler.phase("visual_bwd"):
+                    modelWrapper.accumulate(total_loss_v * frac, 'visual')
+            with profiler.phase("visual_bwd"):
+                modelWrapper.step('visual')
+
+            modelWrapper.zero_grad('acoustic')
+            for xa_m, xv_m, y_m, mask_m, frac in micro_batches:
+                with profiler.phase("acoustic_fwd"), autocast():
+
+                    preds_a, x_in, rec_pred = modelWrapper.feed_forward(xa_m, None, mode = 'acoustic', attention_mask=mask_m)
+                    loss_rec_a = utils.MSE_loss(rec_pred, x_in)
+
+                    total_loss_a = 0.0
+                    if args.label_type == "dimensional":
+                        ccc = utils.CCC_loss(preds_a, y_m)
+                        loss = 1.0-ccc
+                        total_loss_a += loss[0] + loss[1] + loss[2] + loss_rec_a
+
+                    elif args.label_type == "categorical":
+                        total_loss_a += utils.CE_category(preds_a, y_m) + 2*loss_rec_a
+
+                ## Backpropagation
+                with profiler.phase("acoustic_bwd"):
+                    modelWrapper.accumulate(total_loss_a * frac, 'acoustic')
+            with profiler.phase("acoustic_bwd"):
+                modelWrapper.step('acoustic')
+
+            modelWrapper.zero_grad('weights')
+            for xa_m, xv_m, y_m, mask_m, frac in micro_batches:
+                with profiler.phase("weights_fwd"), autocast():
+
+                    preds_a, preds_v, preds = modelWrapper.feed_forward(xa_m, xv_m, mode = 'weights', attention_mask=mask_m)
+                    total_loss = 0.0
+                    if args.label_type == "dimensional":
+                        ccc = utils.CCC_loss(preds, y_m)
+                        loss = 1.0-ccc
+                        total_loss += loss[0] + loss[1] + loss[2]
+
+
+                    elif args.label_type == "categorical":
+                        total_loss += utils.CE_category(preds, y_m)
+
+                        acc = utils.calc_acc(preds, y_m)
+
+                ## Backpropagation
+                with profiler.phase("weights_bwd"):
+                    modelWrapper.accumulate(total_loss * frac, 'weights')
+
+                # Logging
+                with profiler.phase("log"):
+                    batch_num = y_m.size(0)
+                    if args.label_type == "dimensional":
+                        lm.add_torch_stat("train_aro", ccc[0], weight=batch_num)
+                        lm.add_torch_stat("train_dom", ccc[1], weight=batch_num)
+                        lm.add_torch_stat("train_val", ccc[2], weight=batch_num)
+                    elif args.label_type == "categorical":
+                        lm.add_torch_stat("train_loss", total_loss, weight=batch_num)
+                        lm.add_torch_stat("train_acc", acc, weight=batch_num)
+            with profiler.phase("weights_bwd"):
+                modelWrapper.step('weights')
+            profiler.end_step(y.size(0), audio_samples)
+
+        do_eval = (epoch + 1) % args.eval_every == 0 or epoch == epochs - 1
+        improved = False
+        if do_eval:
+            modelWrapper.set_eval()
+            # BatchNorm running stats are updated locally, take rank 0's before evaluating
+            modelWrapper.broadcast_state()
+
+            with torch.no_grad():
+                # dev metrics are accumulated batch by batch, without keeping the predictions
+                ccc_dev = utils.CCCAccumulator()
+                for xy_pair in tqdm(total_dataloader["dev"], disable=not is_main):
+                    xa = xy_pair[0]
+                    xv = xy_pair[1]
+                    y = xy_pair[2]
+                    mask = xy_pair[3]
+
+
+                    xa=xa.to(args.device, non_blocking=True).float()
+                    xv=xv.to(args.device, non_blocking=True).float()
+                    y=y.to(args.device, non_blocking=True).float()
+                    mask=mask.to(args.device, non_blocking=True).float()
+
+
+                    preds_a, preds_v, preds_av = modelWrapper.feed_forward(xa, xv, mode = 'weights', attention_mask=mask)
+
+
+                    if args.label_type == "categorical":
+                        if args.label_learning == "hard-label":
+                            lm.add_torch_stat("dev_loss", utils.CE_category(preds_av, y), weight=y.size(0))
+                        lm.add_torch_stat("dev_acc", utils.calc_acc(preds_av, y), weight=y.size(0))
+                    elif args.label_type == "dimensional":
+                        ccc_dev.update(preds_av, y)
 
-            with autocast():
-
-                preds_a, preds_v, preds = modelWrapper.feed_forward(xa, xv, mode = 'weights', attention_mask=mask)
-                total_loss = 0.0
-                if args.label_type == "dimensional":
-                    ccc = utils.CCC_loss(preds, y)
-                    loss = 1.0-ccc
-                    total_loss += loss[0] + loss[1] + loss[2]
-                
-
-                elif args.label_type == "categorical":
-                    total_loss += utils.CE_category(preds, y)
-                
-                    acc = utils.calc_acc(preds, y)
-
-
-            ## Backpropagation
-            modelWrapper.backprop(total_loss, 'weights')
-
-
-
-
-            # Logging
             if args.label_type == "dimensional":
-                lm.add_torch_stat("train_aro", ccc[0])
-                lm.add_torch_stat("train_dom", ccc[1])
-                lm.add_torch_stat("train_val", ccc[2])
-            elif args.label_type == "categorical":
-                lm.add_torch_stat("train_loss", total_loss)
-                lm.add_torch_stat("train_acc", acc)
-
-        modelWrapper.set_eval()
-
-        with torch.no_grad():
-            total_pred = [] 
-            total_y = []
-            for xy_pair in tqdm(total_dataloader["dev"]):
-                xa = xy_pair[0]
-                xv = xy_pair[1]
-                y = xy_pair[2]
-                mask = xy_pair[3]
-
-            
-                xa=xa.cuda(non_blocking=True).float()
-                xv=xv.cuda(non_blocking=True).float()
-                y=y.cuda(non_blocking=True).float()
-                mask=mask.cuda(non_blocking=True).float()
-
-
-                preds_a, preds_v, preds_av = modelWrapper.feed_forward(xa, xv, mode = 'weights', attention_mask=mask)
-
-
-                total_pred.append(preds_av)
-                total_y.append(y)
-
-            total_pred = torch.cat(total_pred, 0)
-            total_y = torch.cat(total_y, 0)
-
-            total_pred_t, total_pred_a, total_pred_v  = [] , [], []
-            total_y_t = []
-            total_utts = []
-            for xy_pair in tqdm(total_dataloader["test"]):
-                xa = xy_pair[0]
-                xv = xy_pair[1]
-                y = xy_pair[2]
-                mask = xy_pair[3]
-                utt_ids = xy_pair[4]
-
-            
-                xa=xa.cuda(non_blocking=True).float()
-                xv=xv.cuda(non_blocking=True).float()
-                y=y.cuda(non_blocking=True).float()
-                mask=mask.cuda(non_blocking=True).float()
-
-                preds_a, preds_v, preds_av = modelWrapper.feed_forward(xa, xv, mode = 'weights', attention_mask=mask)
-
-
-                total_pred_t.append(preds_av)
-                total_pred_a.append(preds_a)
-                total_pred_v.append(preds_v)    
-                total_y_t.append(y)
-                total_utts.extend(utt_ids)
-
-            total_pred_t = torch.cat(total_pred_t, 0)
-            total_pred_a = torch.cat(total_pred_a, 0)
-            total_pred_v = torch.cat(total_pred_v, 0)
-            total_y_t = torch.cat(total_y_t, 0)
-
-        
-        if args.label_type == "categorical":
-            if args.label_learning == "hard-label":
-                loss = utils.CE_category(total_pred, total_y)
-                loss_t = utils.CE_category(total_pred_t, total_y_t)
-                
-            acc = utils.calc_acc(total_pred, total_y)
-            lm.add_torch_stat("dev_loss", loss)
-            lm.add_torch_stat("dev_acc", acc)
-
-            acc_t = utils.calc_acc(total_pred_t, total_y_t)
-            lm.add_torch_stat("test_loss", loss_t)
-            lm.add_torch_stat("test_acc", acc_t)
-
-        if args.label_type == "dimensional":
-            ccc_dev = utils.CCC_loss(total_pred, total_y)
-            ccc_test = utils.CCC_loss(total_pred_t, total_y_t)
-            ccc_test_a = utils.CCC_loss(total_pred_a, total_y_t)
-            ccc_test_v = utils.CCC_loss(total_pred_v, total_y_t)
-                        
-            lm.add_torch_stat("dev_aro", ccc_dev[0])
-            lm.add_torch_stat("dev_dom", ccc_dev[1])
-            lm.add_torch_stat("dev_val", ccc_dev[2])
-            lm.add_torch_stat("test_aro", ccc_test[0])
-            lm.add_torch_stat("test_dom", ccc_test[1])
-            lm.add_torch_stat("test_val", ccc_test[2])
-            lm.add_torch_stat("test_aro_a", ccc_test_a[0])
-            lm.add_torch_stat("test_dom_a", ccc_test_a[1])
-            lm.add_torch_stat("test_val_a", ccc_test_a[2])
-            lm.add_torch_stat("test_aro_v", ccc_test_v[0])
-            lm.add_torch_stat("test_dom_v", ccc_test_v[1])
-            lm.add_torch_stat("test_val_v", ccc_test_v[2])
+                ccc_dev = ccc_dev.compute()
+                lm.add_torch_stat("dev_aro", ccc_dev[0])
+                lm.add_torch_stat("dev_dom", ccc_dev[1])
+                lm.add_torch_stat("dev_val", ccc_dev[2])
 
+            # With --defer_test the test set is only evaluated for the selected model, after training
+            if not args.defer_test:
+                test_out = evaluate_test(modelWrapper, total_dataloader["test"], args, lm, show_progress=is_main)
 
+        # every process trained on its own shard, dev and test are evaluated in full everywhere
+        lm.all_reduce([stat_type for stat_type in lm.log_book.keys() if stat_type.startswith("train_")])
         lm.print_stat()
-        if args.label_type == "dimensional":
+        if not do_eval:
+            pass
+        elif args.label_type == "dimensional":
             dev_loss = 3.0 - lm.get_stat("dev_aro") - lm.get_stat("dev_dom") - lm.get_stat("dev_val")
             test_loss = 3.0 - lm.get_stat("test_aro") - lm.get_stat("test_dom") - lm.get_stat("test_val")
         elif args.label_type == "categorical":
             dev_loss = lm.get_stat("dev_loss")
             tr_loss = lm.get_stat("train_loss")
             test_loss = lm.get_stat("test_loss")
-            losses_dev.append(dev_loss)
-            losses_train.append(tr_loss)
-            losses_test.append(test_loss)
-        if min_loss > dev_loss:
-            min_epoch = epoch
-            min_loss = dev_loss
-        
-        if float(dev_loss) < float(temp_dev):
-            temp_dev = float(dev_loss)
-            print('better dev loss found:' + str(float(dev_loss)) + ' saving model')
-            modelWrapper.save_model(epoch)
-
-            total_pred_np = total_pred_t.detach().cpu().numpy()
-            total_pred_np_a = total_pred_a.detach().cpu().numpy()
-            total_pred_np_v = total_pred_v.detach().cpu().numpy()
-            total_y_np = total_y_t.detach().cpu().numpy()
-
-            total_pred_pd = pd.DataFrame(total_pred_np, index=total_utts)
-            total_pred_pd_a = pd.DataFrame(total_pred_np_a, index=total_utts)
-            total_pred_pd_v = pd.DataFrame(total_pred_np_v, index=total_utts)
-            total_y_pd = pd.DataFrame(total_y_np, index=total_utts)
-
-            
-            for mode in ['acoustic', 'visual', 'audiovisual']:
-                save_path = model_path + '/predictions/test/' + mode + '/'
-
-                if not os.path.exists(save_path):
-                    os.makedirs(save_path)
-                
-                if mode == 'acoustic':
-                    total_pred_pd_a.to_csv(save_path+'y_pred.csv')
-                    total_y_pd.to_csv(save_path+'y_true.csv')  
-
-                elif mode == 'visual':
-                    total_pred_pd_v.to_csv(save_path+'y_pred.csv')
-                    total_y_pd.to_csv(save_path+'y_true.csv')  
-                
-                elif mode == 'audiovisual':
-                    total_pred_pd.to_csv(save_path+'y_pred.csv')
-                    total_y_pd.to_csv(save_path+'y_true.csv') 
-                       
-                if args.label_type == "categorical":
-                    print("This is mode:", mode)
-                    utils.scores(save_path)
+            # plain floats, the checkpoints are loaded with weights_only
+            losses_dev.append(float(dev_loss))
+            losses_train.append(float(tr_loss))
+            if not args.defer_test:
+                losses_test.append(float(test_loss))
+        if do_eval:
+            # every process follows rank 0's model selection and stopping decisions
+            dev_loss = utils.broadcast_object(dev_loss)
+            if min_loss > dev_loss:
+                min_epoch = epoch
+                min_loss = float(dev_loss)
+
+            if float(dev_loss) < float(temp_dev):
+                improved = True
+                temp_dev = float(dev_loss)
+                print('better dev loss found:' + str(float(dev_loss)) + ' saving model')
+                if is_main:
+                    modelWrapper.save_model(epoch, writer=ckpt_manager.writer)
+
+                best_result = {"epoch": epoch, "dev_loss": float(dev_loss)}
+                if not args.defer_test:
+                    best_result.update(report_test(test_out, args, lm, model_path, pred_writer if is_main else None))
+                    best_result["test_loss"] = float(test_loss)
+
+            if improved:
+                epochs_no_improve = 0
+            else:
+                epochs_no_improve += 1
+        stop = args.patience > 0 and epochs_no_improve >= args.patience
+        if stop:
+            print("No dev improvement in", epochs_no_improve, "evaluations, stopping early")
+
+        if is_main and ((epoch + 1) % args.ckpt_interval == 0 or epoch == epochs - 1 or stop):
+            # Data loaders iterate without shuffling, so the epoch index fully determines the sampler position
+            ckpt_manager.save({
+                "epoch": epoch,
+                "model": modelWrapper.get_train_state(),
+                "min_epoch": min_epoch,
+                "min_loss": float(min_loss),
+                "temp_dev": temp_dev,
+                "epochs_no_improve": epochs_no_improve,
+                "losses_train": losses_train,
+                "losses_dev": losses_dev,
+                "losses_test": losses_test,
+                "best_result": best_result,
+                "rng": utils.get_rng_state(),
+            }, epoch)
+        if stop:
+            break
+    ckpt_manager.close()
+    profiler.close()
+
+    if args.defer_test and "epoch" in best_result:
+        # the selected heads were just written by save_model
+        utils.barrier()
+        print("Evaluating test set with the model of epoch", best_result["epoch"])
+        modelWrapper.load_model(model_path, 'test')
+        modelWrapper.set_eval()
+        lm.init_stat()
+        test_out = evaluate_test(modelWrapper, total_dataloader["test"], args, lm, show_progress=is_main)
+        lm.print_stat()
+        if args.label_type == "dimensional":
+            best_result["test_loss"] = float(3.0 - lm.get_stat("test_aro") - lm.get_stat("test_dom") - lm.get_stat("test_val"))
+        elif args.label_type == "categorical":
+            best_result["test_loss"] = float(lm.get_stat("test_loss"))
+            losses_test.append(best_result["test_loss"])
+        best_result.update(report_test(test_out, args, lm, model_path, pred_writer if is_main else None))
+    pred_writer.close()
     print("Save",end=" ")
     print(min_epoch, end=" ")
     print("")
 
-    with open(model_path+'/train_loss.txt', 'w') as f:
-        for item in losses_train:
-            f.write("%s\n" % item)
-    
-    with open(model_path+'/dev_loss.txt', 'w') as f:
-        for item in losses_dev:
-            f.write("%s\n" % item)
-    
-    with open(model_path+'/test_loss.txt', 'w') as f:
-        for item in losses_test:
-            f.write("%s\n" % item)
+    if is_main:
+        with open(model_path+'/train_loss.txt', 'w') as f:
+            for item in losses_train:
+                f.write("%s\n" % item)
+
+        with open(model_path+'/dev_loss.txt', 'w') as f:
+            for item in losses_dev:
+                f.write("%s\n" % item)
+
+        with open(model_path+'/test_loss.txt', 'w') as f:
+            for item in losses_test:
+                f.write("%s\n" % item)
+
+        utils.atomic_write_text(json.dumps({
+            "corpus": args.corpus,
+            "partition_number": args.partition_number,
+            "seed": args.seed,
+            "label_type": args.label_type,
+            "best": best_result,
+        }, indent=4), model_path+'/results.json')
 
-    
     print("Loss",end=" ")
     if args.label_type == "dimensional":
         print(3.0-min_loss, end=" ")
@@ -376,6 +529,8 @@ def main(args):
         print(min_loss, end=" ")
     print("")
 
+    utils.cleanup_distributed()
+
 
 if __name__ == "__main__":
     # Inputs for the main function
@@ -404,7 +559,11 @@ if __name__ == "__main__":
     parser.add_argument(
         '--model_type',
         default="wav2vec2",
-        type=str)
+        type=str,
+        help='audio encoder: wav2vec2(-large-robust), wav2vec2-large, wav2vec2-base, distilhubert or log-mel')
+    parser.add_argument(
+        '--wav2vec_path', type=str, default=None,
+        help='directory of a fine-tuned final_wav2vec.pt for the audio encoder (default: pretrained weights)')
     parser.add_argument(
         '--label_type',
         choices=['dimensional', 'categorical'],
@@ -481,6 +640,46 @@ if __name__ == "__main__":
         '--optim', type = str, default = 'Adam',
         help='optimizer to use (default: Adam)')
 
+    # Checkpoint Arguments
+    parser.add_argument(
+        '--ckpt_interval', type=int, default=1,
+        help='save a resumable checkpoint every N epochs (default: 1)')
+    parser.add_argument(
+        '--keep_ckpt', type=int, default=2,
+        help='number of resumable checkpoints to keep (default: 2)')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='resume from the latest checkpoint in <model_path>/checkpoints')
+    parser.add_argument(
+        '--micro_batch_size', type=int, default=None,
+        help='split each batch into micro-batches of this size and accumulate their gradients '
+            '(default: no split). Not bit-identical to full batches: the Conformers and BatchNorm '
+            'see each micro-batch separately and the CCC loss is not additive')
+    parser.add_argument(
+        '--eval_every', type=int, default=1,
+        help='evaluate on dev (and test) every N epochs; the last epoch is always evaluated (default: 1)')
+    parser.add_argument(
+        '--patience', type=int, default=0,
+        help='stop after this many evaluations without dev improvement (default: 0, never stop early)')
+    parser.add_argument(
+        '--defer_test', action='store_true',
+        help='skip per-epoch test evaluation and only evaluate the selected model after training')
+    parser.add_argument(
+        '--profile_path', type=str, default=None,
+        help='write per-step phase timings, throughput and peak memory as JSON lines to this file')
+    parser.add_argument(
+        '--profile_trace_dir', type=str, default=None,
+        help='also capture a torch.profiler trace into this directory (requires --profile_path)')
+    parser.add_argument(
+        '--profile_trace_start', type=int, default=10,
+        help='first training step of the torch.profiler trace (default: 10)')
+    parser.add_argument(
+        '--profile_trace_steps', type=int, default=5,
+        help='number of traced steps (default: 5)')
+    parser.add_argument(
+        '--corpus_cache', type=str, default=None,
+        help='directory of the decoded corpus shared between runs (built on first use)')
+
     args = parser.parse_args()
 
     # Call main function
@@ -0,0 +1,171 @@
+# -*- coding: UTF-8 -*-
+# Local modules
+import os
+import sys
+import copy
+import argparse
+# 3rd-Party Modules
+import numpy as np
+
+# PyTorch Modules
+import torch
+import torch.optim as optim
+# Self-Written Modules
+sys.path.append(os.getcwd())
+import utils
+from net import avmodel
+
+
+head_files = {
+    "fusion": "final_weights_head.pt",
+    "mlp_a": "MLP_a_head.pt",
+    "mlp_v": "MLP_v_head.pt",
+}
+
+
+def load_split(embedding_path, split_type, device):
+    store = utils.EmbeddingStore(os.path.join(embedding_path, split_type))
+    data = {name: torch.from_numpy(np.array(store[name])).to(device) for name in ["rep_a", "rep_v", "label"]}
+    return data, store.utts
+
+
+def forward_head(head, head_type, rep_a, rep_v):
+    if head_type == "fusion":
+        return head(rep_a, rep_v)
+    elif head_type == "mlp_a":
+        return head(rep_a)
+    elif head_type == "mlp_v":
+        return head(rep_v)
+
+
+def calc_loss(pred, y, label_type):
+    if label_type == "dimensional":
+        ccc = utils.CCC_loss(pred, y)
+        return 3.0 - ccc.sum(), ccc
+    elif label_type == "categorical":
+        return utils.CE_category(pred, y), utils.calc_acc(pred, y)
+
+
+def evaluate(head, args, data):
+    head.eval()
+    with torch.no_grad():
+        pred = forward_head(head, args.head, data["rep_a"], data["rep_v"])
+        loss, stat = calc_loss(pred, data["label"], args.label_type)
+    return loss.item(), stat
+
+
+def print_result(split_type, loss, stat, label_type):
+    if label_type == "dimensional":
+        print(split_type, "aro :", np.round(stat[0].item(), 4), "/ dom :", np.round(stat[1].item(), 4),
+            "/ val :", np.round(stat[2].item(), 4))
+    elif label_type == "categorical":
+        print(split_type, "loss :", np.round(loss, 4), "/ acc :", np.round(stat.item(), 4))
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    embedding_path = args.embedding_path or os.path.join(args.model_path, "embeddings")
+    train_data, _ = load_split(embedding_path, "train", args.device)
+    dev_data, _ = load_split(embedding_path, "dev", args.device)
+
+    if args.head == "fusion":
+        head = avmodel.MultitaskFusion(args)
+    else:
+        head = avmodel.MLP(args)
+    head.to(args.device)
+    opt = optim.Adam(head.parameters(), lr=args.lr, weight_decay=5e-7, betas=(0.95, 0.999))
+
+    num_train = train_data["label"].size(0)
+    best_loss = float("inf")
+    best_state = copy.deepcopy(head.state_dict())
+    best_epoch = 0
+    for epoch in range(args.epochs):
+        head.train()
+        perm = torch.randperm(num_train, device=args.device)
+        for sidx in range(0, num_train, args.batch_size):
+            idx = perm[sidx:sidx+args.batch_size]
+            pred = forward_head(head, args.head, train_data["rep_a"][idx], train_data["rep_v"][idx])
+            loss, _ = calc_loss(pred, train_data["label"][idx], args.label_type)
+            opt.zero_grad(set_to_none=True)
+            loss.backward()
+            opt.step()
+
+        dev_loss, _ = evaluate(head, args, dev_data)
+        if dev_loss < best_loss:
+            best_loss = dev_loss
+            best_epoch = epoch
+            best_state = copy.deepcopy(head.state_dict())
+
+    head.load_state_dict(best_state)
+    print("Best epoch:", best_epoch)
+    for split_type in ["train", "dev", "test"]:
+        if not os.path.isdir(os.path.join(embedding_path, split_type)):
+            continue
+        data, _ = load_split(embedding_path, split_type, args.device)
+        loss, stat = evaluate(head, args, data)
+        print_result(split_type, loss, stat, args.label_type)
+
+    output_path = args.output_path or os.path.join(args.model_path, "fusion_heads")
+    os.makedirs(output_path, exist_ok=True)
+    torch.save(head.state_dict(), os.path.join(output_path, head_files[args.head]))
+
+
+if __name__ == "__main__":
+    # Inputs for the main function
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--device',
+        choices=['cuda', 'cpu'],
+        default='cpu',
+        type=str)
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int)
+    parser.add_argument(
+        '--model_path',
+        default=None,
+        type=str)
+    parser.add_argument(
+        '--embedding_path', type=str, default=None,
+        help='exported embeddings (default: <model_path>/embeddings)')
+    parser.add_argument(
+        '--output_path', type=str, default=None,
+        help='where to save the trained head (default: <model_path>/fusion_heads)')
+    parser.add_argument(
+        '--head',
+        choices=list(head_files.keys()),
+        default='fusion',
+        type=str)
+    parser.add_argument(
+        '--label_type',
+        choices=['dimensional', 'categorical'],
+        default='categorical',
+        type=str)
+    parser.add_argument(
+        '--output_num',
+        default=4,
+        type=int)
+    parser.add_argument(
+        '--batch_size',
+        default=32,
+        type=int)
+    parser.add_argument(
+        '--epochs',
+        default=100,
+        type=int)
+    parser.add_argument(
+        '--lr',
+        default=5e-5,
+        type=float)
+    parser.add_argument(
+        '--out_dropout', type=float, default=0.2,
+        help='output layer dropout (default: 0.2')
+
+    args = parser.parse_args()
+
+    # Call main function
+    main(args)
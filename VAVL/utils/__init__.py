@@ -1,8 +1,17 @@
 from .utterance import *
 from .loss_manager import *
+from .metrics import *
 from .etc import *
 from .data_manager import *
 from .extractor import *
 from .normalizer import *
 from .dataset import *
+from .cache import *
+from .embedding_store import *
+from .async_io import *
+from .checkpoint import *
+from .prediction_writer import *
+from .corpus_cache import *
+from .distributed import *
+from .profiler import *
 from .loss_manager import *
\ No newline at end of file
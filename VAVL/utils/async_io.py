@@ -0,0 +1,73 @@
+import os
+import queue
+import threading
+
+import torch
+
+
+class AsyncWriter:
+    """
+    Runs write jobs on a single background thread, in submission order.
+    Errors raised by a job are re-raised on the next submit/flush/close.
+    """
+    def __init__(self, max_pending=2):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            fn, args, kwargs = job
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def submit(self, fn, *args, **kwargs):
+        self._check_error()
+        self.jobs.put((fn, args, kwargs))
+
+    def flush(self):
+        self.jobs.join()
+        self._check_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.jobs.join()
+            self.jobs.put(None)
+            self.thread.join()
+        self._check_error()
+
+
+def atomic_torch_save(obj, path):
+    """
+    torch.save to a temporary file and rename it over path
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_write_text(text, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,151 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+def feature_hash(*feats):
+    """
+    Content hash of one utterance's input features (wav, vid, ...)
+    """
+    h = hashlib.sha1()
+    for feat in feats:
+        feat = np.ascontiguousarray(feat)
+        h.update(str(feat.dtype).encode())
+        h.update(str(feat.shape).encode())
+        h.update(feat.tobytes())
+    return h.hexdigest()
+
+
+def batch_hash(feat_hashes):
+    """
+    Hash of the ordered feature hashes of the utterances batched together
+    """
+    return hashlib.sha1("|".join(feat_hashes).encode()).hexdigest()
+
+
+def state_dict_hash(state_dicts):
+    """
+    Content hash of a list of state dicts (parameters and buffers)
+    """
+    h = hashlib.sha1()
+    for state_dict in state_dicts:
+        for name, tensor in state_dict.items():
+            h.update(name.encode())
+            arr = tensor.detach().cpu().contiguous().numpy()
+            h.update(str(arr.dtype).encode())
+            h.update(str(arr.shape).encode())
+            h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+class PredictionCache:
+    """
+    Per-utterance cache of model outputs keyed by (checkpoint hash, feature hash, mode).
+    Entries are dicts of numpy arrays (e.g. preds_a, preds_v, preds).
+
+    max_items bounds the in-memory LRU. If cache_dir is given, entries are also
+    written there as .npz files and looked up on a memory miss; max_disk_bytes
+    bounds the directory size by evicting the least recently used files.
+    """
+    def __init__(self, max_items=100000, cache_dir=None, max_disk_bytes=None):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.mem = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.disk_index = OrderedDict()
+        self.disk_bytes = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entries = []
+            for fname in os.listdir(self.cache_dir):
+                if not fname.endswith(".npz") or fname.endswith(".tmp.npz"):
+                    continue
+                stat = os.stat(os.path.join(self.cache_dir, fname))
+                entries.append((stat.st_mtime, fname[:-4], stat.st_size))
+            for _, digest, size in sorted(entries):
+                self.disk_index[digest] = size
+                self.disk_bytes += size
+
+    @staticmethod
+    def make_key(ckpt_hash, feat_hash, mode):
+        return hashlib.sha1("|".join([ckpt_hash, feat_hash, mode]).encode()).hexdigest()
+
+    @staticmethod
+    def batch_keys(ckpt_hash, feat_hashes, mode):
+        """
+        Keys of the utterances of one batch, for outputs that depend on the whole batch:
+        every key covers the ordered batch contents and the position of the utterance in it
+        """
+        batch_mode = "%s/%s" % (mode, batch_hash(feat_hashes))
+        return [PredictionCache.make_key(ckpt_hash, feat_hash, "%s/%d" % (batch_mode, pos))
+                for pos, feat_hash in enumerate(feat_hashes)]
+
+    def _disk_path(self, digest):
+        return os.path.join(self.cache_dir, digest + ".npz")
+
+    def _put_mem(self, digest, value):
+        self.mem[digest] = value
+        self.mem.move_to_end(digest)
+        while len(self.mem) > self.max_items:
+            self.mem.popitem(last=False)
+
+    def get(self, key):
+        if key in self.mem:
+            self.mem.move_to_end(key)
+            self.hits += 1
+            return self.mem[key]
+        if key in self.disk_index:
+            path = self._disk_path(key)
+            try:
+                with np.load(path) as data:
+                    value = {name: data[name] for name in data.files}
+            except (OSError, ValueError):
+                self.disk_bytes -= self.disk_index.pop(key)
+                self.misses += 1
+                return None
+            os.utime(path)
+            self.disk_index.move_to_end(key)
+            self._put_mem(key, value)
+            self.hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        value = {name: np.asarray(arr) for name, arr in value.items()}
+        self._put_mem(key, value)
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **value)
+        os.replace(tmp_path, path)
+        if key in self.disk_index:
+            self.disk_bytes -= self.disk_index.pop(key)
+        size = os.path.getsize(path)
+        self.disk_index[key] = size
+        self.disk_bytes += size
+        if self.max_disk_bytes is not None:
+            while self.disk_bytes > self.max_disk_bytes and len(self.disk_index) > 1:
+                old_key, old_size = self.disk_index.popitem(last=False)
+                self.disk_bytes -= old_size
+                try:
+                    os.remove(self._disk_path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def __contains__(self, key):
+        return key in self.mem or key in self.disk_index
+
+    def __len__(self):
+        return len(set(self.mem.keys()) | set(self.disk_index.keys()))
+
+    def print_stat(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total > 0 else 0.0
+        print("Prediction cache: %d hits / %d lookups (%.1f%%)" % (self.hits, total, 100*rate))
@@ -0,0 +1,111 @@
+import os
+import random
+
+import numpy as np
+import torch
+
+from .async_io import AsyncWriter, atomic_torch_save, atomic_write_text
+
+
+def get_rng_state():
+    """
+    RNG states of python, numpy and torch, stored with tensors and plain types only
+    """
+    np_state = np.random.get_state()
+    py_state = random.getstate()
+    state = {
+        "python": [py_state[0], list(py_state[1]), py_state[2]],
+        "numpy": {
+            "key": np_state[0],
+            "keys": torch.from_numpy(np_state[1].astype(np.int64)),
+            "pos": int(np_state[2]),
+            "has_gauss": int(np_state[3]),
+            "cached_gaussian": float(np_state[4]),
+        },
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    py_state = state["python"]
+    random.setstate((py_state[0], tuple(py_state[1]), py_state[2]))
+    np_state = state["numpy"]
+    np.random.set_state((np_state["key"], np_state["keys"].numpy().astype(np.uint32),
+        np_state["pos"], np_state["has_gauss"], np_state["cached_gaussian"]))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def to_cpu(obj):
+    """
+    Detached CPU copy of every tensor in a nested dict/list structure. NumPy scalars
+    become Python numbers, which torch.load(weights_only=True) can read back.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointManager:
+    """
+    Periodic resumable checkpoints under ckpt_dir.
+
+    save() takes a CPU snapshot of the state on the calling thread and hands the
+    serialisation to a background thread. Files are written atomically and the
+    'latest' pointer is only updated once the file is complete, so a job killed
+    mid-write resumes from the previous checkpoint. Only the last `keep` files
+    are kept.
+    """
+    def __init__(self, ckpt_dir, keep=2, async_write=True):
+        self.ckpt_dir = ckpt_dir
+        self.keep = keep
+        os.makedirs(self.ckpt_dir, exist_ok=True)
+        self.writer = AsyncWriter() if async_write else None
+
+    @property
+    def latest_path(self):
+        return os.path.join(self.ckpt_dir, "latest")
+
+    def _write(self, state, fname):
+        atomic_torch_save(state, os.path.join(self.ckpt_dir, fname))
+        atomic_write_text(fname, self.latest_path)
+        ckpt_list = sorted(f for f in os.listdir(self.ckpt_dir) if f.startswith("checkpoint_") and f.endswith(".pt"))
+        for old in ckpt_list[:-self.keep]:
+            os.remove(os.path.join(self.ckpt_dir, old))
+
+    def save(self, state, epoch):
+        state = to_cpu(state)
+        fname = "checkpoint_%04d.pt" % epoch
+        if self.writer is None:
+            self._write(state, fname)
+        else:
+            self.writer.submit(self._write, state, fname)
+
+    def latest(self):
+        if not os.path.isfile(self.latest_path):
+            return None
+        with open(self.latest_path, 'r') as f:
+            fname = f.read().strip()
+        path = os.path.join(self.ckpt_dir, fname)
+        return path if os.path.isfile(path) else None
+
+    def load(self, path=None, map_location='cpu'):
+        path = path or self.latest()
+        if path is None:
+            return None
+        print("Resuming from checkpoint", path)
+        return torch.load(path, map_location=map_location)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,127 @@
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+from .extractor import WavExtractor, VidExtractor
+
+
+class CorpusCache:
+    """
+    Decoded corpus (16kHz waveforms and face features of every utterance),
+    stored once as flat float32 files and memory-mapped read-only, so that
+    concurrent runs on different partitions/seeds share the same pages instead
+    of decoding the corpus again.
+
+    Layout:
+        meta.json        - number of utterances and face feature dimension
+        utts.txt         - utterance ids (wav file names), one per line
+        wav.f32          - all waveforms, concatenated
+        vid.f32          - all face feature frames, concatenated (frames, vid_dim)
+        wav_offsets.npy  - (num_utts + 1,) sample offsets into wav.f32
+        vid_offsets.npy  - (num_utts + 1,) frame offsets into vid.f32
+        vid_fps.npy      - (num_utts,) face feature frame rates, NaN where unknown
+        vid_frame_index.npy - (frames,) frame of every face feature row, -1 for utterances where it is unknown
+        norm_stat/       - train-split normalisation statistics, keyed by utterance list
+    """
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, "meta.json"), 'r') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(root, "utts.txt"), 'r') as f:
+            self.utts = [line.rstrip("\n") for line in f]
+        self.index = {utt: idx for idx, utt in enumerate(self.utts)}
+        self.wav_offsets = np.load(os.path.join(root, "wav_offsets.npy"))
+        self.vid_offsets = np.load(os.path.join(root, "vid_offsets.npy"))
+        self.wav_data = np.memmap(os.path.join(root, "wav.f32"), dtype=np.float32, mode='r')
+        self.vid_data = np.memmap(os.path.join(root, "vid.f32"), dtype=np.float32, mode='r').reshape(-1, self.meta["vid_dim"])
+        # caches built before the frame rates were recorded have no vid_fps.npy
+        fps_path = os.path.join(root, "vid_fps.npy")
+        self.vid_fps = np.load(fps_path) if os.path.isfile(fps_path) else np.full(len(self.utts), np.nan)
+        frame_index_path = os.path.join(root, "vid_frame_index.npy")
+        self.vid_frame_index = np.load(frame_index_path, mmap_mode='r') if os.path.isfile(frame_index_path) \
+            else np.full(len(self.vid_data), -1, dtype=np.int64)
+
+    @staticmethod
+    def exists(root):
+        return os.path.isfile(os.path.join(root, "meta.json"))
+
+    @classmethod
+    def build(cls, root, audio_path, video_path, fnames_aud, fnames_vid, chunk_size=512):
+        """
+        Decode every matched utterance into root. The files are written to a
+        temporary directory first, so a partially built cache is never used.
+        """
+        tmp_root = root.rstrip("/") + ".tmp"
+        shutil.rmtree(tmp_root, ignore_errors=True)
+        os.makedirs(tmp_root)
+        wav_offsets, vid_offsets = [0], [0]
+        vid_fps, vid_frame_index = [], []
+        vid_dim = None
+        with open(os.path.join(tmp_root, "wav.f32"), 'wb') as wav_f, open(os.path.join(tmp_root, "vid.f32"), 'wb') as vid_f:
+            for sidx in range(0, len(fnames_aud), chunk_size):
+                wav_paths = [os.path.join(audio_path, fname) for fname in fnames_aud[sidx:sidx+chunk_size]]
+                vid_paths = [os.path.join(video_path, fname) for fname in fnames_vid[sidx:sidx+chunk_size]]
+                vid_extractor = VidExtractor(vid_paths)
+                for wav, vid in zip(WavExtractor(wav_paths).extract(), vid_extractor.extract()):
+                    wav = np.ascontiguousarray(wav, dtype=np.float32)
+                    vid = np.ascontiguousarray(vid, dtype=np.float32)
+                    vid_dim = vid.shape[1] if vid_dim is None else vid_dim
+                    assert vid.shape[1] == vid_dim, "Face features of different dimensions"
+                    wav_f.write(wav.tobytes())
+                    vid_f.write(vid.tobytes())
+                    wav_offsets.append(wav_offsets[-1] + len(wav))
+                    vid_offsets.append(vid_offsets[-1] + len(vid))
+                vid_fps += [np.nan if fps is None else fps for fps in vid_extractor.fps_list]
+                vid_frame_index += [np.full(vid_offsets[sidx + i + 1] - vid_offsets[sidx + i], -1, dtype=np.int64)
+                                    if frame_index is None else frame_index
+                                    for i, frame_index in enumerate(vid_extractor.frame_index_list)]
+        np.save(os.path.join(tmp_root, "wav_offsets.npy"), np.array(wav_offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_root, "vid_offsets.npy"), np.array(vid_offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_root, "vid_fps.npy"), np.array(vid_fps, dtype=np.float64))
+        np.save(os.path.join(tmp_root, "vid_frame_index.npy"),
+            np.concatenate(vid_frame_index) if len(vid_frame_index) > 0 else np.zeros(0, dtype=np.int64))
+        with open(os.path.join(tmp_root, "utts.txt"), 'w') as f:
+            for utt in fnames_aud:
+                f.write(utt + "\n")
+        with open(os.path.join(tmp_root, "meta.json"), 'w') as f:
+            json.dump({"num_utts": len(fnames_aud), "vid_dim": int(vid_dim or 0),
+                "audio_path": audio_path, "video_path": video_path}, f, indent=4)
+        shutil.rmtree(root, ignore_errors=True)
+        os.replace(tmp_root, root)
+        return cls(root)
+
+    def get_wav(self, utt):
+        idx = self.index[utt]
+        return self.wav_data[self.wav_offsets[idx]:self.wav_offsets[idx+1]]
+
+    def get_vid(self, utt):
+        idx = self.index[utt]
+        return self.vid_data[self.vid_offsets[idx]:self.vid_offsets[idx+1]]
+
+    def get_split(self, utts):
+        return [self.get_wav(utt) for utt in utts], [self.get_vid(utt) for utt in utts]
+
+    def get_fps(self, utts):
+        fps_list = [self.vid_fps[self.index[utt]] for utt in utts]
+        return [None if np.isnan(fps) else float(fps) for fps in fps_list]
+
+    def get_frame_index(self, utts):
+        frame_index_list = []
+        for utt in utts:
+            idx = self.index[utt]
+            frame_index = self.vid_frame_index[self.vid_offsets[idx]:self.vid_offsets[idx+1]]
+            frame_index_list.append(None if len(frame_index) == 0 or frame_index[0] < 0 else frame_index)
+        return frame_index_list
+
+    def norm_stat_path(self, utts):
+        """
+        Shared location for the normalisation statistics of a train split
+        """
+        key = hashlib.sha1("\n".join(sorted(utts)).encode()).hexdigest()
+        return os.path.join(self.root, "norm_stat", key + ".pkl")
+
+    def __len__(self):
+        return len(self.utts)
@@ -4,6 +4,7 @@ import glob
 import json
 import numpy as np
 from . import utterance
+from .extractor import WavExtractor, VidExtractor
 
 """
 All DataManager classes should follow the following interface:
@@ -26,6 +27,20 @@ def load_env(env_path):
         env_dict = json.load(f)
     return env_dict
 
+def get_matched_fnames(audio_path, video_path):
+    """
+    Utterances that have both a wav file and a face feature file
+    """
+    fnames_aud, fnames_vid = [], []
+    v_fnames = os.listdir(video_path)
+    for fname_aud in os.listdir(audio_path):
+        if fname_aud.replace('.wav','.npy') in v_fnames:
+            fnames_aud.append(fname_aud)
+            fnames_vid.append(fname_aud.replace('.wav',''))
+    fnames_aud.sort()
+    fnames_vid.sort()
+    return fnames_aud, fnames_vid
+
 class DataManager:
     def __load_env__(self, env_path):
         with open(env_path, 'r') as f:
@@ -35,6 +50,9 @@ class DataManager:
     def __init__(self, env_path):
         self.env_dict=self.__load_env__(env_path)
         self.msp_label_dict = None
+        # frame rate of the face features of every loaded utterance, and the frame of every feature row
+        self.vid_fps = dict()
+        self.vid_frame_index = dict()
 
     def get_wav_path(self, split_type=None, wav_loc=None, fnames =[], lbl_loc=None , *args, **kwargs):
         wav_root = wav_loc
@@ -129,6 +147,40 @@ class DataManager:
             self.__load_msp_dim_label_dict__(lbl_loc)
         return np.array([self.msp_label_dict[utt_id] for utt_id in utt_list])
 
+    def get_split_data(self, split_type, audio_path, video_path, label_path, fnames_aud, fnames_vid, lab_type, corpus_cache=None):
+        """
+        Returns (wavs, vids, labs, utts) of a data split
+        With a CorpusCache, wavs and vids are read-only views into the cache instead of freshly decoded arrays.
+        """
+        wav_path = self.get_wav_path(split_type=split_type, wav_loc=audio_path, fnames=fnames_aud, lbl_loc=label_path)
+        vid_path = self.get_vid_path(split_type=split_type, vid_loc=video_path, fnames=fnames_vid, lbl_loc=label_path)
+
+        utts = [fname.split('/')[-1] for fname in wav_path]
+        labs = self.get_msp_labels(utts, lab_type=lab_type, lbl_loc=label_path)
+        if corpus_cache is not None:
+            wavs, vids = corpus_cache.get_split(utts)
+            self.vid_fps.update(zip(utts, corpus_cache.get_fps(utts)))
+            self.vid_frame_index.update(zip(utts, corpus_cache.get_frame_index(utts)))
+            return wavs, vids, labs, utts
+        wavs = WavExtractor(wav_path).extract()
+        vid_extractor = VidExtractor(vid_path)
+        vids = vid_extractor.extract()
+        self.vid_fps.update(zip(utts, vid_extractor.fps_list))
+        self.vid_frame_index.update(zip(utts, vid_extractor.frame_index_list))
+        return wavs, vids, labs, utts
+
+    def get_vid_fps(self, utt_list):
+        """
+        Face feature frame rates of utterances loaded by get_split_data (None where unknown), for AudVidSet
+        """
+        return [self.vid_fps.get(utt_id, None) for utt_id in utt_list]
+
+    def get_vid_frame_index(self, utt_list):
+        """
+        Frame of every face feature row of utterances loaded by get_split_data (None where unknown), for AudVidSet
+        """
+        return [self.vid_frame_index.get(utt_id, None) for utt_id in utt_list]
+
     def get_categorical_emo_class(self):
         return self.env_dict["categorical"]["emo_type"]
     def get_categorical_emo_num(self):
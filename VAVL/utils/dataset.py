@@ -40,6 +40,11 @@ class AudVidSet(torch_utils.data.Dataset):
         self.vid_std = kwargs.get("vid_std", None)
 
         self.label_config = kwargs.get("label_config", None)
+        # frame rate of the face features: one value, one per utterance, or None (unknown, no alignment)
+        self.vid_fps = kwargs.get("vid_fps", None)
+        # frame of every face feature row, one array (None if unknown, no alignment) per utterance;
+        # without it every row is one frame
+        self.vid_frame_index = kwargs.get("vid_frame_index", None)
 
         ## Assertion
         if self.lab_type == "categorical":
@@ -71,13 +76,22 @@ class AudVidSet(torch_utils.data.Dataset):
         cur_wav = (cur_wav - self.wav_mean) / (self.wav_std+0.000001)
         
         cur_vid = self.vid_list[idx]
+        vid_fps = self.vid_fps[idx] if isinstance(self.vid_fps, (list, tuple, np.ndarray)) else self.vid_fps
+        if vid_fps:
+            # keep the face rows of the frames in the (possibly truncated) audio span
+            num_frames = int(np.ceil(cur_dur / 16000 * vid_fps))
+            if self.vid_frame_index is None:
+                cur_vid = cur_vid[:max(1, num_frames)]
+            elif self.vid_frame_index[idx] is not None:
+                num_rows = int(np.searchsorted(self.vid_frame_index[idx], num_frames, side='left'))
+                cur_vid = cur_vid[:max(1, num_rows)]
         # print(np.shape(cur_vid))
         cur_vid = (cur_vid - self.vid_mean) / (self.vid_std+0.000001)
 
 
 
         if self.lab_type == "dimensional":
-            cur_lab = self.lab_list[idx]
+            cur_lab = np.array(self.lab_list[idx])
             if self.flip_aro:
                 cur_lab[0] = 6 - (cur_lab[0])
             cur_lab = (cur_lab - self.min_lab_score) / (self.max_lab_score-self.min_lab_score)
@@ -130,4 +144,9 @@ def collate_fn_padd(batch):
         attention_mask[data_idx,:dur] = 1
     ## compute mask
     
-    return total_wav, total_vid, total_lab, attention_mask, total_utt
\ No newline at end of file
+    return total_wav, total_vid, total_lab, attention_mask, total_utt
+
+def load_norm_stat(norm_stat_file):
+    with open(norm_stat_file, 'rb') as f:
+        wav_mean, wav_std, vid_mean, vid_std = pk.load(f)
+    return wav_mean, wav_std, vid_mean, vid_std
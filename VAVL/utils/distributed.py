@@ -0,0 +1,131 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+"""
+Multi-process training helpers. Processes are started by torchrun, which sets
+RANK, LOCAL_RANK and WORLD_SIZE (plus MASTER_ADDR/MASTER_PORT), e.g.
+
+    torchrun --nproc_per_node 4 train.py ...
+    torchrun --nnodes 2 --node_rank 0 --master_addr <host> --nproc_per_node 4 train.py ...
+
+Without those variables everything below falls back to a single process.
+"""
+
+
+def init_distributed(device='cuda', backend=None):
+    """
+    Join the process group if launched with WORLD_SIZE > 1.
+    Returns the device this process should use ('cuda:<local_rank>' or 'cpu').
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size <= 1 or is_distributed():
+        return device
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if device == 'cuda':
+        torch.cuda.set_device(local_rank)
+        device = 'cuda:%d' % local_rank
+    if backend is None:
+        backend = 'nccl' if device.startswith('cuda') else 'gloo'
+    dist.init_process_group(backend=backend)
+    return device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def broadcast_object(obj, src=0):
+    """
+    Value of obj on rank src, on every process
+    """
+    if not is_distributed():
+        return obj
+    obj_list = [obj]
+    dist.broadcast_object_list(obj_list, src=src)
+    return obj_list[0]
+
+
+def all_reduce_sum(values):
+    """
+    Element-wise sums of a list of floats over all processes
+    """
+    if not is_distributed():
+        return list(values)
+    device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else 'cpu'
+    buf = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(buf)
+    return buf.cpu().tolist()
+
+
+def all_reduce_grads(params):
+    """
+    Average the gradients of params over all processes, one flat buffer per dtype/device
+    """
+    if not is_distributed():
+        return
+    world_size = get_world_size()
+    buckets = {}
+    for p in params:
+        if p.grad is not None:
+            buckets.setdefault((p.grad.dtype, p.grad.device), []).append(p.grad)
+    for grads in buckets.values():
+        flat = torch.cat([g.reshape(-1) for g in grads])
+        dist.all_reduce(flat)
+        flat.div_(world_size)
+        offset = 0
+        for g in grads:
+            g.copy_(flat[offset:offset+g.numel()].view_as(g))
+            offset += g.numel()
+
+
+def broadcast_module(module, src=0):
+    """
+    Copy parameters and buffers (e.g. BatchNorm running stats) of src to every process
+    """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor.data, src=src)
+
+
+def setup_for_distributed(is_main):
+    """
+    Silence print() on every process but the main one (print(..., force=True) still prints)
+    """
+    import builtins
+    import functools
+    builtin_print = builtins.print
+
+    @functools.wraps(builtin_print)
+    def print(*args, **kwargs):
+        force = kwargs.pop("force", False)
+        if is_main or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
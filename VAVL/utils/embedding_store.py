@@ -0,0 +1,60 @@
+import os
+import json
+
+import numpy as np
+
+
+class EmbeddingStore:
+    """
+    Directory of memory-mapped per-utterance arrays (one .npy file per field)
+
+    Layout:
+        meta.json  - field names/dims and number of utterances
+        utts.txt   - utterance ids, one per line
+        <field>.npy - (num_utts, dim) float32 array
+    """
+    def __init__(self, root, mode='r'):
+        self.root = root
+        with open(os.path.join(root, "meta.json"), 'r') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(root, "utts.txt"), 'r') as f:
+            self.utts = [line.rstrip("\n") for line in f]
+        self.fields = {}
+        for name in self.meta["fields"]:
+            self.fields[name] = np.load(os.path.join(root, name + ".npy"), mmap_mode=mode)
+
+    @classmethod
+    def create(cls, root, utts, fields, **meta):
+        """
+        fields: dict of field name -> feature dimension
+        """
+        os.makedirs(root, exist_ok=True)
+        for name, dim in fields.items():
+            arr = np.lib.format.open_memmap(os.path.join(root, name + ".npy"), mode='w+',
+                dtype=np.float32, shape=(len(utts), dim))
+            del arr
+        with open(os.path.join(root, "utts.txt"), 'w') as f:
+            for utt in utts:
+                f.write(utt + "\n")
+        meta = dict(meta)
+        meta["fields"] = {name: int(dim) for name, dim in fields.items()}
+        meta["num_utts"] = len(utts)
+        with open(os.path.join(root, "meta.json"), 'w') as f:
+            json.dump(meta, f, indent=4)
+        return cls(root, mode='r+')
+
+    def write(self, sidx, **values):
+        for name, value in values.items():
+            value = np.asarray(value, dtype=np.float32)
+            self.fields[name][sidx:sidx+len(value)] = value
+
+    def flush(self):
+        for arr in self.fields.values():
+            if isinstance(arr, np.memmap):
+                arr.flush()
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    def __len__(self):
+        return len(self.utts)
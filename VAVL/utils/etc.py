@@ -1,14 +1,43 @@
 import os
+import random
 import torch
 import numpy as np
 import json
 
 
-def set_deterministic(seed):
-    os.environ["CUBLAS_WORKSPACE_CONFIG"]=":4096:8"
-    torch.use_deterministic_algorithms(True)
-    torch.manual_seed(seed)
+def set_deterministic(seed, deterministic=True):
+    """
+    Seed python/numpy/torch and, with deterministic, select deterministic kernels
+    (ops without one warn instead of failing the run)
+    """
+    random.seed(seed)
     np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    if deterministic:
+        os.environ["CUBLAS_WORKSPACE_CONFIG"]=":4096:8"
+        torch.use_deterministic_algorithms(True, warn_only=True)
+
+MODEL_SIZE_ARGS = ["model_type", "encoder_dim", "num_heads", "acoustic_layers", "visual_layers", "shared_layers"]
+
+def save_model_config(model_path, args):
+    """
+    Architecture arguments needed to rebuild the heads of a non-default size (e.g. a distilled student)
+    """
+    config = {key: getattr(args, key) for key in MODEL_SIZE_ARGS if hasattr(args, key)}
+    with open(os.path.join(model_path, "model_config.json"), 'w') as f:
+        json.dump(config, f, indent=4)
+
+def load_model_config(model_path, args):
+    """
+    Override the architecture arguments of args with model_path/model_config.json, if there is one
+    """
+    config_file = os.path.join(model_path, "model_config.json")
+    if os.path.isfile(config_file):
+        with open(config_file, 'r') as f:
+            for key, value in json.load(f).items():
+                setattr(args, key, value)
+    return args
 
 def print_config_description(conf_path):
     with open(conf_path, 'r') as f:
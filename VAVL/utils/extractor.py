@@ -1,4 +1,5 @@
 import os
+import json
 import librosa
 
 from transformers import Wav2Vec2Processor, Wav2Vec2Model
@@ -42,15 +43,49 @@ class WavExtractor:
             wav_list = list(tqdm(p.imap(extract_wav, self.wav_path_list), total=len(self.wav_path_list)))
         return wav_list
 
+def load_vid_meta(vid_loc):
+    """
+    Metadata written by facial_features/face_extractor.py next to <vid_loc>.npy, e.g. the frame rate
+    of the face features ("fps"). Empty for features extracted without it.
+    """
+    meta_path = vid_loc + '.json'
+    if not os.path.isfile(meta_path):
+        return {}
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+def get_frame_index(vid_meta, num_rows):
+    """
+    (num_rows,) index of the sampled frame of every feature row (row i is at frame_index[i] / fps seconds),
+    None if unknown. face_extractor.py writes one row per detected face, so frames without a face have no
+    row and frames with several faces have several; it records the frame of every row in "frame_index".
+    Older metadata without it only gives the frames when there is exactly one row per frame.
+    """
+    if "frame_index" in vid_meta:
+        frame_index = np.asarray(vid_meta["frame_index"], dtype=np.int64)
+        return frame_index if len(frame_index) == num_rows else None
+    num_frames = vid_meta.get("num_frames", None)
+    if num_frames is not None and vid_meta.get("num_faces", None) == num_frames == num_rows:
+        return np.arange(num_rows, dtype=np.int64)
+    return None
+
 class VidExtractor:
     def __init__(self, *args, **kwargs):
         self.vid_path_list = kwargs.get("wav_paths", args[0])
         self.nj = kwargs.get("nj", 24)
+        self.fps_list = []
+        self.frame_index_list = []
     def extract(self):
         print("Extracting video files")
         vid_list = []
+        # frame rate of every feature file and frame of every feature row, None if unknown
+        self.fps_list = []
+        self.frame_index_list = []
         for vid_loc in tqdm(self.vid_path_list):
             feats = np.load(vid_loc + '.npy') #np.transpose(np.load(vid_loc + '.npy')) 
+            vid_meta = load_vid_meta(vid_loc)
+            self.fps_list.append(vid_meta.get("fps", None))
+            self.frame_index_list.append(get_frame_index(vid_meta, len(feats)))
 
             # frames = os.listdir(vid_loc)
             # feats = []
@@ -58,6 +93,11 @@ class VidExtractor:
             #     feats.append(list(np.load(vid_loc + '/' + frame)))
 
             vid_list.append(np.array(feats))
+        num_unaligned = sum(fps is not None and frame_index is None
+                            for fps, frame_index in zip(self.fps_list, self.frame_index_list))
+        if num_unaligned > 0:
+            print("[WARNING] The frames of the rows of %d face feature files are unknown, "
+                  "they are not aligned with the audio" % num_unaligned)
         return vid_list
 
 def unpack_torch_segment(padded_segment, duration):
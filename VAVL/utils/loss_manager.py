@@ -5,40 +5,69 @@ import numpy as np
 import sys
 import torch.autograd as autograd
 import os
-import pandas as pd
-import numpy as np
-from sklearn.metrics import f1_score
-from sklearn.metrics import precision_score
-from sklearn.metrics import recall_score
-from sklearn.metrics import confusion_matrix
+from .metrics import classification_metrics
+from .distributed import all_reduce_sum
 class LogManager:
+    """
+    Running weighted means per stat type.
+    add_torch_stat() keeps its sums on the stat's device, so logging a loss or
+    accuracy does not force a host sync; values are only copied to the host,
+    in one transfer, by get_stat()/print_stat().
+    """
     def __init__(self):
         self.log_book=dict()
     def alloc_stat_type(self, stat_type):
-        self.log_book[stat_type] = []
+        # [weighted sum, total weight]
+        self.log_book[stat_type] = [0.0, 0.0]
     def alloc_stat_type_list(self, stat_type_list):
         for stat_type in stat_type_list:
             self.alloc_stat_type(stat_type)
     def init_stat(self):
         for stat_type in self.log_book.keys():
-            self.log_book[stat_type] = []
-    def add_stat(self, stat_type, stat):
+            self.alloc_stat_type(stat_type)
+    def add_stat(self, stat_type, stat, weight=1):
         assert stat_type in self.log_book, "Wrong stat type"
-        self.log_book[stat_type].append(stat)
-    def add_torch_stat(self, stat_type, stat):
+        self.log_book[stat_type][0] += float(stat) * weight
+        self.log_book[stat_type][1] += weight
+    def add_torch_stat(self, stat_type, stat, weight=1):
         assert stat_type in self.log_book, "Wrong stat type"
-        self.log_book[stat_type].append(stat.detach().cpu().item())
+        self.log_book[stat_type][0] = self.log_book[stat_type][0] + stat.detach().float() * weight
+        self.log_book[stat_type][1] += weight
+    def sync(self):
+        """
+        Move every device-side sum to the host with a single copy
+        """
+        stat_types = [k for k, v in self.log_book.items() if torch.is_tensor(v[0])]
+        if len(stat_types) == 0:
+            return
+        sums = torch.stack([self.log_book[k][0].reshape(()).to(self.log_book[stat_types[0]][0].device)
+            for k in stat_types]).cpu().tolist()
+        for k, v in zip(stat_types, sums):
+            self.log_book[k][0] = v
+    def all_reduce(self, stat_types):
+        """
+        Sum the weighted sums and weights of stat_types over all processes, for stats
+        accumulated on each process's own shard of the data (e.g. the training batches)
+        """
+        self.sync()
+        stat_types = [k for k in stat_types if k in self.log_book]
+        values = all_reduce_sum([float(x) for k in stat_types for x in self.log_book[k]])
+        for i, k in enumerate(stat_types):
+            self.log_book[k] = [values[2 * i], values[2 * i + 1]]
     def get_stat(self, stat_type):
         result_stat = 0
-        stat_list = self.log_book[stat_type]
-        if len(stat_list) != 0:
-            result_stat = np.mean(stat_list)
+        stat_sum, stat_weight = self.log_book[stat_type]
+        if stat_weight != 0:
+            if torch.is_tensor(stat_sum):
+                stat_sum = stat_sum.item()
+            result_stat = stat_sum / float(stat_weight)
             result_stat = np.round(result_stat, 4)
         return result_stat
 
     def print_stat(self):
+        self.sync()
         for stat_type in self.log_book.keys():
-            if len(self.log_book[stat_type]) == 0:
+            if self.log_book[stat_type][1] == 0:
                 continue
             stat = self.get_stat(stat_type)           
             print(stat_type,":",stat, end=' / ')
@@ -58,6 +87,19 @@ def CE_category(pred, lab):
     ce_loss = celoss(pred, max_indx)
     return ce_loss
 
+def KD_loss(pred, teacher_pred, temperature=1.0, label_type="categorical"):
+    """
+    Distillation loss against (cached) teacher outputs: KL divergence between the
+    temperature-softened class distributions, scaled by T^2 so its gradients keep
+    the magnitude of the hard-label loss; MSE for dimensional outputs
+    """
+    teacher_pred = teacher_pred.to(pred.dtype)
+    if label_type == "dimensional":
+        return F.mse_loss(pred, teacher_pred)
+    log_p = F.log_softmax(pred / temperature, dim=1)
+    q = F.softmax(teacher_pred / temperature, dim=1)
+    return F.kl_div(log_p, q, reduction='batchmean') * temperature ** 2
+
 def calc_err(pred, lab):
     p = pred.detach()
     t = lab.detach()
@@ -72,83 +114,130 @@ def CCC_loss(pred, lab, m_lab=None, v_lab=None):
     """
     pred: (N, 3)
     lab: (N, 3)
+    Single pass over the centred inputs: ccc = 2 cov / (v_pred + v_lab + (m_pred - m_lab)^2)
     """
-    m_pred = torch.mean(pred, 0, keepdim=True)
-    m_lab = torch.mean(lab, 0, keepdim=True)
+    m_pred = torch.mean(pred, 0)
+    m_lab = torch.mean(lab, 0)
 
     d_pred = pred - m_pred
     d_lab = lab - m_lab
 
-    v_pred = torch.var(pred, 0, unbiased=False)
-    v_lab = torch.var(lab, 0, unbiased=False)
+    v_pred = torch.mean(d_pred ** 2, 0)
+    v_lab = torch.mean(d_lab ** 2, 0)
+    cov = torch.mean(d_pred * d_lab, 0)
 
-    corr = torch.sum(d_pred * d_lab, 0) / (torch.sqrt(torch.sum(d_pred ** 2, 0)) * torch.sqrt(torch.sum(d_lab ** 2, 0)))
+    ccc = (2*cov) / (v_pred + v_lab + (m_pred-m_lab)**2)
+    return ccc
 
-    s_pred = torch.std(pred, 0, unbiased=False)
-    s_lab = torch.std(lab, 0, unbiased=False)
 
-    ccc = (2*corr*s_pred*s_lab) / (v_pred + v_lab + (m_pred[0]-m_lab[0])**2)    
-    return ccc
+class CCCAccumulator:
+    """
+    Streaming CCC over batches of (N, D) predictions and labels.
+
+    Keeps the count, means, centred sums of squares and cross-products per
+    dimension and merges each batch with Chan et al.'s pairwise update, so the
+    full prediction matrix is never built. With n_boot > 0 it also tracks
+    n_boot Poisson(1)-weighted bootstrap replicates, vectorized over
+    resamples, for confidence intervals.
+    """
+    def __init__(self, n_boot=0, seed=None):
+        self.n_boot = n_boot
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator()
+            self.generator.manual_seed(seed)
+        self.reset()
+
+    def reset(self):
+        self.stat = None
+        self.boot_stat = None
+
+    @staticmethod
+    def _batch_stat(pred, lab, weight=None):
+        # weight: (R, N) or None -> stats with leading (R,) dim or none
+        if weight is None:
+            n = torch.full_like(pred[0], pred.size(0))
+            m_pred, m_lab = pred.mean(0), lab.mean(0)
+            d_pred, d_lab = pred - m_pred, lab - m_lab
+            return [n, m_pred, m_lab, (d_pred ** 2).sum(0), (d_lab ** 2).sum(0), (d_pred * d_lab).sum(0)]
+        # shift by the unweighted batch mean first to keep the raw moments small
+        c_pred, c_lab = pred.mean(0), lab.mean(0)
+        pred, lab = pred - c_pred, lab - c_lab
+        n = weight.sum(1, keepdim=True).expand(-1, pred.size(1))
+        safe_n = n.clamp(min=1)
+        m_pred, m_lab = (weight @ pred) / safe_n, (weight @ lab) / safe_n
+        s_pred2, s_lab2, s_cross = weight @ (pred ** 2), weight @ (lab ** 2), weight @ (pred * lab)
+        return [n, m_pred + c_pred, m_lab + c_lab,
+            s_pred2 - n * m_pred ** 2, s_lab2 - n * m_lab ** 2, s_cross - n * m_pred * m_lab]
+
+    @staticmethod
+    def _merge(stat_a, stat_b):
+        if stat_a is None:
+            return stat_b
+        n_a, m_pa, m_la, v_pa, v_la, c_a = stat_a
+        n_b, m_pb, m_lb, v_pb, v_lb, c_b = stat_b
+        n = n_a + n_b
+        safe_n = n.clamp(min=1)
+        d_pred, d_lab = m_pb - m_pa, m_lb - m_la
+        scale = n_a * n_b / safe_n
+        return [n, m_pa + d_pred * n_b / safe_n, m_la + d_lab * n_b / safe_n,
+            v_pa + v_pb + d_pred ** 2 * scale, v_la + v_lb + d_lab ** 2 * scale, c_a + c_b + d_pred * d_lab * scale]
+
+    @staticmethod
+    def _ccc(stat):
+        n, m_pred, m_lab, v_pred, v_lab, cov = stat
+        return 2 * cov / (v_pred + v_lab + n * (m_pred - m_lab) ** 2)
+
+    def update(self, pred, lab):
+        pred = pred.detach().double()
+        lab = lab.detach().to(pred.device).double()
+        self.stat = self._merge(self.stat, self._batch_stat(pred, lab))
+        if self.n_boot > 0:
+            rate = torch.ones(self.n_boot, pred.size(0), dtype=torch.float64)
+            weight = torch.poisson(rate, generator=self.generator).to(pred.device)
+            self.boot_stat = self._merge(self.boot_stat, self._batch_stat(pred, lab, weight))
+
+    def compute(self):
+        """
+        (D,) CCC over everything seen since reset()
+        """
+        return self._ccc(self.stat).float()
+
+    def compute_ci(self, alpha=0.05):
+        """
+        (lower, upper) percentile bootstrap bounds, each (D,)
+        """
+        assert self.n_boot > 0, "CCCAccumulator was created with n_boot=0"
+        boot_ccc = self._ccc(self.boot_stat)
+        lower = torch.quantile(boot_ccc, alpha / 2, dim=0)
+        upper = torch.quantile(boot_ccc, 1 - alpha / 2, dim=0)
+        return lower.float(), upper.float()
 
     
 def calc_acc(pred, lab):
     err = calc_err(pred, lab)
     return 1.0 - err
 
-def scores(root):
-
-    preds = root + 'y_pred.csv'
-    truths =  root + 'y_true.csv'
-
-    df_preds = pd.read_csv(preds)
-    df_truths = pd.read_csv(truths)
-    
-    columns = ['0','1','2','3','4','5']
-    test_preds = df_preds[columns].values.tolist()
-    test_truth = df_truths[columns].values.tolist()
-
-
-    predictions, truths = [], []
-    # print(test_preds, 'tpreds')
-
-    def softmax(x):
-         return np.exp(x)/sum(np.exp(x))
-
-    for i in range(len(test_preds)):
-        x =np.argmax(softmax(test_preds[i]))
-        predictions.append(x)
-    # print(predictions, 'preds')
-    
-    for i in range(len(test_truth)):
-        x =np.argmax(test_truth[i])
-        truths.append(x)
-        
-    
-    test_preds = predictions
-    test_truth = truths
-
-    f1ma = f1_score(test_truth, test_preds, average='macro')
-    f1mi = f1_score(test_truth, test_preds, average='micro')
-    pre_ma = precision_score(test_truth, test_preds, average='macro')
-    pre_mi = precision_score(test_truth, test_preds, average='micro')
-    re_ma = recall_score(test_truth, test_preds, average='macro')
-    re_mi = recall_score(test_truth, test_preds, average='micro')
-
-    conf_matrix = confusion_matrix(test_truth, test_preds)
+def scores(y_pred, y_true):
+    """
+    y_pred: (N, C) model outputs, y_true: (N, C) one-hot/soft labels
+    """
+    result = classification_metrics(y_pred, y_true)
 
     # print the confusion matrix
-    print(conf_matrix)
+    print(result["confusion_matrix"].cpu().numpy())
 
 
-    print('F1-Score Macro = {:5.3f}'.format(f1ma))
-    print('F1-Score Micro = {:5.3f}'.format(f1mi))
+    print('F1-Score Macro = {:5.3f}'.format(result["f1_macro"].item()))
+    print('F1-Score Micro = {:5.3f}'.format(result["f1_micro"].item()))
     print('-------------------------')
-    print('Precision Macro = {:5.3f}'.format(pre_ma))
-    print('Precision Micro = {:5.3f}'.format(pre_mi))
+    print('Precision Macro = {:5.3f}'.format(result["precision_macro"].item()))
+    print('Precision Micro = {:5.3f}'.format(result["precision_micro"].item()))
     print('-------------------------')
-    print('Recall Macro = {:5.3f}'.format(re_ma))
-    print('Recall Micro = {:5.3f}'.format(re_mi))
+    print('Recall Macro = {:5.3f}'.format(result["recall_macro"].item()))
+    print('Recall Micro = {:5.3f}'.format(result["recall_micro"].item()))
     print('-------------------------')
-
-
-
+    print('UA = {:5.3f}'.format(result["ua"].item()))
+    print('WA = {:5.3f}'.format(result["wa"].item()))
+    print('-------------------------')
+    return result
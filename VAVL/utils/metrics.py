@@ -0,0 +1,94 @@
+import torch
+
+
+def to_class_idx(y):
+    """
+    (N, C) scores / one-hot labels -> (N,) class indices; (N,) indices are kept
+    """
+    y = torch.as_tensor(y)
+    if y.dim() > 1:
+        y = torch.argmax(y, dim=1)
+    return y.long()
+
+
+def confusion_matrix(pred_idx, true_idx, num_classes):
+    """
+    (num_classes, num_classes) counts, rows are true classes and columns predictions
+    """
+    idx = true_idx * num_classes + pred_idx
+    return torch.bincount(idx, minlength=num_classes ** 2).reshape(num_classes, num_classes)
+
+
+def _safe_div(num, den):
+    return torch.where(den > 0, num / den.clamp(min=1), torch.zeros_like(num))
+
+
+def metrics_from_confusion(conf_matrix):
+    """
+    Macro averages run over the classes present in the labels or the predictions
+    (as sklearn does); UA averages recall over the classes present in the labels.
+    """
+    conf_matrix = conf_matrix.double()
+    tp = torch.diagonal(conf_matrix)
+    num_true = conf_matrix.sum(1)
+    num_pred = conf_matrix.sum(0)
+    total = conf_matrix.sum()
+
+    precision = _safe_div(tp, num_pred)
+    recall = _safe_div(tp, num_true)
+    f1 = _safe_div(2 * tp, num_true + num_pred)
+
+    present = (num_true + num_pred) > 0
+    num_present = present.sum().clamp(min=1)
+    in_truth = num_true > 0
+    micro = _safe_div(tp.sum(), total)
+    return {
+        "f1_macro": (f1 * present).sum() / num_present,
+        "f1_micro": micro,
+        "precision_macro": (precision * present).sum() / num_present,
+        "precision_micro": micro,
+        "recall_macro": (recall * present).sum() / num_present,
+        "recall_micro": micro,
+        "ua": (recall * in_truth).sum() / in_truth.sum().clamp(min=1),
+        "wa": micro,
+        "confusion_matrix": conf_matrix.long(),
+    }
+
+
+def classification_metrics(y_pred, y_true, num_classes=None):
+    """
+    y_pred: (N, C) scores or (N,) indices, y_true: (N, C) one-hot/soft labels or (N,) indices
+    All results stay on the input device as tensors.
+    """
+    pred_idx = to_class_idx(y_pred)
+    true_idx = to_class_idx(y_true).to(pred_idx.device)
+    if num_classes is None:
+        y_pred, y_true = torch.as_tensor(y_pred), torch.as_tensor(y_true)
+        if y_pred.dim() > 1:
+            num_classes = y_pred.size(1)
+        elif y_true.dim() > 1:
+            num_classes = y_true.size(1)
+        else:
+            # indices only: the largest class seen
+            num_classes = int(max(pred_idx.max(), true_idx.max())) + 1 if len(pred_idx) > 0 else 0
+    return metrics_from_confusion(confusion_matrix(pred_idx, true_idx, num_classes))
+
+
+class ConfusionMeter:
+    """
+    Confusion matrix accumulated batch by batch on device
+    """
+    def __init__(self, num_classes, device='cpu'):
+        self.num_classes = num_classes
+        self.conf_matrix = torch.zeros(num_classes, num_classes, dtype=torch.long, device=device)
+
+    def reset(self):
+        self.conf_matrix.zero_()
+
+    def update(self, y_pred, y_true):
+        pred_idx = to_class_idx(y_pred).to(self.conf_matrix.device)
+        true_idx = to_class_idx(y_true).to(self.conf_matrix.device)
+        self.conf_matrix += confusion_matrix(pred_idx, true_idx, self.num_classes)
+
+    def compute(self):
+        return metrics_from_confusion(self.conf_matrix)
@@ -0,0 +1,36 @@
+import os
+
+import numpy as np
+
+from .async_io import AsyncWriter
+
+
+def save_predictions(path, utts, y_true, **preds):
+    """
+    Single compressed .npz with utterance ids, labels and one array per mode
+    """
+    tmp_path = path + ".tmp.npz"
+    np.savez_compressed(tmp_path, utts=np.asarray(utts), y_true=y_true, **preds)
+    os.replace(tmp_path, path)
+
+
+def load_predictions(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+class PredictionWriter:
+    """
+    Writes prediction files on a background thread.
+    Arrays are passed as numpy copies, so callers may reuse their buffers.
+    """
+    def __init__(self):
+        self.writer = AsyncWriter()
+
+    def write(self, path, utts, y_true, **preds):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        preds = {mode: np.array(pred) for mode, pred in preds.items()}
+        self.writer.submit(save_predictions, path, list(utts), np.array(y_true), **preds)
+
+    def close(self):
+        self.writer.close()
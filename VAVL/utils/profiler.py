@@ -0,0 +1,159 @@
+import time
+import json
+import resource
+import contextlib
+
+import torch
+
+
+def summarize_profile(path, skip_steps=1):
+    """
+    Mean of every per-step field of a StepProfiler JSONL file, skipping the
+    first skip_steps (warm-up) steps of each epoch. Handy to diff two runs.
+    """
+    totals, count = {}, 0
+    with open(path, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            if record["epoch_step"] < skip_steps:
+                continue
+            count += 1
+            for key, value in record.items():
+                if isinstance(value, dict):
+                    for name, sub_value in value.items():
+                        totals[key + "." + name] = totals.get(key + "." + name, 0.0) + sub_value
+                elif key not in ["epoch", "step", "epoch_step"]:
+                    totals[key] = totals.get(key, 0.0) + value
+    return {key: value / count for key, value in totals.items()} if count > 0 else {}
+
+
+class StepProfiler:
+    """
+    Opt-in per-step instrumentation of the training loop.
+
+    Every step appends one JSON line to path with the wall time of each named
+    phase, the device (CUDA event) time of each phase, throughput in
+    utterances/s and audio-seconds/s, and peak memory. Phases may nest
+    ("acoustic_fwd/wav2vec"); a phase entered several times in a step (e.g. per
+    micro-batch) is summed. Optionally a torch.profiler trace is captured for
+    trace_steps steps starting at step trace_start, into trace_dir (viewable in
+    TensorBoard / chrome://tracing).
+
+    With path=None every method is a no-op, so the hooks can stay in place.
+    Enabling it synchronises the device once per step to read the CUDA events.
+    """
+    def __init__(self, path=None, device='cpu', trace_dir=None, trace_start=10, trace_steps=5, sr=16000):
+        self.enabled = path is not None
+        self.path = path
+        self.sr = sr
+        self.use_cuda = self.enabled and str(device).startswith('cuda') and torch.cuda.is_available()
+        self.out_f = open(path, 'a') if self.enabled else None
+        self.stack = []
+        self.epoch = 0
+        self.global_step = 0
+        self.epoch_step = 0
+        self.reset_step()
+
+        self.torch_profiler = None
+        if self.enabled and trace_dir is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=max(trace_start - 1, 0), warmup=1, active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                record_shapes=True, profile_memory=True, with_stack=False)
+            self.torch_profiler.start()
+
+    def reset_step(self):
+        self.wall = {}
+        self.cuda_events = {}
+        self.step_start = time.perf_counter()
+        if self.use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.epoch_step = 0
+        self.reset_step()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.stack.append(name)
+        full_name = "/".join(self.stack)
+        if self.use_cuda:
+            start_event = torch.cuda.Event(enable_timing=True)
+            end_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(full_name):
+                yield
+        finally:
+            self.wall[full_name] = self.wall.get(full_name, 0.0) + time.perf_counter() - start
+            if self.use_cuda:
+                end_event.record()
+                self.cuda_events.setdefault(full_name, []).append((start_event, end_event))
+            self.stack.pop()
+
+    def iter_loader(self, loader):
+        """
+        Iterate over loader, timing each fetch as the "data" phase
+        """
+        iterator = iter(loader)
+        while True:
+            with self.phase("data"):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def end_step(self, num_utts, audio_samples):
+        """
+        num_utts: utterances in the step, audio_samples: unpadded audio samples in the step
+        """
+        if not self.enabled:
+            return
+        record = {
+            "epoch": self.epoch,
+            "step": self.global_step,
+            "epoch_step": self.epoch_step,
+        }
+        if self.use_cuda:
+            torch.cuda.synchronize()
+            record["device_ms"] = {name: round(sum(s.elapsed_time(e) for s, e in events), 3)
+                for name, events in self.cuda_events.items()}
+            record["peak_mem_mb"] = round(torch.cuda.max_memory_allocated() / 2**20, 1)
+        else:
+            # ru_maxrss is in KB on Linux: the process high-water mark, not per step
+            record["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 1)
+        step_time = time.perf_counter() - self.step_start
+        audio_sec = float(audio_samples) / self.sr
+        record["wall_ms"] = {name: round(1000 * sec, 3) for name, sec in self.wall.items()}
+        record["step_ms"] = round(1000 * step_time, 3)
+        record["utts"] = int(num_utts)
+        record["audio_sec"] = round(audio_sec, 3)
+        record["utt_per_sec"] = round(num_utts / step_time, 3)
+        record["audio_sec_per_sec"] = round(audio_sec / step_time, 3)
+        self.out_f.write(json.dumps(record) + "\n")
+        self.out_f.flush()
+
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+        self.global_step += 1
+        self.epoch_step += 1
+        self.reset_step()
+
+    def close(self):
+        if not self.enabled:
+            return
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+        self.out_f.close()
+        self.enabled = False
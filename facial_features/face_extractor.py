@@ -8,99 +8,292 @@ Code adapted using pieces from code by Radek Danecek
 
 from hashlib import new
 from utils.FaceVideoDataModule import TestFaceVideoDM
+from utils.FaceDetector import FAN
+from utils.FaceEmbedder import FaceEmbedder
+from utils.VideoMetadata import gather_video_metadata
 # import gdl
-from pathlib import Path
-import shutil
-from tqdm import auto
+from collections import deque
+from fractions import Fraction
 import argparse
+import json
 import os
-import torch 
-from torchvision import  transforms
+import queue
+import threading
+import time
+import traceback
 import numpy as np
-from PIL import Image
-from tqdm import tqdm
+import torch
 
 
-def main():
-    root = '/path_to_data_dir/data/Dataset_Name/'
+"""
+Extracts the EfficientNet-B2 features of the faces in every video of <root>/Videos into
+<root>/Face_features/<video>.npy, one row per detected face. Frames are decoded, the faces
+detected, cropped and embedded in memory. Crops and landmarks are only written
+(to <root>/faces/<video>) with --save_crops.
+
+Frames are sampled at --fps (every frame of the video by default). The frame rate of the
+features and the extraction settings are written next to them, to <root>/Face_features/<video>.json,
+where VAVL reads the frame rate and the frame of every feature row to align the faces with the audio.
+
+Up to --num_workers videos are probed and decoded ahead on CPU threads (ffmpeg decodes in
+its own process) while the shared detector and embedder process the current one. A failed
+video is retried --retries times and then skipped. Every finished video is appended to
+<root>/Face_features/manifest.jsonl, so an interrupted run resumes where it stopped;
+videos recorded as failed are tried again on the next run.
+"""
+
+
+class DecodeWorker(threading.Thread):
+    """
+    Decodes one video, handing its frames to the consumer through a bounded queue.
+    The video is only probed here if video_meta (probed by main for all the videos) is None.
+    """
+    END = None
+
+    def __init__(self, input_video, output_folder, args, video_meta=None):
+        super().__init__(daemon=True)
+        self.video_meta = video_meta
+        self.dm = TestFaceVideoDM(input_video, output_folder, processed_subfolder="", face_detector_threshold=0.96,
+            sample_fps=args.fps, detection_batch_size=args.detection_batch_size, crop_warp=args.crop_warp,
+            tracking_keyframe_interval=args.keyframe_interval, tracking_min_confidence=args.min_confidence)
+        self.frames = queue.Queue(maxsize=args.queue_size)
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.error = None
+        self.num_frames = 0
+
+    def _put(self, item):
+        # gives up when the consumer has stopped reading
+        while not self.stopped.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        try:
+            self.dm._gather_data(exist_ok=True, video_meta=self.video_meta)
+            self.dm._unpack_videos()
+            self.ready.set()
+            frames = self.dm._decode_video(0)
+            try:
+                for frame in frames:
+                    if not self._put(frame):
+                        break
+            finally:
+                frames.close()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.ready.set()
+            self._put(DecodeWorker.END)
+
+    def __iter__(self):
+        while True:
+            frame = self.frames.get()
+            if frame is DecodeWorker.END:
+                break
+            self.num_frames += 1
+            yield frame
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self.stopped.set()
+
+
+def load_manifest(manifest_path):
+    """
+    Videos recorded as done in the manifest
+    """
+    done = set()
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line of an interrupted run
+                    continue
+                if record["status"] == "done":
+                    done.add(record["video"])
+    return done
+
+
+def append_manifest(manifest_path, record):
+    with open(manifest_path, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def video_fps(vid_meta):
+    """
+    Frame rate of the video stream, None if ffprobe does not know it (avg_frame_rate 0/0)
+    """
+    num, den = vid_meta['fps'].split('/')
+    if int(den) == 0 or int(num) == 0:
+        return None
+    return float(Fraction(int(num), int(den)))
+
+
+def save_atomic(path, save_fn):
+    # written under another name first, a partial file would look finished
+    with open(path + ".tmp", 'wb') as f:
+        save_fn(f)
+    os.replace(path + ".tmp", path)
+
+
+def extract_video(worker, detector, embedder, args):
+    worker.ready.wait()
+    if worker.error is not None:
+        raise worker.error
+    # the detector and the embedder are shared by all the videos
+    worker.dm.face_detector = detector
+    return worker.dm._extract_face_features_in_sequence(0, embedder, save_detections=args.save_crops,
+        frames=iter(worker), return_frame_index=True)
+
+
+def main(args):
+    root = args.root
 
     input_folder = root + 'Videos/' 
     output_folder = root + 'faces/'
 
-    if not os.path.isdir(output_folder):
-        os.mkdir(output_folder)
-
     save_to = root + 'Face_features'
     if not os.path.isdir(save_to):
         os.mkdir(save_to)
+    manifest_path = os.path.join(save_to, "manifest.jsonl")
 
-    #loading model
-    model = torch.load('./model/enet_b2_8_best.pt')
-    model.classifier = torch.nn.Identity()
-    model.eval()
-
-    IMG_SIZE = 224
-
-    test_transforms = transforms.Compose(
-        [
-            transforms.Resize((IMG_SIZE,IMG_SIZE)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                        std=[0.229, 0.224, 0.225])
-        ]
-    )
+    #loading models
+    device = torch.device(args.device)
+    detector = FAN(device, threshold=0.96)
+    embedder = FaceEmbedder(args.model_path, device=device, batch_size=args.embed_batch_size)
 
     list_of_dirs = os.listdir(input_folder)
     list_of_dirs.sort()
 
-    videos = os.listdir(output_folder)
+    done = load_manifest(manifest_path)
+    videos = os.listdir(save_to)
 
-    print(len(videos))
+    print(len(done), "videos in the manifest")
 
+    pending = []
     for ldir in list_of_dirs:
+        filename = ldir.replace('.mp4','')
+        if ldir in done or filename + '.npy' in videos:
+            print(ldir, 'ALREADY IN!')
+        else:
+            pending.append(ldir)
 
-        try:
-            if ldir.replace('.mp4','') not in videos:
-
-                input_video = input_folder + ldir
-                processed_subfolder = None
-                dm = TestFaceVideoDM(input_video, output_folder, processed_subfolder=processed_subfolder,face_detector_threshold=0.96, 
-                    batch_size=20, num_workers=20)
-                dm.prepare_data()
-                dm.setup()
-                processed_subfolder = Path(dm.output_dir).name
-                filename = ldir.replace('.mp4','')
-                folder = output_folder + processed_subfolder + '/' + filename + '/videos'
-                shutil.rmtree(folder)
-                shutil.move(output_folder + processed_subfolder + '/' + filename, output_folder)
-                shutil.rmtree(output_folder + processed_subfolder)
-                file_path = output_folder + filename
-                feature_vector = []
-                detections_folder = os.path.join(file_path, "detections")
-                for image_name in sorted(os.listdir(detections_folder)):
-                    if image_name[-3:] == 'png':
-                        image_path = os.path.join(detections_folder, image_name)
-                        image = Image.open(image_path)
-                        image = test_transforms(image).unsqueeze(0).cuda()
-
-                        with torch.no_grad():
-                            features = model(image).cpu()
-                            feature_vector.append(features)
-                    
-                feature_vector = np.concatenate(feature_vector, axis=0)
-                feature_file = os.path.join(save_to, filename + ".npy")
-                np.save(feature_file, feature_vector)
+    # all the pending videos are probed at once, unchanged videos come from the metadata cache
+    os.makedirs(output_folder, exist_ok=True)
+    video_metas = gather_video_metadata([input_folder + ldir for ldir in pending],
+        cache_path=os.path.join(output_folder, "video_metadata.json"), num_workers=args.probe_workers,
+        skip_errors=True)
+    video_metas = dict(zip(pending, video_metas))
 
+    # (video, decoding worker, attempt), in processing order
+    workers = deque()
+    next_video = 0
+    failed = []
+    while next_video < len(pending) or len(workers) > 0:
+        while len(workers) < args.num_workers and next_video < len(pending):
+            ldir = pending[next_video]
+            worker = DecodeWorker(input_folder + ldir, output_folder, args, video_metas[ldir])
+            worker.start()
+            workers.append((ldir, worker, 1))
+            next_video += 1
 
+        ldir, worker, attempt = workers.popleft()
+        start = time.time()
+        try:
+            feature_vector, frame_index = extract_video(worker, detector, embedder, args)
+            filename = ldir.replace('.mp4','')
+            source_fps = video_fps(worker.dm.video_metas[0])
+            meta = {
+                # frame rate of the features, the source frame rate when every frame is kept
+                "fps": args.fps if args.fps is not None else source_fps,
+                "sample_fps": args.fps,
+                "source_fps": source_fps,
+                "num_frames": worker.num_frames,
+                "num_faces": len(feature_vector),
+                "feature_dim": feature_vector.shape[1],
+                "keyframe_interval": args.keyframe_interval,
+                # sampled frame of every feature row (frames without a face have no row), row i is at
+                # frame_index[i] / fps seconds
+                "frame_index": frame_index.tolist(),
+                "seconds": round(time.time() - start, 2),
+            }
+            # the metadata goes first, the .npy marks the video as finished
+            save_atomic(os.path.join(save_to, filename + ".json"),
+                lambda f: f.write(json.dumps(meta).encode()))
+            save_atomic(os.path.join(save_to, filename + ".npy"), lambda f: np.save(f, feature_vector))
+            append_manifest(manifest_path, {"video": ldir, "status": "done", "faces": len(feature_vector),
+                "fps": meta["fps"], "attempts": attempt, "seconds": meta["seconds"]})
+        except Exception as e:
+            worker.stop()
+            traceback.print_exc()
+            if attempt <= args.retries:
+                print('RETRYING ', ldir)
+                # probed again, the metadata may be why it failed
+                worker = DecodeWorker(input_folder + ldir, output_folder, args)
+                worker.start()
+                workers.appendleft((ldir, worker, attempt + 1))
             else:
-                print(ldir, 'ALREADY IN!')
-            
-        except:
-            
-            print('ERROR IN ', ldir)
-            break
-    print("Done")
+                print('ERROR IN ', ldir)
+                failed.append(ldir)
+                append_manifest(manifest_path, {"video": ldir, "status": "failed", "error": repr(e),
+                    "attempts": attempt})
+    print("Done,", len(failed), "failed videos:", failed)
 
 if __name__ == '__main__':
-    main()
- 
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--root',
+        default='/path_to_data_dir/data/Dataset_Name/',
+        type=str)
+    parser.add_argument(
+        '--model_path',
+        default='./model/enet_b2_8_best.pt',
+        type=str)
+    parser.add_argument(
+        '--device',
+        default='cuda:0' if torch.cuda.is_available() else 'cpu',
+        type=str)
+    parser.add_argument(
+        '--fps', type=float, default=None,
+        help='rate at which the frames are sampled, e.g. 1, 5 or 25 (default: every frame of the video)')
+    parser.add_argument(
+        '--detection_batch_size', type=int, default=8,
+        help='frames the face detector runs on at once (default: 8)')
+    parser.add_argument(
+        '--keyframe_interval', type=int, default=0,
+        help='run the face detector every N frames and track the faces in between, 0 detects every frame (default: 0)')
+    parser.add_argument(
+        '--min_confidence', type=float, default=0.5,
+        help='landmark confidence under which a tracked frame is detected again (default: 0.5)')
+    parser.add_argument(
+        '--crop_warp', type=str, default='cv2', choices=['cv2', 'torch', 'skimage'],
+        help='face crop warping: cv2 or torch (batched uint8), skimage (original float warp) (default: cv2)')
+    parser.add_argument(
+        '--embed_batch_size', type=int, default=64,
+        help='face crops embedded at once (default: 64)')
+    parser.add_argument(
+        '--save_crops', action='store_true',
+        help='also write the face crops and landmarks to <root>/faces/<video>')
+    parser.add_argument(
+        '--num_workers', type=int, default=4,
+        help='videos probed and decoded ahead on CPU threads (default: 4)')
+    parser.add_argument(
+        '--probe_workers', type=int, default=8,
+        help='videos probed at once by ffprobe before the extraction (default: 8)')
+    parser.add_argument(
+        '--queue_size', type=int, default=64,
+        help='decoded frames buffered per video (default: 64)')
+    parser.add_argument(
+        '--retries', type=int, default=1,
+        help='retries of a failed video before it is skipped (default: 1)')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the facial_features modules import each other as utils.<Module>
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from utils.ImageDatasetHelpers import bbpoint_warp, bbpoint_warp_batch
+
+
+def _frame(height=240, width=320, seed=0):
+    """
+    Smooth synthetic uint8 frame: colour gradients with a few blurred blobs
+    """
+    rng = np.random.RandomState(seed)
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float64)
+    frame = np.stack([xs / width, ys / height, (xs + ys) / (width + height)], axis=-1) * 160
+    for _ in range(6):
+        cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+        sigma = rng.uniform(8, 30)
+        frame += rng.uniform(-80, 80, size=3) * np.exp(-((xs - cx) ** 2 + (ys - cy) ** 2) / (2 * sigma ** 2))[..., None]
+    return np.clip(np.round(frame), 0, 255).astype(np.uint8)
+
+
+# (center, size): inside the frame, scaled up, scaled down, crossing the left/top border
+BOXES = [((160., 120.), 100.), ((100.5, 80.25), 60.), ((200., 140.), 200.), ((20., 15.), 90.)]
+
+
+@pytest.mark.parametrize("method", ["cv2", "torch"])
+def test_parity_with_bbpoint_warp(method):
+    frames = [_frame(seed=0), _frame(seed=1)]
+    centers = [np.array(center) for center, _ in BOXES]
+    sizes = [size for _, size in BOXES]
+    image_index = [0, 1, 0, 1]
+    landmarks = [np.array(center) + np.array([[-10., -5.], [0., 0.], [12.5, 7.25]]) for center in centers]
+
+    crops, dst_landmarks = bbpoint_warp_batch(frames, centers, sizes, 64, landmarks=landmarks,
+                                              image_index=image_index, method=method)
+    assert crops.shape == (len(BOXES), 64, 64, 3) and crops.dtype == np.uint8
+
+    for crop, dst_landmark, ii, center, size, landmark in zip(crops, dst_landmarks, image_index, centers, sizes,
+                                                             landmarks):
+        ref, ref_landmark = bbpoint_warp(frames[ii], center, size, 64, landmarks=landmark)
+        diff = np.abs(crop.astype(np.float64) - ref * 255)
+        # bicubic convolution vs skimage's B-spline, and rounding to uint8
+        assert diff.max() <= 3
+        assert diff.mean() <= 0.25
+        np.testing.assert_allclose(dst_landmark, ref_landmark, atol=1e-9)
+
+
+def test_empty_batch():
+    crops = bbpoint_warp_batch([_frame()], [], [], 64)
+    assert crops.shape == (0, 64, 64, 3)
@@ -0,0 +1,66 @@
+import os
+import threading
+
+import pytest
+
+import utils.VideoMetadata as VideoMetadata
+
+
+@pytest.fixture
+def probes(monkeypatch):
+    """
+    ffprobe replaced by a counter, "bad" videos cannot be probed
+    """
+    probed = []
+    lock = threading.Lock()
+
+    def probe_video(video_file):
+        with lock:
+            probed.append(os.path.basename(str(video_file)))
+        if "bad" in str(video_file):
+            raise RuntimeError("Video file has no video streams! '%s'" % str(video_file))
+        return {"fps": "25/1", "width": 160, "height": 120, "frame_width": 160, "frame_height": 120,
+                "num_frames": os.path.getsize(video_file)}
+
+    monkeypatch.setattr(VideoMetadata, "probe_video", probe_video)
+    return probed
+
+
+def _videos(tmp_path, names):
+    files = []
+    for i, name in enumerate(names):
+        path = tmp_path / name
+        path.write_bytes(b"0" * (i + 1))
+        files.append(str(path))
+    return files
+
+
+def test_unchanged_videos_are_not_probed_again(tmp_path, probes):
+    files = _videos(tmp_path, ["%02d.mp4" % i for i in range(20)])
+    cache_path = str(tmp_path / "video_metadata.json")
+    metas = VideoMetadata.gather_video_metadata(files, cache_path=cache_path, num_workers=4)
+    assert [meta["num_frames"] for meta in metas] == list(range(1, 21))
+    assert sorted(probes) == sorted(os.path.basename(f) for f in files)
+
+    del probes[:]
+    assert VideoMetadata.gather_video_metadata(files, cache_path=cache_path, num_workers=4) == metas
+    assert probes == []
+
+    # a changed size invalidates the entry
+    with open(files[3], 'ab') as f:
+        f.write(b"0")
+    metas = VideoMetadata.gather_video_metadata(files, cache_path=cache_path, num_workers=4)
+    assert probes == ["03.mp4"] and metas[3]["num_frames"] == 5
+
+
+def test_probe_errors(tmp_path, probes):
+    files = _videos(tmp_path, ["a.mp4", "bad.mp4", "c.mp4"])
+    cache_path = str(tmp_path / "video_metadata.json")
+    metas = VideoMetadata.gather_video_metadata(files, cache_path=cache_path, skip_errors=True)
+    assert metas[1] is None and metas[0]["num_frames"] == 1 and metas[2]["num_frames"] == 3
+    with pytest.raises(RuntimeError):
+        VideoMetadata.gather_video_metadata(files, cache_path=cache_path)
+    # the videos probed before are cached, the failed one is probed again
+    del probes[:]
+    VideoMetadata.gather_video_metadata(files, cache_path=cache_path, skip_errors=True)
+    assert probes == ["bad.mp4"]
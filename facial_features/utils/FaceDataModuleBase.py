@@ -30,9 +30,10 @@ from skimage.io import imread, imsave
 from torch.utils.data import DataLoader
 from torchvision.transforms import Resize, Compose, Normalize
 from tqdm import tqdm
-from utils.ImageDatasetHelpers import bbox2point, bbpoint_warp
+from utils.ImageDatasetHelpers import bbox2point, bbpoint_warp, bbpoint_warp_batch
 from utils.UnsupervisedImageDataset import UnsupervisedImageDataset
 from utils.FaceDetector import FAN, MTCNN, save_landmark
+from utils.FaceTracker import FaceTracker
 import pickle as pkl
 
 class FaceDataModuleBase(pl.LightningDataModule):
@@ -50,6 +51,10 @@ class FaceDataModuleBase(pl.LightningDataModule):
                  bb_center_shift_x=0., # in relative numbers
                  bb_center_shift_y=0., # in relative numbers (i.e. -0.1 for 10% shift upwards, ...)
                  processed_ext=".png",
+                 detection_batch_size=8,
+                 crop_warp='cv2',
+                 tracking_keyframe_interval=0,
+                 tracking_min_confidence=0.5,
                  ):
         super().__init__()
         self.root_dir = root_dir
@@ -73,6 +78,15 @@ class FaceDataModuleBase(pl.LightningDataModule):
 
         self.image_size = image_size
         self.scale = scale
+        # number of frames the face detector runs on at once
+        self.detection_batch_size = detection_batch_size
+        # 'cv2' or 'torch' crop all the faces of a batch of uint8 frames at once (see bbpoint_warp_batch),
+        # 'skimage' is the original float bbpoint_warp, one face at a time
+        self.crop_warp = crop_warp
+        # with tracking_keyframe_interval > 0, the face detector only runs on keyframes (and when the landmark
+        # confidence drops below tracking_min_confidence), the faces are tracked in between (see FaceTracker)
+        self.tracking_keyframe_interval = tracking_keyframe_interval
+        self.tracking_min_confidence = tracking_min_confidence
 
 
     # @profile
@@ -88,70 +102,133 @@ class FaceDataModuleBase(pl.LightningDataModule):
         else:
             raise ValueError("Invalid face detector specifier '%s'" % self.face_detector)
 
-    # @profile
-    def _detect_faces_in_image(self, image_path, detected_faces=None):
-        # imagepath = self.imagepath_list[index]
-        # imagename = imagepath.split('/')[-1].split('.')[0]
-        image = np.array(imread(image_path))
+    def _get_face_tracker(self):
+        self._instantiate_detector()
+        if not hasattr(self, 'face_tracker') or self.face_tracker.detector is not self.face_detector:
+            self.face_tracker = FaceTracker(self.face_detector, keyframe_interval=self.tracking_keyframe_interval,
+                                            min_confidence=self.tracking_min_confidence)
+        return self.face_tracker
+
+    @staticmethod
+    def _load_image(image):
+        # image is either a frame decoded in memory (uint8 RGB) or the path of an image file
+        if not isinstance(image, np.ndarray):
+            image = imread(image)
+        image = np.array(image)
         if len(image.shape) == 2:
             image = np.tile(image[:, :, None], (1, 1, 3))
         if len(image.shape) == 3 and image.shape[2] > 3:
             image = image[:, :, :3]
+        return image
+
+    # @profile
+    def _detect_faces_in_image(self, image, detected_faces=None):
+        # imagepath = self.imagepath_list[index]
+        # imagename = imagepath.split('/')[-1].split('.')[0]
+        image = self._load_image(image)
 
         h, w, _ = image.shape
         self._instantiate_detector()
         bounding_boxes, bbox_type, landmarks = self.face_detector.run(image,
                                                                       with_landmarks=True,
                                                                       detected_faces=detected_faces)
-        image = image / 255.
-        detection_images = []
-        detection_centers = []
-        detection_sizes = []
-        detection_landmarks = []
-        # detection_embeddings = []
-        if len(bounding_boxes) == 0:
-            # print('no face detected! run original image')
-            return detection_images, detection_centers, detection_images, \
-                   bbox_type, detection_landmarks
-            # left = 0
-            # right = h - 1
-            # top = 0
-            # bottom = w - 1
-            # bounding_boxes += [[left, right, top, bottom]]
-
-        for bi, bbox in enumerate(bounding_boxes):
-            left = bbox[0]
-            right = bbox[2]
-            top = bbox[1]
-            bottom = bbox[3]
-            old_size, center = bbox2point(left, right, top, bottom, type=bbox_type)
-
-            center[0] += abs(right-left)*self.bb_center_shift_x
-            center[1] += abs(bottom-top)*self.bb_center_shift_y
-
-            size = int(old_size * self.scale)
-
-            dst_image, dts_landmark = bbpoint_warp(image, center, size, self.image_size, landmarks=landmarks[bi])
-
-            # dst_image = dst_image.transpose(2, 0, 1)
-            #
-            detection_images += [(dst_image*255).astype(np.uint8)]
-            detection_centers += [center]
-            detection_sizes += [size]
+        return self._crop_faces_in_images([image], [(bounding_boxes, bbox_type, landmarks)])[0]
 
+    def _detect_faces_in_images(self, images):
+        """
+        Batched version of _detect_faces_in_image, the detector runs on all the images at once
+        """
+        images = [self._load_image(image) for image in images]
+        self._instantiate_detector()
+        if self.tracking_keyframe_interval > 0:
+            # images are consecutive frames
+            detections = self._get_face_tracker().run_batch(images, with_landmarks=True)
+        else:
+            detections = self.face_detector.run_batch(images, with_landmarks=True)
+        return self._crop_faces_in_images(images, detections)
+
+    def _get_crop_box(self, bbox, bbox_type):
+        left = bbox[0]
+        right = bbox[2]
+        top = bbox[1]
+        bottom = bbox[3]
+        old_size, center = bbox2point(left, right, top, bottom, type=bbox_type)
+
+        center[0] += abs(right-left)*self.bb_center_shift_x
+        center[1] += abs(bottom-top)*self.bb_center_shift_y
+
+        size = int(old_size * self.scale)
+        return center, size
+
+    def _crop_faces_in_images(self, images, detections):
+        """
+        Crops the detected faces of all the images at once.
+        detections: (bounding_boxes, bbox_type, landmarks) of every image
+        return: (detection_images, detection_centers, detection_sizes, bbox_type, detection_landmarks) of every image
+        """
+        if self.crop_warp == 'skimage' or \
+                (self.crop_warp == 'torch' and len(set(image.shape for image in images)) > 1):
+            # one image at a time
+            if len(images) > 1:
+                return [self._crop_faces_in_images([image], [detection])[0]
+                        for image, detection in zip(images, detections)]
+
+        centers = []
+        sizes = []
+        landmarks = []
+        image_index = []
+        for ii, (bounding_boxes, bbox_type, image_landmarks) in enumerate(detections):
+            for bi, bbox in enumerate(bounding_boxes):
+                center, size = self._get_crop_box(bbox, bbox_type)
+                centers += [center]
+                sizes += [size]
+                landmarks += [image_landmarks[bi]]
+                image_index += [ii]
+
+        if self.crop_warp == 'skimage':
+            warped = [bbpoint_warp(images[ii] / 255., center, size, self.image_size, landmarks=landmark)
+                      for ii, center, size, landmark in zip(image_index, centers, sizes, landmarks)]
+            crops = [(dst_image*255).astype(np.uint8) for dst_image, _ in warped]
+            crop_landmarks = [dst_landmark for _, dst_landmark in warped]
+        else:
+            crops, crop_landmarks = bbpoint_warp_batch(images, centers, sizes, self.image_size, landmarks=landmarks,
+                                                       image_index=image_index, method=self.crop_warp,
+                                                       device=self.device)
+
+        results = []
+        for ii, (bounding_boxes, bbox_type, _) in enumerate(detections):
+            faces = [i for i, index in enumerate(image_index) if index == ii]
+            detection_images = [crops[i] for i in faces]
+            detection_centers = [centers[i] for i in faces]
+            detection_sizes = [sizes[i] for i in faces]
             # to be checked
-            detection_landmarks += [dts_landmark]
-
-        del image
-        return detection_images, detection_centers, detection_sizes, bbox_type, detection_landmarks
+            detection_landmarks = [crop_landmarks[i] for i in faces]
+            results += [(detection_images, detection_centers, detection_sizes, bbox_type, detection_landmarks)]
+        return results
 
     # @profile
     def _detect_faces_in_image_wrapper(self, frame_list, fid, out_detection_folder, out_landmark_folder, bb_outfile,
-                                       centers_all, sizes_all, detection_fnames_all, landmark_fnames_all):
+                                       centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, frame=None):
+        self._detect_faces_in_batch_wrapper(frame_list, [fid], out_detection_folder, out_landmark_folder, bb_outfile,
+                                            centers_all, sizes_all, detection_fnames_all, landmark_fnames_all,
+                                            frames=[frame])
 
-        frame_fname = frame_list[fid]
+    # @profile
+    def _detect_faces_in_batch_wrapper(self, frame_list, fids, out_detection_folder, out_landmark_folder, bb_outfile,
+                                       centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, frames=None):
+        frames = frames or [None] * len(fids)
+        # frames decoded in memory are passed directly, unpacked frames are read from disk
+        frames = [Path(self.output_dir) / frame_list[fid] if frame is None else frame
+                  for fid, frame in zip(fids, frames)]
         # detect faces in each frames
-        detection_ims, centers, sizes, bbox_type, landmarks = self._detect_faces_in_image(Path(self.output_dir) / frame_fname)
+        detections = self._detect_faces_in_images(frames)
+        for fid, detection in zip(fids, detections):
+            self._save_frame_detections(frame_list[fid], fid, detection, out_detection_folder, out_landmark_folder,
+                                        bb_outfile, centers_all, sizes_all, detection_fnames_all, landmark_fnames_all)
+
+    def _save_frame_detections(self, frame_fname, fid, detection, out_detection_folder, out_landmark_folder,
+                               bb_outfile, centers_all, sizes_all, detection_fnames_all, landmark_fnames_all):
+        detection_ims, centers, sizes, bbox_type, landmarks = detection
         # self.detection_lists[sequence_id][fid] += [detections]
         centers_all += [centers]
         sizes_all += [sizes]
@@ -176,7 +253,6 @@ class FaceDataModuleBase(pl.LightningDataModule):
         detection_fnames_all += [detection_fnames]
         landmark_fnames_all += [landmark_fnames]
 
-        torch.cuda.empty_cache()
         checkpoint_frequency = 100
         if fid % checkpoint_frequency == 0:
             FaceDataModuleBase.save_detections(bb_outfile, detection_fnames_all, landmark_fnames_all,
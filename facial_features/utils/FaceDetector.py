@@ -23,6 +23,13 @@ class FaceDetector(ABC):
     def run(self, image, **kwargs):
         raise NotImplementedError()
 
+    def run_batch(self, images, **kwargs):
+        '''
+        images: list of 0-255, uint8, rgb, [h, w, 3] images
+        return: list with the output of run() for every image
+        '''
+        return [self.run(image, **kwargs) for image in images]
+
     def __call__(self, *args, **kwargs):
         self.run(*args, **kwargs)
 
@@ -31,6 +38,7 @@ class FAN(FaceDetector):
 
     def __init__(self, device = 'cuda', threshold=0.5):
         import face_alignment
+        self.device = device
         self.face_detector = 'sfd'
         self.face_detector_kwargs = {
             "filter_threshold": threshold
@@ -48,7 +56,50 @@ class FAN(FaceDetector):
         return: detected box list
         '''
         out = self.model.get_landmarks(image, detected_faces=detected_faces)
-        torch.cuda.empty_cache()
+        return self._landmarks_to_boxes(out, with_landmarks)
+
+    def run_batch(self, images, with_landmarks=False):
+        '''
+        images: list of 0-255, uint8, rgb, [h, w, 3] images of the same size
+        return: list with the detected box list of every image
+        The face detector runs on the whole batch at once, the landmarks are then regressed for every face.
+        '''
+        if len(images) == 0:
+            return []
+        if len(set(image.shape for image in images)) != 1:
+            return super().run_batch(images, with_landmarks=with_landmarks)
+        detected_faces = self.detect_faces(images)
+        outputs = []
+        for image, faces in zip(images, detected_faces):
+            out = self.model.get_landmarks(image, detected_faces=faces) if len(faces) > 0 else None
+            outputs += [self._landmarks_to_boxes(out, with_landmarks)]
+        return outputs
+
+    def detect_faces(self, images):
+        '''
+        images: list of 0-255, uint8, rgb, [h, w, 3] images of the same size
+        return: list with the face detector boxes ([left, top, right, bottom, score]) of every image
+        '''
+        if len(images) == 0:
+            return []
+        batch = torch.from_numpy(np.stack(images)).to(self.device).permute(0, 3, 1, 2).float()
+        with torch.no_grad():
+            detected_faces = self.model.face_detector.detect_from_batch(batch)
+        del batch
+        return detected_faces
+
+    def track(self, image, detected_faces, with_landmarks=False):
+        '''
+        image: 0-255, uint8, rgb, [h, w, 3]
+        detected_faces: face boxes to regress the landmarks in (e.g. the boxes of the previous frame),
+                        the face detector is not run
+        return: detected box list, and the landmark confidence (mean heatmap peak) of every face
+        '''
+        out, scores, _ = self.model.get_landmarks(image, detected_faces=detected_faces, return_landmark_score=True)
+        confidences = [] if out is None else [float(np.mean(score)) for score in scores]
+        return self._landmarks_to_boxes(out, with_landmarks), confidences
+
+    def _landmarks_to_boxes(self, out, with_landmarks):
         if out is None:
             del out
             if with_landmarks:
@@ -0,0 +1,42 @@
+"""
+Author: Lucas Goncalves
+2023
+
+EfficientNet-B2 face embeddings (enet_b2_8_best.pt, 1408 features per face),
+computed in batches on face crops kept in memory.
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class FaceEmbedder:
+
+    def __init__(self, model_path='./model/enet_b2_8_best.pt', device=None, batch_size=64, image_size=224):
+        self.device = device or torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+        self.batch_size = batch_size
+        self.image_size = image_size
+        model = torch.load(model_path, map_location=self.device)
+        model.classifier = torch.nn.Identity()
+        self.model = model.to(self.device).eval()
+        self.mean = torch.tensor([0.485, 0.456, 0.406], device=self.device).view(1, 3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225], device=self.device).view(1, 3, 1, 1)
+
+    def __call__(self, crops):
+        '''
+        crops: list of 0-255, uint8, rgb, [h, w, 3] face crops
+        return: (len(crops), 1408) float32 features
+        '''
+        features = []
+        for i in range(0, len(crops), self.batch_size):
+            batch = torch.from_numpy(np.stack(crops[i:i + self.batch_size])).to(self.device)
+            batch = batch.permute(0, 3, 1, 2).float().div_(255.)
+            # the crops of the data module already have the input size of the network
+            if batch.shape[-2:] != (self.image_size, self.image_size):
+                batch = F.interpolate(batch, size=(self.image_size, self.image_size), mode='bilinear',
+                                      align_corners=False)
+            batch = (batch - self.mean) / self.std
+            with torch.no_grad():
+                features += [self.model(batch).float().cpu().numpy()]
+        return np.concatenate(features, axis=0)
@@ -0,0 +1,88 @@
+"""
+Author: Lucas Goncalves
+2023
+
+Temporal face tracking for video sequences. The full face detector only runs
+on keyframes; on the frames in between, the landmarks are regressed inside the
+face boxes of the previous frame and the boxes follow the landmarks.
+"""
+
+import numpy as np
+
+
+class FaceTracker:
+    """
+    detector: FAN, it has to provide detect_faces() and track()
+    keyframe_interval: the face detector runs on every keyframe_interval-th frame
+    min_confidence: a frame is detected again when a tracked face has a lower landmark confidence
+
+    run_batch() expects the frames of a sequence in order; reset() before a new sequence.
+    """
+
+    def __init__(self, detector, keyframe_interval=10, min_confidence=0.5):
+        if not (hasattr(detector, 'detect_faces') and hasattr(detector, 'track')):
+            raise ValueError("Face tracking is not supported by '%s'" % type(detector).__name__)
+        self.detector = detector
+        self.keyframe_interval = keyframe_interval
+        self.min_confidence = min_confidence
+        self.reset()
+
+    def reset(self):
+        self.frame_count = 0
+        self.faces = []
+        self.landmarks = []
+        self.num_detected = 0
+        self.num_tracked = 0
+
+    @staticmethod
+    def _move_box(face, old_landmarks, new_landmarks):
+        # the detector box follows the shift and the scale of the landmarks
+        old_center = old_landmarks.mean(axis=0)
+        new_center = new_landmarks.mean(axis=0)
+        scale = np.ptp(new_landmarks, axis=0).mean() / max(np.ptp(old_landmarks, axis=0).mean(), 1e-6)
+        box_center = np.array([(face[0] + face[2]) / 2, (face[1] + face[3]) / 2])
+        box_center = new_center + (box_center - old_center) * scale
+        half_w = (face[2] - face[0]) / 2 * scale
+        half_h = (face[3] - face[1]) / 2 * scale
+        return np.array([box_center[0] - half_w, box_center[1] - half_h,
+                         box_center[0] + half_w, box_center[1] + half_h, face[4]])
+
+    def _detect(self, image, detected_faces, with_landmarks):
+        self.num_detected += 1
+        if len(detected_faces) == 0:
+            out = [], 'kpt68', []
+        else:
+            out, _ = self.detector.track(image, detected_faces, with_landmarks=True)
+        self.faces = list(detected_faces)
+        self.landmarks = out[2]
+        return out if with_landmarks else out[:2]
+
+    def _track(self, image, with_landmarks):
+        out, confidences = self.detector.track(image, self.faces, with_landmarks=True)
+        if len(confidences) != len(self.faces) or min(confidences) < self.min_confidence:
+            return None
+        self.num_tracked += 1
+        self.faces = [self._move_box(face, old, new) for face, old, new in zip(self.faces, self.landmarks, out[2])]
+        self.landmarks = out[2]
+        return out if with_landmarks else out[:2]
+
+    def run_batch(self, images, with_landmarks=False):
+        '''
+        images: list of consecutive 0-255, uint8, rgb, [h, w, 3] frames
+        return: list with the detected box list of every frame, as FAN.run_batch
+        '''
+        # the keyframes of the batch go through the face detector together
+        keyframes = [i for i in range(len(images)) if (self.frame_count + i) % self.keyframe_interval == 0]
+        keyframe_faces = dict(zip(keyframes, self.detector.detect_faces([images[i] for i in keyframes])))
+        outputs = []
+        for i, image in enumerate(images):
+            out = None
+            if i not in keyframe_faces and len(self.faces) > 0:
+                out = self._track(image, with_landmarks)
+            if out is None:
+                # keyframe, nothing to track or lost track
+                faces = keyframe_faces[i] if i in keyframe_faces else self.detector.detect_faces([image])[0]
+                out = self._detect(image, faces, with_landmarks)
+            outputs += [out]
+        self.frame_count += len(images)
+        return outputs
@@ -31,6 +31,8 @@ from utils.ImageTestDataset import TestData
 from utils.FaceDataModuleBase import FaceDataModuleBase
 from utils.ImageDatasetHelpers import point2bbox, bbpoint_warp
 from utils.UnsupervisedImageDataset import UnsupervisedImageDataset
+from utils.VideoDecoder import decode_video
+from utils.VideoMetadata import gather_video_metadata
 from collections import OrderedDict
 from PIL import Image, ImageDraw, ImageFont
 import cv2
@@ -45,6 +47,17 @@ def add_pretrained_deca_to_path():
 class FaceVideoDataModule(FaceDataModuleBase):
     """
     Base data module for face video datasets. Contains the functionality to unpack the videos, detect faces, segment faces, ...
+
+    Frames are decoded in memory while faces are detected. With unpack_frames=True they are written to the 'videos'
+    folder as PNG instead (needed by the segmentation and reconstruction video steps).
+    sample_fps: rate at which the frames are sampled, None keeps every frame
+    detection_batch_size: number of frames the face detector runs on at once
+    crop_warp: 'cv2' (default), 'torch' or 'skimage', see FaceDataModuleBase
+    tracking_keyframe_interval: > 0 runs the face detector on keyframes only and tracks the faces in between
+    tracking_min_confidence: landmark confidence under which a tracked frame is detected again
+    probe_workers: number of videos probed at once by ffprobe
+    video_metadata_cache: keep the probed metadata in <output_dir>/video_metadata.json, keyed by path, size and
+        modification time, so that unchanged videos are not probed again
     """
 
     def __init__(self, root_dir, output_dir, processed_subfolder=None,
@@ -52,14 +65,26 @@ class FaceVideoDataModule(FaceDataModuleBase):
                  face_detector_threshold=0.9,
                  image_size=224,
                  scale=1.25,
-                 device=None):
+                 device=None,
+                 sample_fps=None,
+                 unpack_frames=False,
+                 detection_batch_size=8,
+                 crop_warp='cv2',
+                 tracking_keyframe_interval=0,
+                 tracking_min_confidence=0.5,
+                 probe_workers=8,
+                 video_metadata_cache=True):
         super().__init__(root_dir, output_dir,
                          processed_subfolder=processed_subfolder,
                          face_detector=face_detector,
                          face_detector_threshold=face_detector_threshold,
                          image_size = image_size,
                          scale = scale,
-                         device=device)
+                         device=device,
+                         detection_batch_size=detection_batch_size,
+                         crop_warp=crop_warp,
+                         tracking_keyframe_interval=tracking_keyframe_interval,
+                         tracking_min_confidence=tracking_min_confidence)
 
 
         # self._instantiate_detector()
@@ -67,6 +92,10 @@ class FaceVideoDataModule(FaceDataModuleBase):
 
 
         self.version = 2
+        self.sample_fps = sample_fps
+        self.unpack_frames = unpack_frames
+        self.probe_workers = probe_workers
+        self.video_metadata_cache = video_metadata_cache
 
         self.video_list = None
         self.video_metas = None
@@ -110,6 +139,10 @@ class FaceVideoDataModule(FaceDataModuleBase):
         # return  Path(self._video_category(video_idx)) / video_file.parts[-3] /self._video_set(video_idx) / video_file.stem
 
     def _unpack_video(self, video_idx, overwrite=False):
+        if not self.unpack_frames:
+            # frames are decoded in memory when the faces are detected, which also fills the frame list
+            self.frame_lists += [[]]
+            return
         video_file = Path(self.root_dir) / self.video_list[video_idx]
         # suffix = self._get_unpacked_video_subfolder(video_idx)
         # out_folder = Path(self.output_dir) / suffix
@@ -120,7 +153,10 @@ class FaceVideoDataModule(FaceDataModuleBase):
             out_folder.mkdir(exist_ok=True, parents=True)
 
             out_format = out_folder / (self.get_frame_number_format() + ".png")
-            out_format = '-r 1 -i %s -r 1 ' % str(video_file) + ' "' + str(out_format) + '"'
+            if self.sample_fps is None:
+                out_format = '-r 1 -i %s -r 1 ' % str(video_file) + ' "' + str(out_format) + '"'
+            else:
+                out_format = '-i %s -vf fps=%s ' % (str(video_file), str(self.sample_fps)) + ' "' + str(out_format) + '"'
             # out_format = ' -r 1 -i %s ' % str(video_file) + ' "' + "$frame.%03d.png" + '"'
             # subprocess.call(['ffmpeg', out_format])
             os.system("ffmpeg " + out_format)
@@ -133,14 +169,34 @@ class FaceVideoDataModule(FaceDataModuleBase):
         frame_list = sorted(list(out_folder.glob("*.png")))
         frame_list = [path.relative_to(self.output_dir) for path in frame_list]
         self.frame_lists += [frame_list]
-        n_frames = len(frame_list)
+        self._check_frame_count(video_idx, len(frame_list))
+
+    def _check_frame_count(self, video_idx, n_frames):
+        if self.sample_fps is not None:
+            return
         expected_frames = int(self.video_metas[video_idx]['num_frames'])
         if n_frames == expected_frames:
             pass
             # print("Successfully unpacked the video into %d frames" % expected_frames)
         else:
             print("[WARNING] Expected %d frames but got %d vor video '%s'"
-                  % (expected_frames, n_frames, str(video_file)))
+                  % (expected_frames, n_frames, str(self.video_list[video_idx])))
+
+    def _decode_video(self, video_idx):
+        """
+        Generator over the frames of a video as (h, w, 3) uint8 RGB arrays, sampled at self.sample_fps
+        """
+        video_file = Path(self.root_dir) / self.video_list[video_idx]
+        vid_meta = self.video_metas[video_idx]
+        width = vid_meta.get('frame_width', vid_meta['width'])
+        height = vid_meta.get('frame_height', vid_meta['height'])
+        return decode_video(video_file, width, height, fps=self.sample_fps)
+
+    def _get_frame_name(self, video_idx, frame_idx):
+        # name an unpacked frame would have (ffmpeg numbers the frames from 1)
+        out_folder = self._get_path_to_sequence_frames(video_idx)
+        frame_fname = out_folder / ((self.get_frame_number_format() % (frame_idx + 1)) + ".png")
+        return frame_fname.relative_to(self.output_dir)
 
 
     def _detect_faces(self):
@@ -205,37 +261,107 @@ class FaceVideoDataModule(FaceDataModuleBase):
         #     self.detection_lists = [ [] for i in range(self.num_sequences)]
         video_file = self.video_list[sequence_id]
         print("Detecting faces in sequence: '%s'" % video_file)
+        for fid, detection in self._iterate_detections_in_sequence(sequence_id, save_detections=True):
+            pass
+        print("Done detecting faces in sequence: '%s'" % self.video_list[sequence_id])
+
+    def _iterate_detections_in_sequence(self, sequence_id, save_detections=True, frames=None):
+        """
+        Generator over (frame index, detection) for the frames of a sequence, detection being the output of
+        _detect_faces_in_image. The face detector runs on detection_batch_size frames at once.
+        With save_detections, the crops, landmarks and bboxes.pkl are written as the frames are processed.
+        frames: iterable over the frames decoded elsewhere (e.g. by a decoding thread), by default the video is
+        decoded here
+        """
         # suffix = Path(self._video_category(sequence_id)) / 'detections' /self._video_set(sequence_id) / video_file.stem
         out_detection_folder = self._get_path_to_sequence_detections(sequence_id)
-        out_detection_folder.mkdir(exist_ok=True, parents=True)
         out_file = out_detection_folder / "bboxes.pkl"
-
         out_landmark_folder = self._get_path_to_sequence_landmarks(sequence_id)
-        out_landmark_folder.mkdir(exist_ok=True, parents=True)
+        if save_detections:
+            out_detection_folder.mkdir(exist_ok=True, parents=True)
+            out_landmark_folder.mkdir(exist_ok=True, parents=True)
 
         centers_all = []
         sizes_all = []
         detection_fnames_all = []
         landmark_fnames_all = []
 
-        start_fid = 0
-
         frame_list = self.frame_lists[sequence_id]
+        if self.unpack_frames:
+            frames = [None] * len(frame_list)
+        else:
+            # the frame list is filled with the names of the frames as they are decoded
+            del frame_list[:]
+            if frames is None:
+                frames = self._decode_video(sequence_id)
         fid = 0
-        if len(frame_list) == 0:
+        if self.unpack_frames and len(frame_list) == 0:
             print("Nothing to detect in: '%s'. All frames have been processed" % self.video_list[sequence_id])
-        for fid, frame_fname in enumerate(tqdm(range(start_fid, len(frame_list)))):
+        if self.tracking_keyframe_interval > 0:
+            self._get_face_tracker().reset()
+        batch_fids = []
+        batch_frames = []
 
-            # if fid % detector_instantion_frequency == 0:
-            #     self._instantiate_detector(overwrite=True)
+        def detect_batch():
+            for batch_fid, detection in zip(batch_fids, self._detect_faces_in_images(batch_frames)):
+                if save_detections:
+                    self._save_frame_detections(frame_list[batch_fid], batch_fid, detection, out_detection_folder,
+                                                out_landmark_folder, out_file, centers_all, sizes_all,
+                                                detection_fnames_all, landmark_fnames_all)
+                yield batch_fid, detection
 
-            self._detect_faces_in_image_wrapper(frame_list, fid, out_detection_folder, out_landmark_folder, out_file,
-                                           centers_all, sizes_all, detection_fnames_all, landmark_fnames_all)
+        for fid, frame in enumerate(tqdm(frames)):
 
-        FaceVideoDataModule.save_detections(out_file,
-                                            detection_fnames_all, landmark_fnames_all, centers_all, sizes_all, fid)
-        print("Done detecting faces in sequence: '%s'" % self.video_list[sequence_id])
+            # if fid % detector_instantion_frequency == 0:
+            #     self._instantiate_detector(overwrite=True)
 
+            if self.unpack_frames:
+                frame = Path(self.output_dir) / frame_list[fid]
+            else:
+                frame_list += [self._get_frame_name(sequence_id, fid)]
+            batch_fids += [fid]
+            batch_frames += [frame]
+            if len(batch_fids) == self.detection_batch_size:
+                yield from detect_batch()
+                batch_fids = []
+                batch_frames = []
+        if len(batch_fids) > 0:
+            yield from detect_batch()
+
+        if not self.unpack_frames:
+            self._check_frame_count(sequence_id, len(frame_list))
+        if self.tracking_keyframe_interval > 0:
+            print("Faces detected in %d frames, tracked in %d frames"
+                  % (self.face_tracker.num_detected, self.face_tracker.num_tracked))
+        if save_detections:
+            FaceVideoDataModule.save_detections(out_file,
+                                                detection_fnames_all, landmark_fnames_all, centers_all, sizes_all, fid)
+
+    def _extract_face_features_in_sequence(self, sequence_id, embedding_net, save_detections=False, frames=None,
+                                           return_frame_index=False):
+        """
+        Detects, crops and embeds the faces of a sequence without going through the disk (unless save_detections).
+        Returns the (detections, dim) features, ordered by frame and by face within a frame, and with
+        return_frame_index the (detections,) index of the (sampled) frame of every row.
+        """
+        print("Extracting face features in sequence: '%s'" % self.video_list[sequence_id])
+        features = []
+        crops = []
+        frame_index = []
+        for fid, detection in self._iterate_detections_in_sequence(sequence_id, save_detections=save_detections,
+                                                                   frames=frames):
+            crops += detection[0]
+            frame_index += [fid] * len(detection[0])
+            if len(crops) >= embedding_net.batch_size:
+                features += [embedding_net(crops)]
+                crops = []
+        if len(crops) > 0:
+            features += [embedding_net(crops)]
+        if len(features) == 0:
+            raise RuntimeError("No face detected in sequence: '%s'" % self.video_list[sequence_id])
+        if return_frame_index:
+            return np.concatenate(features, axis=0), np.array(frame_index, dtype=np.int64)
+        return np.concatenate(features, axis=0)
 
 
     def _segment_faces_in_sequence(self, sequence_id):
@@ -454,26 +580,14 @@ class FaceVideoDataModule(FaceDataModuleBase):
         self._gather_video_metadata()
         print("Found %d video files." % len(self.video_list))
 
+    @property
+    def video_metadata_cache_path(self):
+        return os.path.join(self.output_dir, "video_metadata.json")
+
     def _gather_video_metadata(self):
-        import ffmpeg
-        self.video_metas = []
-        for vi, vid_file in enumerate(tqdm(self.video_list)):
-            vid = ffmpeg.probe(str( Path(self.root_dir) / vid_file))
-            # codec_idx = [idx for idx in range(len(vid)) if vid['streams'][idx]['codec_type'] == 'video']
-            codec_idx = [idx for idx in range(len(vid)) if vid['streams'][0]['codec_type'] == 'video']
-            if len(codec_idx) == 0:
-                raise RuntimeError("Video file has no video streams! '%s'" % str(vid_file))
-            # if len(codec_idx) > 1:
-                # raise RuntimeError("Video file has two video streams! '%s'" % str(vid_file))
-            print("[WARNING] Video file has %d video streams. Only the first one will be processed" % len(codec_idx))
-            codec_idx = codec_idx[0]
-            vid_info = vid['streams'][codec_idx]
-            vid_meta = {}
-            vid_meta['fps'] = vid_info['avg_frame_rate']
-            vid_meta['width'] = int(vid_info['width'])
-            vid_meta['height'] = int(vid_info['height'])
-            vid_meta['num_frames'] = int(vid_info['nb_frames'])
-            self.video_metas += [vid_meta]
+        cache_path = self.video_metadata_cache_path if self.video_metadata_cache else None
+        video_files = [Path(self.root_dir) / vid_file for vid_file in self.video_list]
+        self.video_metas = gather_video_metadata(video_files, cache_path=cache_path, num_workers=self.probe_workers)
 
     def _loadMeta(self):
         if self.loaded:
@@ -1666,7 +1780,15 @@ class TestFaceVideoDM(FaceVideoDataModule):
                  scale=1.25,
                  batch_size=8,
                  num_workers=4,
-                 device=None):
+                 device=None,
+                 sample_fps=None,
+                 unpack_frames=False,
+                 detection_batch_size=8,
+                 crop_warp='cv2',
+                 tracking_keyframe_interval=0,
+                 tracking_min_confidence=0.5,
+                 probe_workers=8,
+                 video_metadata_cache=True):
         self.video_path = Path(video_path)
         self.batch_size = batch_size
         self.num_workers = num_workers
@@ -1676,7 +1798,15 @@ class TestFaceVideoDM(FaceVideoDataModule):
                  face_detector_threshold,
                  image_size,
                  scale,
-                 device)
+                 device,
+                 sample_fps,
+                 unpack_frames,
+                 detection_batch_size,
+                 crop_warp,
+                 tracking_keyframe_interval,
+                 tracking_min_confidence,
+                 probe_workers,
+                 video_metadata_cache)
         
     
     def prepare_data(self, *args, **kwargs):
@@ -1697,7 +1827,10 @@ class TestFaceVideoDM(FaceVideoDataModule):
     # def _get_unpacked_video_subfolder(self, video_idx):
     #     return  self.video_path.stem
 
-    def _gather_data(self, exist_ok=False):
+    def _gather_data(self, exist_ok=False, video_meta=None):
+        """
+        video_meta: metadata of the video probed beforehand (utils.VideoMetadata), probed here by default
+        """
         print("Processing dataset")
         Path(self.output_dir).mkdir(parents=True, exist_ok=exist_ok)
 
@@ -1705,7 +1838,10 @@ class TestFaceVideoDM(FaceVideoDataModule):
         self.video_list = [self.video_path.relative_to(self.root_dir)]
 
         self.annotation_list = []
-        self._gather_video_metadata()
+        if video_meta is None:
+            self._gather_video_metadata()
+        else:
+            self.video_metas = [video_meta]
 
 
     def _get_path_to_sequence_results(self, sequence_id, rec_method='EMOCA', suffix=''):
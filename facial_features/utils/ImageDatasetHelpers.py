@@ -64,4 +64,72 @@ def bbpoint_warp(image, center, size, target_size_height, target_size_width=None
     # points need the matrix
     tf_lmk = tform if inv else tform.inverse
     dst_landmarks = tf_lmk(landmarks)
-    return dst_image, dst_landmarks
\ No newline at end of file
+    return dst_image, dst_landmarks
+
+def crop_affine_matrix(center, size, target_size_height, target_size_width=None):
+    """
+    2x3 matrix mapping the image to the crop of point2transform (the similarity is only a scale and a shift)
+    """
+    target_size_width = target_size_width or target_size_height
+    left = center[0] - size / 2
+    top = center[1] - size / 2
+    scale_x = (target_size_height - 1) / size
+    scale_y = (target_size_width - 1) / size
+    return np.array([[scale_x, 0., -scale_x * left],
+                     [0., scale_y, -scale_y * top]])
+
+
+def bbpoint_warp_batch(images, centers, sizes, target_size_height, target_size_width=None, landmarks=None,
+                       image_index=None, method='cv2', device='cpu'):
+    """
+    Batched bbpoint_warp working on uint8 images: crops every (center, size) box at once.
+
+    images: (N, h, w, 3) uint8 array or list of images
+    image_index: image every box is cropped from, by default box i comes from image i
+    method: 'cv2' (cv2.warpAffine, bicubic) or 'torch' (grid_sample, bicubic, all the crops in one call on device)
+    return: (n_boxes, target_size_height, target_size_width, 3) uint8 crops, and the landmarks in crop
+            coordinates if given
+    """
+    target_size_width = target_size_width or target_size_height
+    if image_index is None:
+        image_index = list(range(len(centers)))
+    matrices = [crop_affine_matrix(center, size, target_size_height, target_size_width)
+                for center, size in zip(centers, sizes)]
+    if len(matrices) == 0:
+        crops = np.zeros((0, target_size_height, target_size_width, 3), dtype=np.uint8)
+    elif method == 'cv2':
+        import cv2
+        crops = np.stack([cv2.warpAffine(np.ascontiguousarray(images[ii]), matrix,
+                                         (target_size_width, target_size_height), flags=cv2.INTER_CUBIC,
+                                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+                          for ii, matrix in zip(image_index, matrices)])
+    elif method == 'torch':
+        crops = _grid_sample_crops(images, matrices, image_index, target_size_height, target_size_width, device)
+    else:
+        raise ValueError("Invalid warp method '%s'" % method)
+    if landmarks is None:
+        return crops
+    dst_landmarks = [np.asarray(landmark) @ matrix[:, :2].T + matrix[:, 2]
+                     for landmark, matrix in zip(landmarks, matrices)]
+    return crops, dst_landmarks
+
+
+def _grid_sample_crops(images, matrices, image_index, target_size_height, target_size_width, device):
+    import torch
+    import torch.nn.functional as F
+    used = sorted(set(image_index))
+    frames = torch.from_numpy(np.stack([images[ii] for ii in used])).to(device)
+    frames = frames.permute(0, 3, 1, 2).float()
+    h, w = frames.shape[-2:]
+    # source pixel of every crop pixel, from the inverse of the crop matrices
+    inverse = np.stack([np.linalg.inv(np.vstack([matrix, [0., 0., 1.]]))[:2] for matrix in matrices])
+    inverse = torch.from_numpy(inverse).float().to(device)
+    ys, xs = torch.meshgrid(torch.arange(target_size_height, device=device, dtype=torch.float32),
+                            torch.arange(target_size_width, device=device, dtype=torch.float32), indexing='ij')
+    grid = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1)
+    grid = torch.einsum('nij,hwj->nhwi', inverse, grid)
+    # pixel centers to [-1, 1] (align_corners=True)
+    grid = grid / torch.tensor([w - 1, h - 1], device=device, dtype=torch.float32) * 2 - 1
+    positions = torch.tensor([used.index(ii) for ii in image_index], device=device)
+    crops = F.grid_sample(frames[positions], grid, mode='bicubic', padding_mode='zeros', align_corners=True)
+    return crops.round_().clamp_(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
@@ -0,0 +1,65 @@
+"""
+Author: Lucas Goncalves
+2023
+
+In-memory video decoding. ffmpeg decodes the video into a pipe as raw RGB
+frames, which are read straight into NumPy arrays, so no frame is written
+to disk.
+"""
+
+import subprocess
+import tempfile
+
+import numpy as np
+
+
+def frame_size(vid_info):
+    """
+    (width, height) of the decoded frames of an ffprobe video stream. ffmpeg
+    applies the rotation of the stream when decoding, so the sides of 90/270
+    degree rotated videos are swapped.
+    """
+    width, height = int(vid_info['width']), int(vid_info['height'])
+    rotation = vid_info.get('tags', {}).get('rotate', 0)
+    for side_data in vid_info.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if int(float(rotation)) % 180 != 0:
+        width, height = height, width
+    return width, height
+
+
+def decode_video(video_file, width, height, fps=None, ffmpeg_bin="ffmpeg"):
+    """
+    Generator over the frames of video_file as (height, width, 3) uint8 RGB arrays.
+
+    fps: sample rate of the frames, None keeps every frame of the video
+    The arrays are read-only views of the pipe buffer.
+    """
+    cmd = [ffmpeg_bin, "-nostdin", "-loglevel", "error", "-i", str(video_file)]
+    if fps is None:
+        cmd += ["-vsync", "0"]
+    else:
+        cmd += ["-vf", "fps=%s" % fps]
+    cmd += ["-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:"]
+
+    frame_bytes = width * height * 3
+    # stderr goes to a file, a full stderr pipe would block ffmpeg
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err, bufsize=frame_bytes)
+        try:
+            while True:
+                buf = proc.stdout.read(frame_bytes)
+                if len(buf) < frame_bytes:
+                    break
+                yield np.frombuffer(buf, dtype=np.uint8).reshape(height, width, 3)
+            returncode = proc.wait()
+        finally:
+            # Stops ffmpeg when the generator is closed before the end of the video
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        if returncode != 0:
+            err.seek(0)
+            raise RuntimeError("ffmpeg failed to decode '%s': %s"
+                               % (str(video_file), err.read().decode(errors="ignore").strip()))
@@ -0,0 +1,114 @@
+"""
+Author: Lucas Goncalves
+2023
+
+Video metadata gathering. ffprobe runs on a bounded thread pool (every probe
+is a subprocess, so the threads only wait on it), and the results are kept in
+a JSON cache keyed by path, size and modification time, so unchanged videos
+are not probed again.
+"""
+
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+from utils.VideoDecoder import frame_size
+
+
+# data modules of the same process (e.g. the decoding threads of face_extractor.py) can share a cache file
+_cache_lock = threading.Lock()
+
+
+def probe_video(video_file):
+    """
+    Metadata of the first video stream of video_file, as stored in FaceVideoDataModule.video_metas
+    """
+    import ffmpeg
+    vid = ffmpeg.probe(str(video_file))
+    codec_idx = [idx for idx, stream in enumerate(vid['streams']) if stream['codec_type'] == 'video']
+    if len(codec_idx) == 0:
+        raise RuntimeError("Video file has no video streams! '%s'" % str(video_file))
+    if len(codec_idx) > 1:
+        print("[WARNING] Video file has %d video streams. Only the first one will be processed" % len(codec_idx))
+    vid_info = vid['streams'][codec_idx[0]]
+    vid_meta = {}
+    vid_meta['fps'] = vid_info['avg_frame_rate']
+    vid_meta['width'] = int(vid_info['width'])
+    vid_meta['height'] = int(vid_info['height'])
+    # size of the decoded frames, which are rotated according to the stream metadata
+    vid_meta['frame_width'], vid_meta['frame_height'] = frame_size(vid_info)
+    vid_meta['num_frames'] = int(vid_info['nb_frames'])
+    return vid_meta
+
+
+def _file_key(video_file):
+    stat = os.stat(video_file)
+    return os.path.abspath(video_file), stat.st_size, stat.st_mtime_ns
+
+
+def _load_cache(cache_path):
+    if cache_path is None or not os.path.isfile(cache_path):
+        return {}
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except ValueError:
+        print("[WARNING] Ignoring the corrupted video metadata cache '%s'" % cache_path)
+        return {}
+
+
+def _save_cache(cache_path, entries):
+    with _cache_lock:
+        # merged with what other runs wrote in the meantime
+        cache = _load_cache(cache_path)
+        cache.update(entries)
+        tmp_path = "%s.%d.%d.tmp" % (cache_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+
+
+def _probe_video_or_none(video_file):
+    try:
+        return probe_video(video_file)
+    except Exception as e:
+        print("[WARNING] Failed to probe '%s': %s" % (str(video_file), repr(e)))
+        return None
+
+
+def gather_video_metadata(video_files, cache_path=None, num_workers=8, skip_errors=False):
+    """
+    Metadata of every video of video_files (in order), probed by up to num_workers threads.
+    cache_path: JSON file with the metadata of previously probed videos, None disables the cache
+    skip_errors: videos that cannot be probed get None metadata instead of raising
+    """
+    keys = [_file_key(video_file) for video_file in video_files]
+    with _cache_lock:
+        cache = _load_cache(cache_path)
+
+    metas = [None] * len(video_files)
+    missing = []
+    for i, (path, size, mtime) in enumerate(keys):
+        entry = cache.get(path)
+        if entry is not None and entry['size'] == size and entry['mtime_ns'] == mtime:
+            metas[i] = entry['meta']
+        else:
+            missing += [i]
+
+    if len(missing) > 0:
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(num_workers, len(missing)))) as pool:
+                probed = pool.map(_probe_video_or_none if skip_errors else probe_video,
+                                  [video_files[i] for i in missing])
+                for i, vid_meta in zip(missing, tqdm(probed, total=len(missing))):
+                    metas[i] = vid_meta
+        finally:
+            # the videos probed before a failure are not probed again either
+            if cache_path is not None:
+                _save_cache(cache_path, {keys[i][0]: {'size': keys[i][1], 'mtime_ns': keys[i][2], 'meta': metas[i]}
+                                         for i in missing if metas[i] is not None})
+    print("Probed %d videos, %d from the metadata cache" % (len(missing), len(video_files) - len(missing)))
+    return metas